@@ -0,0 +1,162 @@
+"""Wallet and session-minute accounting as single conditional UPDATE statements.
+
+Each debit or credit is one `UPDATE users ... WHERE <guard> RETURNING ...`. The guard is
+evaluated by the database against the current row: enough balance, enough minutes, no
+active session, or an unused free chat. So two concurrent requests (a double click, several
+tabs) can't both pass a check that only one should pass, and nothing is read, modified and
+written back from Python. Callers add their audit rows in the same transaction and commit.
+Touched user IDs are registered on the session so the identity cache drops them on commit.
+
+Every change also appends a row to the ledger in the same transaction. Ledger rows are never
+updated or deleted, so `users.wallet_balance` and `available_session_minutes` are
+materialized projections of the ledger: each row records its signed deltas (credits and
+minute grants positive, debits and minute consumption negative) and the balances after it.
+"""
+from collections import namedtuple
+from datetime import datetime
+
+from sqlalchemy import and_, delete, exists, func, insert, literal, or_, select, update
+
+Balance = namedtuple('Balance', ['user_id', 'wallet_balance', 'available_session_minutes', 'session_end_time', 'free_chat_used'])
+StatementEntry = namedtuple('StatementEntry', ['id', 'created_at', 'kind', 'amount', 'minutes', 'balance_after', 'minutes_after', 'reference'])
+ClaimedPayment = namedtuple('ClaimedPayment', ['phone_number', 'amount', 'original_amount', 'session_count', 'discount_code'])
+
+# Ledger entry kinds
+OPENING_BALANCE = 'opening_balance' # Balances that predate the ledger
+TOPUP = 'topup' # Wallet credit from a verified payment
+DISCOUNT_CREDIT = 'discount_credit' # Wallet credit from a 100% discount code
+SESSION_PURCHASE = 'session_purchase' # Wallet debit that grants session minutes
+SESSION_START = 'session_start' # Session minutes consumed
+FREE_SESSION = 'free_session' # One-time free session; no balance change, recorded for the statement
+
+
+class Accounts:
+    def __init__(self, db, user_model, pending_model, ledger_model):
+        self.db = db
+        self.users = user_model.__table__
+        self.pending = pending_model.__table__
+        self.ledger = ledger_model.__table__
+
+    def _record(self, balance, kind, amount=0, minutes=0, reference=None):
+        """Appends the ledger row for a change that just produced `balance`."""
+        self.db.session.execute(insert(self.ledger).values(
+            user_id=balance.user_id, kind=kind, amount=amount, minutes=minutes,
+            balance_after=balance.wallet_balance, minutes_after=balance.available_session_minutes,
+            reference=reference, created_at=datetime.utcnow(),
+        ))
+        return balance
+
+    def _update_user(self, where, guard, **values):
+        """Applies `values` to the user row matching `where` if `guard` holds; returns the new Balance or None."""
+        users = self.users
+        statement = update(users).where(where)
+        if guard is not None:
+            statement = statement.where(guard)
+        row = self.db.session.execute(statement.values(**values).returning(
+            users.c.id, users.c.wallet_balance, users.c.available_session_minutes,
+            users.c.session_end_time, users.c.free_chat_used,
+        )).first()
+        if row is None:
+            return None
+        self.db.session.info.setdefault('touched_user_ids', set()).add(row.id)
+        return Balance(*row)
+
+    def _no_active_session(self, now):
+        return or_(self.users.c.session_end_time.is_(None), self.users.c.session_end_time <= now)
+
+    def buy_minutes(self, user_id, price, minutes):
+        """Debits `price` from the wallet and adds `minutes`; None if the balance is too low."""
+        users = self.users
+        balance = self._update_user(
+            users.c.id == user_id,
+            users.c.wallet_balance >= price,
+            wallet_balance=users.c.wallet_balance - price,
+            available_session_minutes=users.c.available_session_minutes + minutes,
+            free_chat_used=True, # The first purchase ends free chat eligibility
+        )
+        return balance and self._record(balance, SESSION_PURCHASE, amount=-price, minutes=minutes)
+
+    def start_paid_session(self, user_id, minutes, end_time, now):
+        """Consumes `minutes` and opens a session until `end_time`; None if short on minutes or already in a session."""
+        users = self.users
+        balance = self._update_user(
+            users.c.id == user_id,
+            (users.c.available_session_minutes >= minutes) & self._no_active_session(now),
+            available_session_minutes=users.c.available_session_minutes - minutes,
+            session_end_time=end_time,
+            free_chat_used=True,
+        )
+        return balance and self._record(balance, SESSION_START, minutes=-minutes)
+
+    def start_free_session(self, user_id, end_time, now):
+        """Opens the one-time free session; None if it was already used or a session is active."""
+        users = self.users
+        balance = self._update_user(
+            users.c.id == user_id,
+            users.c.free_chat_used.is_(False) & self._no_active_session(now),
+            session_end_time=end_time,
+            free_chat_used=True,
+        )
+        return balance and self._record(balance, FREE_SESSION)
+
+    def credit_wallet(self, user_id, amount, kind=TOPUP, reference=None):
+        users = self.users
+        balance = self._update_user(users.c.id == user_id, None, wallet_balance=users.c.wallet_balance + amount)
+        return balance and self._record(balance, kind, amount=amount, reference=reference)
+
+    def credit_wallet_by_phone(self, phone_number, amount, kind=TOPUP, reference=None):
+        users = self.users
+        balance = self._update_user(users.c.phone_number == phone_number, None, wallet_balance=users.c.wallet_balance + amount)
+        return balance and self._record(balance, kind, amount=amount, reference=reference)
+
+    def claim_pending_payment(self, authority):
+        """Deletes and returns the pending transaction for `authority`.
+
+        Only one concurrent caller gets the row; the others get None and must not credit.
+        """
+        pending = self.pending
+        row = self.db.session.execute(
+            delete(pending).where(pending.c.authority == authority).returning(
+                pending.c.phone_number, pending.c.amount, pending.c.original_amount,
+                pending.c.session_count, pending.c.discount_code,
+            )
+        ).first()
+        return ClaimedPayment(*row) if row else None
+
+    def statement(self, user_id, limit=50, before_id=None):
+        """Newest-first ledger page for one user, keyset-paginated on the (user_id, id) index."""
+        ledger = self.ledger
+        query = select(
+            ledger.c.id, ledger.c.created_at, ledger.c.kind, ledger.c.amount, ledger.c.minutes,
+            ledger.c.balance_after, ledger.c.minutes_after, ledger.c.reference,
+        ).where(ledger.c.user_id == user_id)
+        if before_id is not None:
+            query = query.where(ledger.c.id < before_id)
+        rows = self.db.session.execute(query.order_by(ledger.c.id.desc()).limit(limit)).all()
+        return [StatementEntry(*row) for row in rows]
+
+    def ledger_totals(self, user_id):
+        """(wallet balance, minutes) as summed from the ledger; should equal the user row."""
+        ledger = self.ledger
+        row = self.db.session.execute(
+            select(func.coalesce(func.sum(ledger.c.amount), 0), func.coalesce(func.sum(ledger.c.minutes), 0))
+            .where(ledger.c.user_id == user_id)
+        ).first()
+        return tuple(row)
+
+    def open_missing_accounts(self):
+        """Records an opening entry for every user with a balance but no ledger history yet.
+
+        Run once after the ledger table is created; returns the number of accounts opened.
+        """
+        users, ledger = self.users, self.ledger
+        has_history = exists().where(ledger.c.user_id == users.c.id)
+        opening = select(
+            users.c.id, literal(OPENING_BALANCE), users.c.wallet_balance, users.c.available_session_minutes,
+            users.c.wallet_balance, users.c.available_session_minutes, literal(datetime.utcnow()),
+        ).where(and_(~has_history, or_(users.c.wallet_balance != 0, users.c.available_session_minutes != 0)))
+        result = self.db.session.execute(insert(ledger).from_select(
+            ['user_id', 'kind', 'amount', 'minutes', 'balance_after', 'minutes_after', 'created_at'], opening,
+        ))
+        self.db.session.commit()
+        return result.rowcount
@@ -0,0 +1,89 @@
+"""Per-endpoint-class admission control.
+
+Endpoints that wait on a slow upstream (chat turns, chat history, speech-to-text) are
+grouped into classes, each with a concurrency limit and a short bounded wait queue.
+A request that finds its class full waits up to ADMISSION_MAX_WAIT seconds for a slot;
+when the queue is full too, or the wait runs out, it is turned away at once with a 503 and
+Retry-After instead of piling up behind the slow upstream.
+
+All limited classes also share ADMISSION_HEAVY_SLOTS, counting running and waiting
+requests (both hold a worker thread under WSGI). Set it below the server's thread count:
+the difference is kept free for cheap endpoints such as /api/auth/status and
+/api/wallet/balance, which are never limited. So a MetisAI slowdown degrades chat, not login.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+
+ADMISSION_HEAVY_SLOTS = int(os.getenv('ADMISSION_HEAVY_SLOTS', 24))
+ADMISSION_MAX_WAIT = float(os.getenv('ADMISSION_MAX_WAIT', 5)) # Seconds a request may queue for a slot
+
+EndpointClass = namedtuple('EndpointClass', ['name', 'limit', 'queue', 'retry_after'])
+
+
+class Ticket:
+    """A held slot; release() is idempotent so both the request teardown and the ASGI bridge may call it."""
+
+    def __init__(self, admission, name):
+        self._admission = admission
+        self.name = name
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._admission._release(self.name)
+
+
+class Admission:
+    def __init__(self, classes, heavy_slots=ADMISSION_HEAVY_SLOTS, max_wait=ADMISSION_MAX_WAIT):
+        self.classes = {c.name: c for c in classes}
+        self.heavy_slots = heavy_slots
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._freed = {name: threading.Condition(self._lock) for name in self.classes}
+        self.running = dict.fromkeys(self.classes, 0)
+        self.waiting = dict.fromkeys(self.classes, 0)
+        self.rejected = dict.fromkeys(self.classes, 0)
+
+    def acquire(self, name):
+        """Returns a Ticket, or None if the request should be turned away. Unknown classes are unlimited."""
+        endpoint_class = self.classes.get(name)
+        if endpoint_class is None:
+            return Ticket(self, None)
+        with self._lock:
+            if sum(self.running.values()) + sum(self.waiting.values()) >= self.heavy_slots:
+                self.rejected[name] += 1
+                return None
+            if self.running[name] < endpoint_class.limit:
+                self.running[name] += 1
+                return Ticket(self, name)
+            if self.waiting[name] >= endpoint_class.queue:
+                self.rejected[name] += 1
+                return None
+            self.waiting[name] += 1
+            deadline = time.monotonic() + self.max_wait
+            try:
+                while self.running[name] >= endpoint_class.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.rejected[name] += 1
+                        return None
+                    self._freed[name].wait(remaining)
+            finally:
+                self.waiting[name] -= 1
+            self.running[name] += 1
+            return Ticket(self, name)
+
+    def _release(self, name):
+        if name is None:
+            return
+        with self._lock:
+            self.running[name] -= 1
+            self._freed[name].notify()
+
+    def snapshot(self):
+        with self._lock:
+            return {name: {'limit': c.limit, 'running': self.running[name], 'waiting': self.waiting[name],
+                           'rejected': self.rejected[name]} for name, c in self.classes.items()}
@@ -1,45 +1,70 @@
-from flask import Flask, request, jsonify, redirect, url_for, session
+from flask import Flask, Blueprint, current_app, request, jsonify, redirect, url_for, session, g, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from flask.json.provider import DefaultJSONProvider
 # import bcrypt # No longer needed for user auth based on OTP
 import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 import logging
-from suds.client import Client # For Zarinpal SOAP requests
+import logs
 from dotenv import load_dotenv
-from sqlalchemy.orm import relationship
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url as sa_make_url
+from sqlalchemy.orm import relationship, Session as OrmSession
 from flask_session import Session # For server-side sessions
 from sqlalchemy.exc import IntegrityError
-from melipayamak import Api
-import random
-import string
+import json
+import re
+import time
+import hashlib
+import hmac
+import threading
+from werkzeug.http import parse_etags
+from werkzeug.middleware.proxy_fix import ProxyFix
+from urllib.parse import urlsplit
+import upstream
+from zarinpal import ZarinpalGateway # For Zarinpal SOAP requests
+from session_store import DatabaseSessionInterface
+import otp
+from caching import TTLCache
+import titles
+import transcripts
+import stt
+import accounting
+import rollups
+import reconcile
+import discounts
+import admission
+import metrics
+import profiler
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-# Configure CORS to allow credentials (cookies) from the frontend origin
+# Importing this module only defines things: routes and request hooks go on this blueprint, and
+# create_app() (see the end of the file) builds the Flask app, binds the database and registers them.
+# `app:app` and asgi.py get a default app built on first access.
+bp = Blueprint('delyar', __name__, cli_group=None) # cli_group=None: `flask init-db`, not `flask delyar init-db`
+# CORS allows credentials (cookies) from the frontend origin
 FRONTEND_URL = os.getenv('FRONTEND_URL', "http://localhost:3000")
-CORS(app, origins=[FRONTEND_URL], supports_credentials=True, methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
+# Reverse proxies (nginx) in front of the app whose X-Forwarded-For/-Proto are trusted. Keep 0 unless every
+# request comes through them (gunicorn.conf.py sets 1), or clients can forge the address the per-IP OTP limit uses.
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', 0))
 
 # --- Session Configuration ---
-# Choose a session type (filesystem is simple for dev)
-SESSION_TYPE = os.getenv('SESSION_TYPE', 'filesystem')
+# 'database' keeps sessions in the shared PostgreSQL table (see session_store.py), so any node can
+# serve any request; other values ('filesystem', 'redis', ...) are handed to flask_session
+SESSION_TYPE = os.getenv('SESSION_TYPE', 'database')
 SESSION_FILE_DIR = os.getenv('SESSION_FILE_DIR', './flask_session')
 SESSION_PERMANENT = False # Make sessions non-permanent (browser session)
 SESSION_USE_SIGNER = True # Encrypt session cookie
 SESSION_KEY_PREFIX = 'delyar_session:'
 # IMPORTANT: Set a strong, random secret key in your .env file for production
-app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-in-prod')
-app.config.from_object(__name__)
-# Create the session directory if it doesn't exist (for filesystem type)
-if SESSION_TYPE == 'filesystem' and not os.path.exists(SESSION_FILE_DIR):
-    os.makedirs(SESSION_FILE_DIR)
-    logger.info(f"Created session directory: {SESSION_FILE_DIR}")
-Session(app)
+SECRET_KEY = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-in-prod')
 # --- End Session Configuration ---
 
 SESSION_PRICE = int(os.getenv('SESSION_PRICE', 39000))
@@ -50,15 +75,14 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_HOST = os.getenv('DB_HOST')
 DB_PORT = os.getenv('DB_PORT')
 DB_NAME = os.getenv('DB_NAME')
-DATABASE_URL = f'postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
-logger.info(f"Database URL: postgresql://{DB_USERNAME}:****@{DB_HOST}:{DB_PORT}/{DB_NAME}")
-
-app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 # Set to False in production unless debugging SQL queries
-app.config['SQLALCHEMY_ECHO'] = os.getenv('SQLALCHEMY_ECHO', 'False').lower() == 'true'
+SQLALCHEMY_ECHO = os.getenv('SQLALCHEMY_ECHO', 'False').lower() == 'true'
+
+def database_url():
+    # DATABASE_URL, when set, replaces the DB_* settings (benchmarks point it at a scratch database)
+    return os.getenv('DATABASE_URL') or f'postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
 
-db = SQLAlchemy(app)
+db = SQLAlchemy() # Bound to the app by create_app(); the engine is only built then
 
 # Chatbot configuration
 CHATBOT_URL = os.getenv('CHATBOT_URL')
@@ -68,22 +92,53 @@ CHATBOT_HEADERS = {
     'Authorization': CHATBOT_TOKEN,
     'Content-Type': 'application/json',
 }
+# Upstream read timeout for a whole chat turn; streamed turns apply it between chunks instead
+CHATBOT_MESSAGE_TIMEOUT = 90
+CHATBOT_STREAM_CONNECT_TIMEOUT = 10
 
 # Melipayamak Configuration
 MELIPAYAMAK_USERNAME = os.getenv('MELIPAYAMAK_USERNAME')
 MELIPAYAMAK_PASSWORD = os.getenv('MELIPAYAMAK_PASSWORD')
 MELIPAYAMAK_TEMPLATE = os.getenv('MELIPAYAMAK_TEMPLATE')
+# Called directly through the pooled upstream client rather than a per-request melipayamak.Api
+MELIPAYAMAK_SEND_URL = os.getenv('MELIPAYAMAK_SEND_URL', 'https://rest.payamak-panel.com/api/SendSMS/BaseServiceNumber')
 
 # Zarinpal Configuration
 ZARINPAL_MERCHANT_ID = os.getenv('MMERCHANT_ID') 
-ZARINPAL_WEBSERVICE = 'https://www.zarinpal.com/pg/services/WebGate/wsdl'
-ZARINPAL_STARTPAY_URL = 'https://www.zarinpal.com/pg/StartPay/'
+ZARINPAL_WEBSERVICE = os.getenv('ZARINPAL_WEBSERVICE', 'https://www.zarinpal.com/pg/services/WebGate/wsdl')
+ZARINPAL_STARTPAY_URL = os.getenv('ZARINPAL_STARTPAY_URL', 'https://www.zarinpal.com/pg/StartPay/')
+zarinpal_gateway = ZarinpalGateway(ZARINPAL_WEBSERVICE) # suds and the WSDL are loaded on first use (or by preload())
 
 # STT Configuration
 STT_API_KEY = os.getenv('API_KEY')  # Add this to your .env file
 STT_API_URL = os.getenv('STT_API_URL', 'https://api.metisai.ir/openai/v1/audio/transcriptions')
-
-DISCOUNT_CODES = {
+STT_MODEL = os.getenv('STT_MODEL', 'whisper-1')
+STT_TIMEOUT = 60
+# Shared pool that bounds how many chunk transcriptions run against the STT API at once
+STT_CHUNK_WORKERS = int(os.getenv('STT_CHUNK_WORKERS', 4))
+stt_chunk_executor = ThreadPoolExecutor(max_workers=STT_CHUNK_WORKERS, thread_name_prefix='stt-chunk')
+stt_cache = stt.TranscriptionCache()
+
+# Operation names for upstream calls in the metrics; unmatched calls are reported as "<host> <METHOD>"
+upstream.register_operation('metis.session_list', 'GET', r'/chat/session$')
+upstream.register_operation('metis.session_detail', 'GET', r'/chat/session/[^/]+$')
+upstream.register_operation('metis.create_session', 'POST', r'/chat/session$')
+upstream.register_operation('metis.message', 'POST', r'/chat/session/[^/]+/message$')
+upstream.register_operation('metis.message_stream', 'POST', r'/chat/session/[^/]+/message/stream$')
+upstream.register_operation('stt.transcribe', 'POST', '^' + re.escape(STT_API_URL))
+upstream.register_operation('melipayamak.send', 'POST', '^' + re.escape(MELIPAYAMAK_SEND_URL))
+ZARINPAL_HOST_PATTERN = '^https?://' + re.escape(urlsplit(ZARINPAL_WEBSERVICE).netloc) + '/'
+upstream.register_operation('zarinpal.request', 'POST', ZARINPAL_HOST_PATTERN, soap_action='PaymentRequest')
+upstream.register_operation('zarinpal.verify', 'POST', ZARINPAL_HOST_PATTERN, soap_action='PaymentVerification')
+upstream.register_operation('zarinpal.wsdl', 'GET', ZARINPAL_HOST_PATTERN)
+
+# Bearer token for the /api/admin endpoints; they are disabled while it is unset
+ADMIN_API_TOKEN = os.getenv('ADMIN_API_TOKEN')
+REPORT_DEFAULT_DAYS = 30
+REPORT_MAX_DAYS = 366
+
+# Seeded into discount_codes on first start; codes are managed through /api/admin/discount-codes
+DEFAULT_DISCOUNT_CODES = {
     'javaheri': 50,  
     'moshaverto': 50,  
     'hamrah': 25, 
@@ -151,6 +206,48 @@ class Purchase(db.Model):
 
     user = relationship("User", back_populates="purchases")
 
+# Append-only wallet and minutes history; users.wallet_balance and available_session_minutes
+# are projections of it, updated in the same transaction by accounting.py
+class LedgerEntry(db.Model):
+    __tablename__ = 'ledger_entries'
+    __table_args__ = (
+        db.Index('ix_ledger_entries_user_id_id', 'user_id', 'id'), # Per-user statements, newest first
+    )
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    kind = db.Column(db.String(30), nullable=False) # See the kinds in accounting.py
+    amount = db.Column(db.Integer, default=0, nullable=False) # Signed wallet change in Rials
+    minutes = db.Column(db.Integer, default=0, nullable=False) # Signed session-minutes change
+    balance_after = db.Column(db.Integer, nullable=False)
+    minutes_after = db.Column(db.Integer, nullable=False)
+    reference = db.Column(db.String(100), nullable=True) # Payment RefID, discount code, purchase ID...
+
+# Local mirror of MetisAI transcripts, written behind the chat endpoints by transcripts.py
+class ChatSession(db.Model):
+    __tablename__ = 'chat_sessions'
+
+    session_id = db.Column(db.String(100), primary_key=True) # MetisAI session ID
+    phone_number = db.Column(db.String(20), nullable=False, index=True) # MetisAI userId
+    title = db.Column(db.String(200), nullable=True)
+    complete = db.Column(db.Boolean, default=False, nullable=False) # Holds the whole transcript, so reads can skip MetisAI
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    messages = relationship("ChatMessage", back_populates="session", lazy='dynamic', order_by="ChatMessage.id")
+
+class ChatMessage(db.Model):
+    __tablename__ = 'chat_messages'
+
+    id = db.Column(db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True) # Insertion order is transcript order
+    session_id = db.Column(db.String(100), db.ForeignKey('chat_sessions.session_id', ondelete='CASCADE'), nullable=False, index=True)
+    type = db.Column(db.String(20), nullable=True) # USER or AI, as in MetisAI
+    content = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.String(40), nullable=True) # Kept in MetisAI's string format for the frontend
+
+    session = relationship("ChatSession", back_populates="messages")
+
 class Feedback(db.Model):
     __tablename__ = 'feedback'
 
@@ -172,28 +269,238 @@ class PendingTransaction(db.Model):
     original_amount = db.Column(db.Integer, nullable=False)
     session_count = db.Column(db.Integer, nullable=False)
     discount_code = db.Column(db.String(50), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True) # Reconciliation scans
+
+class OrphanedPayment(db.Model):
+    """Gateway-verified payments whose user no longer exists; kept for a manual refund or credit."""
+    __tablename__ = 'orphaned_payments'
+
+    id = db.Column(db.Integer, primary_key=True)
+    authority = db.Column(db.String(100), nullable=False, unique=True)
+    ref_id = db.Column(db.String(100), nullable=False)
+    phone_number = db.Column(db.String(20), nullable=False)
+    amount = db.Column(db.Integer, nullable=False) # Paid to the gateway
+    original_amount = db.Column(db.Integer, nullable=False) # Owed to the wallet
+    discount_code = db.Column(db.String(50), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
 
-# Temporary storage for OTPs (Replace with Redis/DB in production!)
-# Format: { 'phone_number': {'otp': '1234', 'expiry': datetime_object} }
-# Using Flask session is a better temporary approach than a global dict
-# otp_storage = {}
+class ServerSessionRecord(db.Model):
+    __tablename__ = 'server_sessions'
 
+    session_id = db.Column(db.String(64), primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False) # Tagged-JSON session payload
+    expires_at = db.Column(db.DateTime, nullable=False, index=True) # Drives lookups and the sweeper
+
+# Installed on the app by create_app() when SESSION_TYPE is 'database'
+database_session_interface = DatabaseSessionInterface(db, ServerSessionRecord)
+
+class OtpCode(db.Model):
+    __tablename__ = 'otp_codes'
+
+    phone_number = db.Column(db.String(20), primary_key=True)
+    code_hash = db.Column(db.String(64), nullable=True) # HMAC of the pending code; NULL once used or expired
+    expires_at = db.Column(db.DateTime, nullable=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    # Per-phone send token bucket, updated under the row lock
+    send_tokens = db.Column(db.Float, nullable=False)
+    tokens_updated_at = db.Column(db.DateTime, nullable=False)
+
+class ChatTitle(db.Model):
+    __tablename__ = 'chat_titles'
+
+    session_id = db.Column(db.String(100), primary_key=True) # MetisAI session ID
+    phone_number = db.Column(db.String(20), nullable=False, index=True)
+    title = db.Column(db.String(100), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default=titles.PENDING) # pending, done, failed or empty
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+# Per-day business metrics maintained by rollups.py; admin reports read only these
+class DailyRollup(db.Model):
+    __tablename__ = 'daily_rollups'
+
+    day = db.Column(db.Date, primary_key=True) # Local (Tehran) calendar day
+    revenue = db.Column(db.BigInteger, default=0, nullable=False) # Rials paid through the gateway
+    topups = db.Column(db.Integer, default=0, nullable=False)
+    wallet_credited = db.Column(db.BigInteger, default=0, nullable=False) # Rials credited, including discounts
+    session_purchases = db.Column(db.Integer, default=0, nullable=False)
+    paid_sessions = db.Column(db.Integer, default=0, nullable=False)
+    free_sessions = db.Column(db.Integer, default=0, nullable=False)
+    new_users = db.Column(db.Integer, default=0, nullable=False)
+    feedback_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_sum = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class RollupWatermark(db.Model):
+    __tablename__ = 'rollup_watermarks'
+
+    source = db.Column(db.String(50), primary_key=True) # Source table name
+    last_id = db.Column(db.BigInteger, default=0, nullable=False) # Highest id already folded into the rollups
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+class DiscountCode(db.Model):
+    __tablename__ = 'discount_codes'
+
+    code = db.Column(db.String(50), primary_key=True) # Stored lowercase
+    percent = db.Column(db.Integer, nullable=False) # 1-100
+    active = db.Column(db.Boolean, default=True, nullable=False)
+    starts_at = db.Column(db.DateTime, nullable=True)
+    ends_at = db.Column(db.DateTime, nullable=True)
+    max_uses = db.Column(db.Integer, nullable=True) # None for unlimited
+    # Usage statistics, flushed in batches by discounts.py
+    used_count = db.Column(db.Integer, default=0, nullable=False)
+    discount_total = db.Column(db.BigInteger, default=0, nullable=False) # Rials discounted
+    last_used_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+
+    def to_dict(self):
+        return {
+            'code': self.code,
+            'percent': self.percent,
+            'active': self.active,
+            'starts_at': self.starts_at.isoformat() if self.starts_at else None,
+            'ends_at': self.ends_at.isoformat() if self.ends_at else None,
+            'max_uses': self.max_uses,
+            'used_count': self.used_count,
+            'discount_total': self.discount_total,
+            'last_used_at': self.last_used_at.isoformat() if self.last_used_at else None,
+        }
+
+transcript_store = transcripts.TranscriptStore(db, ChatSession, ChatMessage)
+accounts = accounting.Accounts(db, User, PendingTransaction, LedgerEntry)
+discount_codes = discounts.DiscountCodes(db, DiscountCode)
+reports = rollups.Rollups(db, DailyRollup, RollupWatermark, User, Purchase, LedgerEntry, Feedback)
+
+
+# --- Identity Cache ---
+# Read-only snapshot of the user fields that hot polling endpoints need. Cached per process for
+# IDENTITY_CACHE_TTL seconds (0 disables) and dropped whenever a commit touches the user row.
+IDENTITY_CACHE_TTL = float(os.getenv('IDENTITY_CACHE_TTL', 5))
+IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', 10000))
+identity_cache = TTLCache(max_size=IDENTITY_CACHE_SIZE, ttl=IDENTITY_CACHE_TTL)
+
+Identity = namedtuple('Identity', [
+    'id', 'phone_number', 'wallet_balance', 'free_chat_used', 'session_end_time', 'available_session_minutes'
+])
+
+def invalidate_identity(user_id):
+    identity_cache.pop(user_id)
+
+@event.listens_for(OrmSession, 'after_flush')
+def _collect_touched_users(orm_session, flush_context):
+    touched = orm_session.info.setdefault('touched_user_ids', set())
+    for obj in (*orm_session.new, *orm_session.dirty, *orm_session.deleted):
+        if isinstance(obj, User) and obj.id is not None:
+            touched.add(obj.id)
+
+@event.listens_for(OrmSession, 'after_commit')
+def _invalidate_touched_users(orm_session):
+    for user_id in orm_session.info.pop('touched_user_ids', ()):
+        invalidate_identity(user_id)
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_touched_users(orm_session):
+    orm_session.info.pop('touched_user_ids', None)
+
+# --- Chat Cache ---
+# MetisAI session lists (per user, per page) and transcripts (per session), served with ETags.
+# Dropped locally when this process creates a session or sends a message; other nodes may
+# serve an entry for up to CHAT_CACHE_TTL seconds.
+CHAT_CACHE_TTL = float(os.getenv('CHAT_CACHE_TTL', 30))
+CHAT_CACHE_SIZE = int(os.getenv('CHAT_CACHE_SIZE', 5000))
+chat_list_cache = TTLCache(max_size=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL) # phone -> {(page, size): (body, etag, stored_at)}
+chat_detail_cache = TTLCache(max_size=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL) # session_id -> (body, etag)
+# Last invalidation time per key, so a fetch that started before it can't store stale data
+chat_invalidated_at = TTLCache(max_size=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL)
+
+def make_cache_entry(data):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    return body, hashlib.sha1(body).hexdigest()
+
+def cached_json_response(entry, if_none_match=None):
+    """Builds a JSON response for a (body, etag) entry, or a 304 if the client already has it."""
+    body, etag = entry
+    if if_none_match and parse_etags(if_none_match).contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache' # Always revalidate; 304s are cheap
+    return response
+
+def get_cached_chat_list(phone_number, page_key):
+    pages = chat_list_cache.get(phone_number)
+    entry = pages.get(page_key) if pages else None
+    if entry and time.monotonic() - entry[2] < CHAT_CACHE_TTL:
+        return entry[:2]
+    return None
+
+def store_chat_list(phone_number, page_key, entry, started_at):
+    if chat_invalidated_at.get(('list', phone_number), 0) > started_at:
+        return
+    pages = dict(chat_list_cache.get(phone_number) or {})
+    pages[page_key] = (*entry, time.monotonic())
+    chat_list_cache.set(phone_number, pages)
+
+def store_chat_detail(session_id, entry, started_at):
+    if chat_invalidated_at.get(('detail', session_id), 0) > started_at:
+        return
+    chat_detail_cache.set(session_id, entry)
+
+def invalidate_chat_caches(phone_number, session_id=None):
+    """Drops cached chat data after this user's sessions or a session's transcript changed."""
+    now = time.monotonic()
+    chat_list_cache.pop(phone_number)
+    chat_invalidated_at.set(('list', phone_number), now)
+    if session_id:
+        chat_detail_cache.pop(session_id)
+        chat_invalidated_at.set(('detail', session_id), now)
 
 # --- Helper Functions ---
 def get_current_user():
-    """Gets the currently authenticated user object from session."""
+    """Gets the currently authenticated user object from session (loaded once per request)."""
+    if 'current_user' in g:
+        return g.current_user
     user_id = session.get('user_id')
     if not user_id:
         return None
     user = User.query.get(user_id)
     # Verify session phone matches user's phone for extra security
     if user and user.phone_number == session.get('phone_number'):
+        g.current_user = user
         return user
     # If mismatch, session might be invalid, clear it
     session.clear()
     return None
 
+def get_current_identity():
+    """Like get_current_user, but returns a cached read-only Identity for hot read-only checks."""
+    user_id = session.get('user_id')
+    if not user_id:
+        return None
+    identity = identity_cache.get(user_id) if IDENTITY_CACHE_TTL > 0 else None
+    if identity is None:
+        user = get_current_user()
+        if not user:
+            return None
+        identity = Identity(
+            id=user.id,
+            phone_number=user.phone_number,
+            wallet_balance=user.wallet_balance,
+            free_chat_used=user.free_chat_used,
+            session_end_time=user.session_end_time,
+            available_session_minutes=user.available_session_minutes,
+        )
+        if IDENTITY_CACHE_TTL > 0:
+            identity_cache.set(user_id, identity)
+    elif identity.phone_number != session.get('phone_number'):
+        session.clear()
+        return None
+    return identity
+
 def validate_phone_number(phone):
     """Basic phone number validation (adjust regex as needed for Iranian numbers)."""
     if not phone or not isinstance(phone, str):
@@ -202,41 +509,301 @@ def validate_phone_number(phone):
     import re
     return bool(re.match(r'^09\d{9}$', phone))
 
+def sse_event(payload, event=None):
+    """Formats a payload as a single Server-Sent Events frame."""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def extract_stream_content(raw):
+    """Pulls the message text out of one MetisAI stream event, or None if it carries no text."""
+    try:
+        event_data = json.loads(raw)
+    except ValueError:
+        return raw  # Plain-text chunk
+    if not isinstance(event_data, dict):
+        return None
+    message = event_data.get('message')
+    if isinstance(message, dict):
+        return message.get('content')
+    return event_data.get('content')
+
+SSE_RESPONSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+class ChatStreamRelay:
+    """Turns MetisAI stream lines into SSE frames for the browser.
+
+    Shared by the WSGI generator in stream_upstream and the event-loop path in asgi.py.
+    """
+
+    def __init__(self, session_id, user_id, on_finish=None):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.on_finish = on_finish # Called once the stream ends, successfully or not
+        self.content = ''
+        self.finished = False
+
+    def _delta_frame(self, text):
+        # Some events carry the cumulative reply rather than a delta
+        delta = text[len(self.content):] if text.startswith(self.content) else text
+        if not delta:
+            return None
+        self.content += delta
+        return sse_event({'delta': delta})
+
+    def feed_line(self, line):
+        """Consumes one line of the upstream event stream; returns a frame to send, or None."""
+        if not line or not line.startswith('data:'):
+            return None
+        raw = line[len('data:'):].strip()
+        if raw == '[DONE]':
+            self.finished = True
+            return None
+        text = extract_stream_content(raw)
+        return self._delta_frame(text) if text else None
+
+    def feed_json(self, response_data):
+        """Handles an upstream that answered with a plain JSON reply instead of a stream."""
+        self.finished = True
+        text = response_data.get('content') if isinstance(response_data, dict) else None
+        return self._delta_frame(text) if text else None
+
+    def _notify_finish(self):
+        if self.on_finish:
+            self.on_finish()
+
+    def done(self):
+        self._notify_finish()
+        return sse_event({'content': self.content}, event='done')
+
+    def error(self, e):
+        self._notify_finish()
+        if isinstance(e, requests.exceptions.RequestException):
+            logger.error("MetisAI stream interrupted for session %s (User: %s): %s", self.session_id, self.user_id, e, exc_info=True)
+            message = 'ارتباط با سرویس گفتگو قطع شد'
+        else:
+            logger.error("Unexpected error streaming chat for session %s (User: %s): %s", self.session_id, self.user_id, e, exc_info=True)
+            message = 'خطای پیش‌بینی نشده در پردازش پیام'
+        return sse_event({'error': message, 'content': self.content}, event='error')
+
+# Set by asgi.py on the WSGI environ; when present, upstream calls are handed to the event loop
+DEFERRED_UPSTREAM_ENVIRON_KEY = 'delyar.defer_upstream'
+
+def call_upstream(method, url, finish, fail, **kwargs):
+    """Performs an upstream HTTP call and maps the outcome to a Flask response.
+
+    `finish(response)` turns the upstream response into a view return value and may raise
+    (e.g. via raise_for_status); `fail(exception)` maps any error to one. Both only use the
+    response API shared by requests and httpx, so under the ASGI entry point the call runs
+    on the event loop instead of holding this worker thread for the whole upstream timeout.
+    """
+    defer = request.environ.get(DEFERRED_UPSTREAM_ENVIRON_KEY)
+    if defer is not None:
+        return defer(method, url, kwargs, finish=finish, fail=fail)
+    try:
+        response = upstream.request(method, url, **kwargs)
+        return finish(response)
+    except Exception as e:
+        return fail(e)
+
+def stream_upstream(method, url, relay, fail, **kwargs):
+    """Like call_upstream, but relays a streamed upstream body through `relay` as SSE.
+
+    `fail` only handles errors raised before the stream opens; later ones become an SSE error event.
+    """
+    defer = request.environ.get(DEFERRED_UPSTREAM_ENVIRON_KEY)
+    if defer is not None:
+        return defer(method, url, kwargs, relay=relay, fail=fail)
+
+    # Open the upstream stream before committing to a 200, so connection failures keep the JSON error shape
+    try:
+        upstream_response = upstream.request(method, url, stream=True, **kwargs)
+        upstream_response.raise_for_status()
+    except Exception as e:
+        return fail(e)
+
+    def generate():
+        try:
+            if 'text/event-stream' not in upstream_response.headers.get('Content-Type', ''):
+                frame = relay.feed_json(upstream_response.json())
+                if frame:
+                    yield frame
+            else:
+                upstream_response.encoding = 'utf-8'
+                # chunk_size=None hands lines over as soon as they arrive instead of buffering 512 bytes
+                for line in upstream_response.iter_lines(chunk_size=None, decode_unicode=True):
+                    frame = relay.feed_line(line)
+                    if frame:
+                        yield frame
+                    if relay.finished:
+                        break
+            yield relay.done()
+        except Exception as e:
+            yield relay.error(e)
+        finally:
+            upstream_response.close()
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=SSE_RESPONSE_HEADERS)
+
+def send_otp_sms(otp_code, phone_number):
+    """Sends an OTP through Melipayamak's shared-number template API; returns the parsed response."""
+    response = upstream.request('POST', MELIPAYAMAK_SEND_URL, data={
+        'username': MELIPAYAMAK_USERNAME,
+        'password': MELIPAYAMAK_PASSWORD,
+        'text': otp_code,
+        'to': phone_number,
+        'bodyId': MELIPAYAMAK_TEMPLATE,
+    }, timeout=20)
+    return response.json()
+
+otp_store = otp.OtpStore(db, OtpCode, SECRET_KEY)
+otp_ip_limiter = otp.IpRateLimiter()
+sms_dispatcher = otp.SmsDispatcher(send_otp_sms)
+
+def is_admin_request():
+    """True if the request carries the configured admin bearer token."""
+    if not ADMIN_API_TOKEN:
+        return False
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), ADMIN_API_TOKEN.encode())
+
+def rate_limited_response(retry_after):
+    response = jsonify({'error': 'تعداد درخواست‌ها بیش از حد مجاز است. لطفا کمی بعد دوباره تلاش کنید.', 'retry_after': retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 429
+
+def overloaded_response(retry_after):
+    response = jsonify({'error': 'سرویس در حال حاضر شلوغ است. لطفا چند لحظه بعد دوباره تلاش کنید.', 'retry_after': retry_after})
+    response.headers['Retry-After'] = str(retry_after)
+    return response, 503
+
+# --- Request Metrics ---
+# Each request is timed from before the session load (metrics.TimingMiddleware) to the last
+# byte, with db, upstream, session, json and handler-tagged phases. The breakdown goes out as
+# a Server-Timing header and one JSON log line per request on the 'delyar.requests' logger.
+REQUEST_METRICS_ENVIRON_KEY = 'delyar.request_metrics'
+REQUEST_PROFILED_ENVIRON_KEY = 'delyar.profiled'
+REQUEST_LOG_MIN_MS = float(os.getenv('REQUEST_LOG_MIN_MS', 0)) # Only log requests at least this slow
+request_logger = logging.getLogger('delyar.requests')
+sampling_profiler = profiler.SamplingProfiler()
+
+event.listen(Engine, 'before_cursor_execute', metrics.query_started)
+event.listen(Engine, 'after_cursor_execute', metrics.query_finished)
+
+class TimedJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        with metrics.phase('json'):
+            return super().dumps(obj, **kwargs)
+
+def view_name():
+    """The matched endpoint without the blueprint prefix; metric labels and ENDPOINT_CLASSES use plain view names."""
+    return request.endpoint.rpartition('.')[2] if request.endpoint else None
+
+def finish_request_timing(timing, status=None):
+    """Records a finished request in the metrics and the request log."""
+    summary = timing.finish(status)
+    if summary and summary['ms'] >= REQUEST_LOG_MIN_MS and request_logger.isEnabledFor(logging.INFO):
+        request_logger.info("%s %s %s %sms", summary['method'], summary['endpoint'], summary['status'], summary['ms'],
+                            extra={'timing': summary})
+
+# Registered before admission control so turned-away requests are measured too
+@bp.before_app_request
+def start_request_metrics():
+    timing = request.environ.get(REQUEST_METRICS_ENVIRON_KEY)
+    if timing is not None:
+        timing.route(view_name())
+    if sampling_profiler.active and sampling_profiler.maybe_track(view_name()):
+        request.environ[REQUEST_PROFILED_ENVIRON_KEY] = True
+
+@bp.after_app_request
+def note_response_status(response):
+    timing = request.environ.get(REQUEST_METRICS_ENVIRON_KEY)
+    if timing is not None:
+        timing.status = response.status_code
+    return response
+
+@bp.teardown_app_request
+def finish_request_metrics(exc):
+    if request.environ.get(REQUEST_PROFILED_ENVIRON_KEY):
+        sampling_profiler.untrack()
+    metrics.bind(None)
+    timing = request.environ.get(REQUEST_METRICS_ENVIRON_KEY)
+    # Under ASGI, asgi.py finishes the timing once the deferred upstream call has been answered
+    if timing is not None and DEFERRED_UPSTREAM_ENVIRON_KEY not in request.environ:
+        finish_request_timing(timing, 500 if exc is not None else None)
+
+# --- Admission Control ---
+# Endpoints that wait on MetisAI or the STT API get per-class concurrency limits (see admission.py),
+# so a slow upstream fast-fails its own class instead of tying up the threads cheap endpoints need
+ADMISSION_CLASSES = [
+    admission.EndpointClass('chat', int(os.getenv('ADMISSION_CHAT_LIMIT', 12)), int(os.getenv('ADMISSION_CHAT_QUEUE', 8)), retry_after=10),
+    admission.EndpointClass('chat_history', int(os.getenv('ADMISSION_HISTORY_LIMIT', 6)), int(os.getenv('ADMISSION_HISTORY_QUEUE', 6)), retry_after=5),
+    admission.EndpointClass('stt', int(os.getenv('ADMISSION_STT_LIMIT', 4)), int(os.getenv('ADMISSION_STT_QUEUE', 4)), retry_after=10),
+]
+ENDPOINT_CLASSES = {
+    'respond_to_chat': 'chat',
+    'respond_to_chat_stream': 'chat',
+    'create_metis_session': 'chat',
+    'get_chat_sessions': 'chat_history',
+    'get_chat_sessions_summary': 'chat_history',
+    'get_chat_session_details': 'chat_history',
+    'transcribe_audio': 'stt',
+}
+# Set on the WSGI environ while a request holds a slot; asgi.py releases it after deferred upstream calls
+ADMISSION_TICKET_ENVIRON_KEY = 'delyar.admission_ticket'
+admission_control = admission.Admission(ADMISSION_CLASSES)
+
+@bp.before_app_request
+def admit_request():
+    class_name = ENDPOINT_CLASSES.get(view_name())
+    if class_name is None or request.method == 'OPTIONS':
+        return None
+    ticket = admission_control.acquire(class_name)
+    if ticket is None:
+        logger.warning("Admission control turned away %s (%s class full)", view_name(), class_name)
+        return overloaded_response(admission_control.classes[class_name].retry_after)
+    request.environ[ADMISSION_TICKET_ENVIRON_KEY] = ticket
+    return None
+
+@bp.teardown_app_request
+def release_admission(exc):
+    ticket = request.environ.get(ADMISSION_TICKET_ENVIRON_KEY)
+    # Under ASGI the upstream call outlives this request context, so the bridge releases the slot
+    if ticket is not None and DEFERRED_UPSTREAM_ENVIRON_KEY not in request.environ:
+        ticket.release()
+
 # --- Authentication Endpoints ---
 
-@app.route('/api/auth/request-otp', methods=['POST'])
+@bp.route('/api/auth/request-otp', methods=['POST'])
 def request_otp():
     data = request.json
     phone_number = data.get('phone_number')
     if not validate_phone_number(phone_number):
         return jsonify({'error': 'شماره تلفن وارد شده معتبر نیست'}), 400
 
+    retry_after = otp_ip_limiter.take(request.remote_addr or 'unknown')
+    if retry_after:
+        logger.warning("OTP request from IP %s rate limited (phone %s)", request.remote_addr, phone_number)
+        return rate_limited_response(retry_after)
+
     try:
-        otp_code = ''.join(random.choices(string.digits, k=4))
-        print
-        melipayamak_api = Api(MELIPAYAMAK_USERNAME, MELIPAYAMAK_PASSWORD)
-        sms_rest = melipayamak_api.sms()
-        
-        response = sms_rest.send_by_base_number(otp_code, phone_number, MELIPAYAMAK_TEMPLATE)
-        
-        logger.debug(f"Melipayamak response for {phone_number}: {response}")
-        
-        
-        if response['StrRetStatus'] == 'Ok':  
-            expiry_time = datetime.utcnow() + timedelta(minutes=20)
-            session['otp_data'] = {'otp': otp_code, 'expiry': expiry_time.isoformat(), 'phone': phone_number}
-            logger.info(f"OTP sent to {phone_number}, expires at {expiry_time}")
-            return jsonify({'message': 'کد یکبار مصرف ارسال شد'}), 200
-        else:
-            logger.error(f"Melipayamak failed to send OTP to {phone_number}: {response}")
-            return jsonify({'error': 'امکان ارسال کد یکبار مصرف وجود ندارد. لطفا دقایقی دیگر تلاش کنید.'}), 500
+        otp_code, retry_after = otp_store.issue(phone_number)
+        if otp_code is None:
+            logger.warning("OTP request for %s rate limited, retry after %ss", phone_number, retry_after)
+            return rate_limited_response(retry_after)
+
+        # The SMS goes out from the dispatcher's worker pool; don't hold the response for the provider
+        if not sms_dispatcher.submit(phone_number, otp_code):
+            return jsonify({'error': 'امکان ارسال کد یکبار مصرف وجود ندارد. لطفا دقایقی دیگر تلاش کنید.'}), 503
+        logger.info("OTP queued for %s, expires in %ss", phone_number, otp.OTP_TTL_SECONDS)
+        return jsonify({'message': 'کد یکبار مصرف ارسال شد'}), 200
 
     except Exception as e:
-        logger.error(f"Unexpected error during OTP request for {phone_number}: {e}", exc_info=True)
+        db.session.rollback()
+        logger.error("Unexpected error during OTP request for %s: %s", phone_number, e, exc_info=True)
         return jsonify({'error': 'خطای سیستمی رخ داد'}), 500
 
 
-@app.route('/api/auth/verify-otp', methods=['POST'])
+@bp.route('/api/auth/verify-otp', methods=['POST'])
 def verify_otp():
     data = request.json
     phone_number = data.get('phone_number')
@@ -245,43 +812,47 @@ def verify_otp():
     if not otp_code:
         return jsonify({'error': 'شماره تلفن و کد تایید الزامی است'}), 400
 
-    otp_data = session.get('otp_data')
-
-    if not otp_data or otp_data.get('phone') != phone_number:
-        logger.warning(f"OTP verify attempt for {phone_number} but no/mismatched OTP data in session.")
+    if not validate_phone_number(phone_number):
         return jsonify({'error': 'کد تایید نامعتبر است یا درخواست منقضی شده'}), 400
 
     try:
-        expiry_time = datetime.fromisoformat(otp_data['expiry'])
-        if datetime.utcnow() > expiry_time:
-            session.pop('otp_data', None) # Clean up expired OTP data
-            logger.info(f"OTP expired for {phone_number}")
-            return jsonify({'error': 'کد تایید منقضی شده است'}), 400
-    except (ValueError, TypeError):
-        logger.error(f"Invalid expiry format in session for {phone_number}. Data: {otp_data.get('expiry')}")
-        session.pop('otp_data', None)
+        with metrics.phase('otp_check'):
+            outcome = otp_store.verify(phone_number, otp_code)
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Error checking OTP for %s: %s", phone_number, e, exc_info=True)
         return jsonify({'error': 'خطای داخلی - اطلاعات کد نامعتبر'}), 500
 
-    is_otp_match = (otp_data['otp'] == str(otp_code) or str(otp_code) == '4041')
+    if outcome == otp.MISSING:
+        logger.warning("OTP verify attempt for %s but no pending OTP.", phone_number)
+        return jsonify({'error': 'کد تایید نامعتبر است یا درخواست منقضی شده'}), 400
+    if outcome == otp.EXPIRED:
+        logger.info("OTP expired for %s", phone_number)
+        return jsonify({'error': 'کد تایید منقضی شده است'}), 400
+    if outcome == otp.LOCKED:
+        logger.warning("OTP for %s locked after %s failed attempts", phone_number, otp.OTP_MAX_ATTEMPTS)
+        return jsonify({'error': 'تعداد تلاش‌های ناموفق بیش از حد مجاز است. لطفا کد جدید درخواست کنید.'}), 429
+
+    is_otp_match = outcome == otp.VERIFIED
 
     if is_otp_match:
-        logger.info(f"OTP verified successfully for {phone_number}")
-        session.pop('otp_data', None)
+        logger.info("OTP verified successfully for %s", phone_number)
 
         try:
             # --- Database Operations ---
-            user = User.query.filter_by(phone_number=phone_number).first()
+            with metrics.phase('user_lookup'):
+                user = User.query.filter_by(phone_number=phone_number).first()
             now = datetime.utcnow()
             is_new_user = False
 
             if user:
                 # User Exists: Update last login
                 user.last_login_at = now
-                logger.info(f"User exists. Updating last_login_at for {phone_number} (ID: {user.id})")
+                logger.info("User exists. Updating last_login_at for %s (ID: %s)", phone_number, user.id)
             else:
                 # User Doesn't Exist: Create new user
                 is_new_user = True
-                logger.info(f"User does not exist. Creating new user for {phone_number}")
+                logger.info("User does not exist. Creating new user for %s", phone_number)
                 user = User(
                     phone_number=phone_number,
                     created_at=now,         # Explicitly set (good practice)
@@ -294,21 +865,22 @@ def verify_otp():
                 # We removed db.session.flush() - ID will be available after commit
 
             # Log state just before commit
-            logger.debug(f"Attempting commit. User Phone: {user.phone_number}, New User: {is_new_user}")
+            logger.debug("Attempting commit. User Phone: %s, New User: %s", user.phone_number, is_new_user)
 
             # Commit changes (INSERT new user or UPDATE existing user)
-            db.session.commit()
+            with metrics.phase('user_commit'):
+                db.session.commit()
             # --- Commit Successful ---
-            logger.info(f"Database commit successful for user {phone_number}. User ID: {user.id}") # ID is now available
+            logger.info("Database commit successful for user %s. User ID: %s", phone_number, user.id) # ID is now available
 
             # --- Set Flask Session AFTER Successful Commit ---
             session['user_id'] = user.id
             session['phone_number'] = user.phone_number
             session.permanent = True
             # Ensure lifetime is configured if session.permanent is True
-            if not app.permanent_session_lifetime:
-                 app.permanent_session_lifetime = timedelta(days=30)
-            logger.info(f"Flask session set for user ID: {user.id}")
+            if not current_app.permanent_session_lifetime:
+                 current_app.permanent_session_lifetime = timedelta(days=30)
+            logger.info("Flask session set for user ID: %s", user.id)
             # ------------------------------------------------
 
             # Return success response
@@ -321,7 +893,7 @@ def verify_otp():
         except IntegrityError as ie:
             # Catch specific constraint violations (like UNIQUE phone number)
             db.session.rollback()
-            logger.error(f"Database IntegrityError during OTP verification commit for {phone_number}: {ie}", exc_info=True)
+            logger.error("Database IntegrityError during OTP verification commit for %s: %s", phone_number, ie, exc_info=True)
             # Check if it's a unique constraint violation
             error_info = str(ie.orig) if hasattr(ie, 'orig') else str(ie)
             if 'users_phone_number_key' in error_info or 'unique constraint' in error_info.lower():
@@ -333,24 +905,24 @@ def verify_otp():
         except Exception as e:
             # Catch any other database or unexpected errors during commit/session set
             db.session.rollback()
-            logger.error(f"Unexpected error during OTP verification commit/session set for {phone_number}: {e}", exc_info=True)
+            logger.error("Unexpected error during OTP verification commit/session set for %s: %s", phone_number, e, exc_info=True)
             # Using Farsi for user-facing errors
             return jsonify({'error': 'خطای پایگاه داده هنگام تایید هویت'}), 500 # Internal Server Error
 
     else:
         # --- OTP Incorrect ---
-        logger.warning(f"Incorrect OTP attempt for {phone_number}. Expected: {otp_data.get('otp')}, Got: {otp_code}")
+        logger.warning("Incorrect OTP attempt for %s.", phone_number)
         # Using Farsi for user-facing errors
         return jsonify({'error': 'کد تایید وارد شده نادرست است'}), 400
 
-@app.route('/api/auth/logout', methods=['POST'])
+@bp.route('/api/auth/logout', methods=['POST'])
 def logout():
     phone = session.get('phone_number', 'Unknown User')
     session.clear() # Clear all session data
-    logger.info(f"User {phone} logged out")
+    logger.info("User %s logged out", phone)
     return jsonify({'message': 'خروج موفقیت آمیز بود'}), 200
 
-@app.route('/api/auth/status', methods=['GET'])
+@bp.route('/api/auth/status', methods=['GET'])
 def auth_status():
     user = get_current_user()
     if user:
@@ -359,7 +931,7 @@ def auth_status():
         return jsonify({'logged_in': False})
 
 # --- User Profile Endpoint ---
-@app.route('/api/user/profile', methods=['PUT'])
+@bp.route('/api/user/profile', methods=['PUT'])
 def update_profile():
     user = get_current_user()
     if not user:
@@ -379,7 +951,7 @@ def update_profile():
 
         if updated:
             db.session.commit()
-            logger.info(f"User profile updated for user ID: {user.id}")
+            logger.info("User profile updated for user ID: %s", user.id)
             return jsonify({'message': 'پروفایل با موفقیت به‌روز شد', 'user': user.to_dict()}), 200
         else:
             # Return current profile if nothing was updated
@@ -387,22 +959,54 @@ def update_profile():
 
     except Exception as e:
         db.session.rollback()
-        logger.error(f"Error updating profile for user ID {user.id}: {e}", exc_info=True)
+        logger.error("Error updating profile for user ID %s: %s", user.id, e, exc_info=True)
         return jsonify({'error': 'خطا در به‌روزرسانی پروفایل'}), 500
 
 
 # --- Wallet and Session Endpoints ---
 
-@app.route('/api/wallet/balance', methods=['GET'])
+@bp.route('/api/wallet/balance', methods=['GET'])
 def get_wallet_balance():
-    user = get_current_user()
+    user = get_current_identity()
     if not user:
         return jsonify({'error': 'User not authenticated'}), 401
     return jsonify({'balance': user.wallet_balance or 0})
 
-@app.route('/api/chat/check-access', methods=['GET'])
+WALLET_STATEMENT_MAX_PAGE = 100
+
+@bp.route('/api/wallet/statement', methods=['GET'])
+def get_wallet_statement():
+    """Newest-first ledger entries. Pass the returned `next_before` as `before` for the next page."""
+    user = get_current_identity()
+    if not user:
+        return jsonify({'error': 'User not authenticated'}), 401
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), WALLET_STATEMENT_MAX_PAGE)
+        before = request.args.get('before')
+        before = int(before) if before else None
+    except ValueError:
+        return jsonify({'error': 'پارامترهای صفحه‌بندی نامعتبر است'}), 400
+
+    entries = accounts.statement(user.id, limit=limit, before_id=before)
+    return jsonify({
+        'balance': user.wallet_balance or 0,
+        'available_minutes': user.available_session_minutes or 0,
+        'entries': [{
+            'id': entry.id,
+            'created_at': entry.created_at.isoformat(),
+            'kind': entry.kind,
+            'amount': entry.amount,
+            'minutes': entry.minutes,
+            'balance_after': entry.balance_after,
+            'minutes_after': entry.minutes_after,
+            'reference': entry.reference,
+        } for entry in entries],
+        'next_before': entries[-1].id if len(entries) == limit else None,
+    })
+
+@bp.route('/api/chat/check-access', methods=['GET'])
 def check_chat_access():
-    user = get_current_user()
+    user = get_current_identity()
     if not user: return jsonify({'error': 'User not authenticated'}), 401
 
     now = datetime.utcnow()
@@ -446,7 +1050,7 @@ def check_chat_access():
     return jsonify(response_data)
 
 # This endpoint might be called by the frontend timer when the free 20 mins expire
-@app.route('/api/chat/end-free-session', methods=['POST'])
+@bp.route('/api/chat/end-free-session', methods=['POST'])
 def end_free_session():
     user = get_current_user()
     if not user:
@@ -456,62 +1060,50 @@ def end_free_session():
     if not user.free_chat_used:
         user.free_chat_used = True
         db.session.commit()
-        logger.info(f"Free chat marked as used for user {user.id} via explicit end call")
+        logger.info("Free chat marked as used for user %s via explicit end call", user.id)
         return jsonify({'message': 'جلسه چت رایگان پایان یافت.'})
     else:
         return jsonify({'message': 'چت رایگان قبلاً استفاده شده است.'})
     
-@app.route('/api/chat/purchase-session', methods=['POST'])
+@bp.route('/api/chat/purchase-session', methods=['POST'])
 def purchase_session():
     user = get_current_user()
     if not user: return jsonify({'error': 'User not authenticated'}), 401
 
+    user_id = user.id
     try:
         session_price = SESSION_PRICE
         session_minutes_to_add = 20 # Standard session duration
 
-        if (user.wallet_balance or 0) >= session_price:
-            user.wallet_balance -= session_price
-            # --- CHANGE: Add minutes instead of calculating end_time ---
-            user.available_session_minutes = (user.available_session_minutes or 0) + session_minutes_to_add
-            # --- END CHANGE ---
-
-            now = datetime.utcnow()
+        # Debit and credit in one guarded UPDATE, so concurrent clicks can't overdraw the wallet
+        balance = accounts.buy_minutes(user_id, session_price, session_minutes_to_add)
+        if balance is None:
+            db.session.rollback()
+            return jsonify({'error': 'موجودی کیف پول کافی نیست'}), 400
 
-            # --- MARK FREE CHAT USED ON FIRST PURCHASE ---
-            if not user.free_chat_used:
-                user.free_chat_used = True
-                logger.info(f"Marking free chat used on first purchase for user {user.id}")
-            # --- END MARK ---
-
-            # Log the purchase
-            new_purchase = Purchase(
-                user_id=user.id, amount_paid=session_price, sessions_purchased=1, # Logged 1 session
-                purchase_time=now
-                # Add payment_method='wallet' if desired
-            )
-            db.session.add(new_purchase)
-            db.session.commit()
-            logger.info(f"Session minutes purchased from wallet for user {user.id}. Added: {session_minutes_to_add} mins. New available: {user.available_session_minutes}. New balance: {user.wallet_balance}")
+        # Log the purchase
+        new_purchase = Purchase(
+            user_id=user_id, amount_paid=session_price, sessions_purchased=1, # Logged 1 session
+            purchase_time=datetime.utcnow()
+            # Add payment_method='wallet' if desired
+        )
+        db.session.add(new_purchase)
+        db.session.commit()
+        logger.info("Session minutes purchased from wallet for user %s. Added: %s mins. New available: %s. New balance: %s", user_id, session_minutes_to_add, balance.available_session_minutes, balance.wallet_balance)
 
-            # --- CHANGE: Response reflects available minutes, not active time ---
-            return jsonify({
-                'message': 'جلسه با موفقیت از کیف پول خریداری و به حساب شما اضافه شد.',
-                'balance': user.wallet_balance,
-                'available_minutes': user.available_session_minutes
-                # 'remaining_time' is no longer relevant here unless a session was already active
-            })
-            # --- END CHANGE ---
-        else:
-            return jsonify({'error': 'موجودی کیف پول کافی نیست'}), 400
+        return jsonify({
+            'message': 'جلسه با موفقیت از کیف پول خریداری و به حساب شما اضافه شد.',
+            'balance': balance.wallet_balance,
+            'available_minutes': balance.available_session_minutes
+        })
     except Exception as e:
         db.session.rollback()
-        logger.error(f"Error purchasing session from wallet for user {user.id}: {str(e)}", exc_info=True)
+        logger.error("Error purchasing session from wallet for user %s: %s", user_id, str(e), exc_info=True)
         return jsonify({'error': 'خطا در پردازش خرید جلسه'}), 500
     
 # --- Chat Session Management ---
 
-@app.route('/api/chat/sessions', methods=['GET'])
+@bp.route('/api/chat/sessions', methods=['GET'])
 def get_chat_sessions():
     user = get_current_user()
     if not user:
@@ -527,46 +1119,250 @@ def get_chat_sessions():
          logger.error("Chatbot URL or Token not configured.")
          return jsonify({'error': 'Chat service connection not configured'}), 500
 
-    try:
-        params = {
-            'page': page,
-            'size': size,
-            'userId': user.phone_number, # Use phone number as the unique ID for MetisAI user filter
-            'botId': BOT_ID
-        }
+    params = {
+        'page': page,
+        'size': size,
+        'userId': user.phone_number, # Use phone number as the unique ID for MetisAI user filter
+        'botId': BOT_ID
+    }
+    user_id = user.id
+    phone_number = user.phone_number
+    page_key = (page, size)
+    if_none_match = request.headers.get('If-None-Match')
 
-        response = requests.get(
-            f"{CHATBOT_URL}/chat/session",
-            headers=CHATBOT_HEADERS,
-            params=params,
-            timeout=20
-        )
-        response.raise_for_status() # Raise HTTP errors
+    cached = get_cached_chat_list(phone_number, page_key)
+    if cached:
+        return cached_json_response(cached, if_none_match)
+    started_at = time.monotonic()
 
+    def finish(response):
+        response.raise_for_status() # Raise HTTP errors
         # Assuming response.json() returns a list of sessions
         sessions_data = response.json()
+        stored_titles, _ = load_chat_titles(phone_number, [s['id'] for s in sessions_data if s.get('id')])
+        entry = make_cache_entry(add_display_titles(sessions_data, stored_titles))
+        if response.status_code == 200:
+            store_chat_list(phone_number, page_key, entry, started_at)
+        if 200 <= response.status_code < 300:
+            return cached_json_response(entry, if_none_match) # Keeps its 304 when the client's copy is current
+        return cached_json_response(entry), response.status_code
+
+    def fail(e):
+        if isinstance(e, requests.exceptions.Timeout):
+            logger.error("Timeout fetching chat sessions for user %s", user_id)
+            return jsonify({'error': 'Failed to retrieve chat sessions (Timeout)'}), 504
+        if isinstance(e, requests.exceptions.RequestException):
+            logger.error("Error from Metis AI getting sessions for user %s: %s", user_id, e, exc_info=True)
+            status = e.response.status_code if e.response is not None else 503
+            return jsonify({'error': f'Failed to retrieve chat sessions (Code: {status})'}), status
+        logger.error("Unexpected error retrieving chat sessions for user %s: %s", user_id, str(e), exc_info=True)
+        return jsonify({'error': 'Failed to retrieve chat sessions'}), 500
+
+    return call_upstream('GET', f"{CHATBOT_URL}/chat/session", finish, fail,
+                         headers=CHATBOT_HEADERS, params=params, timeout=20)
+
+# Shared pool that bounds how many transcript fetches the summary endpoint runs against MetisAI at once
+CHAT_SUMMARY_WORKERS = int(os.getenv('CHAT_SUMMARY_WORKERS', 8))
+CHAT_SUMMARY_PREVIEW_COUNT = 5
+CHAT_SUMMARY_PREVIEW_CHARS = 150
+chat_summary_executor = ThreadPoolExecutor(max_workers=CHAT_SUMMARY_WORKERS, thread_name_prefix='chat-summary')
+
+def normalize_chat_detail(session_id, session_data):
+    """Shapes a MetisAI session payload the way the frontend expects it."""
+    # Extract messages, handle different possible keys ('messages' or 'history')
+    messages = session_data.get('messages', session_data.get('history', []))
+    return {
+        'id': session_id,
+        'messages': messages,
+        'title': session_data.get('title', 'گفتگوی جدید') # Get title from Metis if available
+        # Add any other relevant session metadata
+    }
+
+def load_local_chat_detail(session_id):
+    """Serves a transcript from the local mirror; None when only MetisAI has the full history."""
+    local = transcript_store.load(session_id)
+    if local is None:
+        return None
+    title, messages = local
+    return normalize_chat_detail(session_id, {'messages': messages, 'title': title or 'گفتگوی جدید'})
+
+def backfill_transcript(session_id, session_data, fetched_at):
+    """Copies a transcript fetched from MetisAI (requested at `fetched_at`, UTC) into the local mirror."""
+    phone_number = (session_data.get('user') or {}).get('id')
+    if not phone_number:
+        return # Can't attribute the session to a user; keep reading it from MetisAI
+    messages = session_data.get('messages', session_data.get('history', []))
+    transcript_store.replace(session_id, phone_number, session_data.get('title'), messages, fetched_at)
+
+def fetch_chat_detail(session_id):
+    """Returns a session's normalized transcript, from the detail cache when possible."""
+    cached = chat_detail_cache.get(session_id)
+    if cached:
+        return json.loads(cached[0])
+    started_at = time.monotonic()
+    detail = load_local_chat_detail(session_id)
+    if detail is None:
+        fetched_at = datetime.utcnow()
+        response = upstream.request('GET', f"{CHATBOT_URL}/chat/session/{session_id}", headers=CHATBOT_HEADERS, timeout=20)
+        response.raise_for_status()
+        session_data = response.json()
+        detail = normalize_chat_detail(session_id, session_data)
+        backfill_transcript(session_id, session_data, fetched_at)
+    store_chat_detail(session_id, make_cache_entry(detail), started_at)
+    return detail
+
+def is_meaningful_title(title):
+    return bool(title) and len(title) > 1 and title != 'گفتگوی جدید' and 'کاربر:' not in title
+
+# --- Chat Titles ---
+# Titles are generated once per chat by a background worker (titles.py) and stored in chat_titles.
+# The list endpoints serve stored titles and queue any chat that does not have one yet.
+TITLE_PROMPT = "با توجه به متن گفتگوی زیر، یک عنوان کوتاه و مناسب (حداکثر ۵ کلمه) پیشنهاد بده. فقط خود عنوان را بنویس:\n\n"
+TITLE_MAX_LENGTH = 40
+
+def clean_generated_title(raw):
+    """Normalizes the bot's answer to the title prompt; returns None if it is not usable."""
+    title = (raw or '').strip()
+    title = re.sub(r'^عنوان:\s*', '', title, flags=re.IGNORECASE)
+    title = re.sub(r'["\'*]', '', title).strip()
+    if len(title) > TITLE_MAX_LENGTH:
+        title = title[:TITLE_MAX_LENGTH - 3] + '...'
+    if len(title) < 3 or 'کاربر:' in title:
+        return None
+    return title
+
+def generate_chat_title(session_id, phone_number):
+    """Title worker callback: keeps a meaningful MetisAI title, otherwise asks the bot for one."""
+    detail = fetch_chat_detail(session_id)
+    if is_meaningful_title(detail.get('title')):
+        return titles.DONE, detail['title'][:TITLE_MAX_LENGTH]
+    if not detail['messages']:
+        return titles.EMPTY, None
+
+    # Same prompt the frontend used to send; ChatPage filters it out of the visible transcript
+    response = upstream.request('POST', f"{CHATBOT_URL}/chat/session/{session_id}/message", headers=CHATBOT_HEADERS,
+                                json={"message": {"content": TITLE_PROMPT, "type": "USER"}}, timeout=CHATBOT_MESSAGE_TIMEOUT)
+    invalidate_chat_caches(phone_number, session_id)
+    response.raise_for_status()
+    reply = response.json().get('content')
+    transcript_store.append(session_id, phone_number, [{'type': 'USER', 'content': TITLE_PROMPT}, {'type': 'AI', 'content': reply}])
+    title = clean_generated_title(reply)
+    if not title:
+        logger.warning("Unusable title generated for session %s", session_id)
+        return titles.FAILED, None
+    return titles.DONE, title
+
+title_worker = titles.TitleWorker(db, ChatTitle, generate_chat_title,
+                                  on_stored=lambda session_id, phone_number: invalidate_chat_caches(phone_number))
+
+def load_chat_titles(phone_number, session_ids):
+    """Returns ({session_id: title} for stored titles, set of session IDs queued for generation)."""
+    if not session_ids:
+        return {}, set()
+    rows = db.session.query(ChatTitle.session_id, ChatTitle.title, ChatTitle.status, ChatTitle.attempts) \
+        .filter(ChatTitle.session_id.in_(session_ids)).all()
+    stored = {row.session_id: row.title for row in rows if row.status == titles.DONE}
+    given_up = {row.session_id for row in rows if row.status == titles.FAILED and row.attempts >= titles.TITLE_MAX_ATTEMPTS}
+    pending = set()
+    for session_id in session_ids:
+        if session_id not in stored and session_id not in given_up:
+            title_worker.enqueue(session_id, phone_number)
+            pending.add(session_id)
+    return stored, pending
+
+def add_display_titles(sessions_data, stored_titles):
+    """Sets 'display_title' on MetisAI list entries that have a stored title; this is the cached list shape."""
+    for session_info in sessions_data:
+        if session_info.get('id') in stored_titles:
+            session_info['display_title'] = stored_titles[session_info['id']]
+    return sessions_data
+
+def summarize_chat(chat, detail, stored_title=None, title_pending=False):
+    """Builds the sidebar summary for one session from its list entry, transcript and stored title."""
+    messages = detail['messages'] if detail else []
+    timestamps = [m.get('timestamp') for m in messages if m.get('timestamp')]
+    title = stored_title
+    if not title and detail and is_meaningful_title(detail.get('title')):
+        title = detail['title']
+    return {
+        'id': chat['id'],
+        'title': title,
+        'titlePending': not title and title_pending and bool(messages),
+        'lastMessageTime': max(timestamps) if timestamps else (chat.get('lastActivityDate') or chat.get('startDate')),
+        'messageCount': len(messages),
+        'messages': [
+            {'type': m.get('type'), 'content': (m.get('content') or '')[:CHAT_SUMMARY_PREVIEW_CHARS], 'timestamp': m.get('timestamp')}
+            for m in messages[:CHAT_SUMMARY_PREVIEW_COUNT]
+        ],
+        'detailsUnavailable': detail is None,
+    }
 
-        # Optional: Enhance data if needed, e.g., get stored titles
-        # enhanced_sessions = []
-        # for session_info in sessions_data:
-        #     stored_title = get_stored_title(session_info.get('id')) # Implement this if storing titles locally
-        #     session_info['display_title'] = stored_title or session_info.get('title', 'گفتگوی جدید')
-        #     enhanced_sessions.append(session_info)
+@bp.route('/api/chat/sessions/summary', methods=['GET'])
+def get_chat_sessions_summary():
+    """One-shot sidebar data: a page of sessions with title, last message time and previews."""
+    user = get_current_user()
+    if not user:
+        return jsonify({'error': 'User not authenticated'}), 401
+
+    page = request.args.get('page', '0')
+    size = request.args.get('size', '10')
 
-        return jsonify(sessions_data), response.status_code
+    if not BOT_ID:
+        logger.error("BOT_ID not configured.")
+        return jsonify({'error': 'Chat service not configured correctly'}), 500
+    if not CHATBOT_URL or not CHATBOT_HEADERS.get('Authorization'):
+        logger.error("Chatbot URL or Token not configured.")
+        return jsonify({'error': 'Chat service connection not configured'}), 500
 
+    user_id = user.id
+    phone_number = user.phone_number
+    page_key = (page, size)
+    started_at = None # Set when the list comes from MetisAI and still has to be cached
+    try:
+        cached = get_cached_chat_list(phone_number, page_key)
+        if cached:
+            sessions_data = json.loads(cached[0])
+        else:
+            started_at = time.monotonic()
+            response = upstream.request('GET', f"{CHATBOT_URL}/chat/session", headers=CHATBOT_HEADERS, timeout=20, params={
+                'page': page,
+                'size': size,
+                'userId': phone_number,
+                'botId': BOT_ID
+            })
+            response.raise_for_status()
+            sessions_data = response.json()
     except requests.exceptions.Timeout:
-         logger.error(f"Timeout fetching chat sessions for user {user.id}")
-         return jsonify({'error': 'Failed to retrieve chat sessions (Timeout)'}), 504
+        logger.error("Timeout fetching chat sessions for summary (User: %s)", user_id)
+        return jsonify({'error': 'Failed to retrieve chat sessions (Timeout)'}), 504
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error from Metis AI getting sessions for user {user.id}: {e}", exc_info=True)
+        logger.error("Error from Metis AI getting sessions for summary (User: %s): %s", user_id, e, exc_info=True)
         status = e.response.status_code if e.response is not None else 503
         return jsonify({'error': f'Failed to retrieve chat sessions (Code: {status})'}), status
-    except Exception as e:
-        logger.error(f"Unexpected error retrieving chat sessions for user {user.id}: {str(e)}", exc_info=True)
-        return jsonify({'error': 'Failed to retrieve chat sessions'}), 500
 
-@app.route('/api/chat/sessions/<session_id>', methods=['GET'])
+    app = current_app._get_current_object()
+
+    def fetch_or_none(chat):
+        try:
+            with app.app_context(): # Pool threads don't inherit the request's context; the local mirror needs one
+                return fetch_chat_detail(chat['id'])
+        except Exception as e:
+            logger.warning("Could not fetch details for session %s in summary (User: %s): %s", chat['id'], user_id, e)
+            return None
+
+    chats = [chat for chat in sessions_data if chat.get('id')]
+    details = chat_summary_executor.map(fetch_or_none, chats)
+    stored_titles, pending_titles = load_chat_titles(phone_number, [chat['id'] for chat in chats])
+    if started_at is not None:
+        # Same shape get_chat_sessions caches, since both read this entry
+        store_chat_list(phone_number, page_key, make_cache_entry(add_display_titles(sessions_data, stored_titles)), started_at)
+    summaries = [
+        summarize_chat(chat, detail, stored_titles.get(chat['id']), chat['id'] in pending_titles)
+        for chat, detail in zip(chats, details)
+    ]
+    return cached_json_response(make_cache_entry(summaries), request.headers.get('If-None-Match'))
+
+@bp.route('/api/chat/sessions/<session_id>', methods=['GET'])
 def get_chat_session_details(session_id):
     # No direct user auth check here, relies on session_id being valid/accessible via API key
     # However, could add check: ensure this session_id *belongs* to the logged-in user if MetisAI API allows fetching by user+session ID.
@@ -578,46 +1374,49 @@ def get_chat_session_details(session_id):
          logger.error("Chatbot URL or Token not configured.")
          return jsonify({'error': 'Chat service connection not configured'}), 500
 
-    try:
-        response = requests.get(
-            f"{CHATBOT_URL}/chat/session/{session_id}",
-            headers=CHATBOT_HEADERS,
-            timeout=20
-        )
-        response.raise_for_status()
-
-        session_data = response.json()
+    if_none_match = request.headers.get('If-None-Match')
+    cached = chat_detail_cache.get(session_id)
+    if cached:
+        return cached_json_response(cached, if_none_match)
+    started_at = time.monotonic()
+    fetched_at = datetime.utcnow() # Wall clock, comparable with the mirror's updated_at across nodes
 
-        # Extract messages, handle different possible keys ('messages' or 'history')
-        messages = session_data.get('messages', session_data.get('history', []))
+    local_detail = load_local_chat_detail(session_id)
+    if local_detail is not None:
+        entry = make_cache_entry(local_detail)
+        store_chat_detail(session_id, entry, started_at)
+        return cached_json_response(entry, if_none_match)
 
-        # Prepare response structure consistent with frontend expectations
-        return jsonify({
-            'id': session_id,
-            'messages': messages,
-            'title': session_data.get('title', 'گفتگوی جدید') # Get title from Metis if available
-            # Add any other relevant session metadata
-        })
+    def finish(response):
+        response.raise_for_status()
 
-    except requests.exceptions.Timeout:
-         logger.error(f"Timeout fetching details for session {session_id} (User: {user_id_log})")
-         return jsonify({'error': f'Failed to retrieve chat session {session_id} (Timeout)'}), 504
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Failed to retrieve session {session_id} (User: {user_id_log}): {e}", exc_info=True)
-        status = e.response.status_code if e.response is not None else 503
-        # Distinguish between Not Found and other errors
-        if status == 404:
-            return jsonify({'error': 'Chat session not found'}), 404
-        else:
+        session_data = response.json()
+        entry = make_cache_entry(normalize_chat_detail(session_id, session_data))
+        store_chat_detail(session_id, entry, started_at)
+        backfill_transcript(session_id, session_data, fetched_at)
+        return cached_json_response(entry, if_none_match)
+
+    def fail(e):
+        if isinstance(e, requests.exceptions.Timeout):
+            logger.error("Timeout fetching details for session %s (User: %s)", session_id, user_id_log)
+            return jsonify({'error': f'Failed to retrieve chat session {session_id} (Timeout)'}), 504
+        if isinstance(e, requests.exceptions.RequestException):
+            logger.error("Failed to retrieve session %s (User: %s): %s", session_id, user_id_log, e, exc_info=True)
+            status = e.response.status_code if e.response is not None else 503
+            # Distinguish between Not Found and other errors
+            if status == 404:
+                return jsonify({'error': 'Chat session not found'}), 404
             return jsonify({'error': f'Failed to retrieve chat session (Code: {status})'}), status
-    except Exception as e:
-        logger.error(f"Unexpected error retrieving chat session {session_id} (User: {user_id_log}): {str(e)}", exc_info=True)
+        logger.error("Unexpected error retrieving chat session %s (User: %s): %s", session_id, user_id_log, str(e), exc_info=True)
         return jsonify({'error': 'Failed to retrieve chat session'}), 500
 
+    return call_upstream('GET', f"{CHATBOT_URL}/chat/session/{session_id}", finish, fail,
+                         headers=CHATBOT_HEADERS, timeout=20)
+
 # Endpoint to explicitly start a session (mainly for free chat or tracking)
 # Endpoint to explicitly start a session (consumes free time or purchased minutes)
 # Endpoint to explicitly start a session (consumes free time or purchased minutes)
-@app.route('/api/chat/start-session', methods=['POST'])
+@bp.route('/api/chat/start-session', methods=['POST'])
 def start_session():
     user = get_current_user()
     if not user: return jsonify({'error': 'User not authenticated'}), 401
@@ -627,7 +1426,32 @@ def start_session():
     free_session_duration_minutes = 20
     activation_buffer_seconds = 20
 
+    user_id = user.id
     try:
+        # Each branch is one guarded UPDATE that also requires no active session, so a double
+        # click can't consume minutes twice; whichever request loses sees the active session below
+        if not (user.session_end_time and user.session_end_time > now):
+            paid_seconds = (session_duration_minutes * 60) + activation_buffer_seconds
+            if accounts.start_paid_session(user_id, session_duration_minutes, now + timedelta(seconds=paid_seconds), now):
+                db.session.commit()
+                logger.info("Started a %s min (+%ss buffer) paid session for user %s.", session_duration_minutes, activation_buffer_seconds, user_id)
+                return jsonify({
+                    'message': f'جلسه {session_duration_minutes} دقیقه‌ای شما شروع شد.',
+                    'remaining_time': paid_seconds,
+                    'is_free_chat': False,
+                })
+
+            free_seconds = (free_session_duration_minutes * 60) + activation_buffer_seconds
+            if accounts.start_free_session(user_id, now + timedelta(seconds=free_seconds), now):
+                db.session.commit()
+                logger.info("Started %s min free chat session for user %s.", free_session_duration_minutes, user_id)
+                return jsonify({
+                    'message': f'چت رایگان {free_session_duration_minutes} دقیقه‌ای شما شروع شد.',
+                    'remaining_time': free_seconds,
+                    'is_free_chat': True,
+                })
+            db.session.rollback() # Expires the user so the check below sees a concurrently started session
+
         if user.session_end_time and user.session_end_time > now:
             remaining = int((user.session_end_time - now).total_seconds())
             return jsonify({
@@ -636,44 +1460,14 @@ def start_session():
                 'session_already_active': True,
             })
 
-        elif (user.available_session_minutes or 0) >= session_duration_minutes:
-            user.available_session_minutes -= session_duration_minutes
-            total_seconds_to_add = (session_duration_minutes * 60) + activation_buffer_seconds
-            user.session_end_time = now + timedelta(seconds=total_seconds_to_add)
-
-            if not user.free_chat_used:
-                user.free_chat_used = True
-                logger.info(f"Marking free chat used as user {user.id} started a paid session.")
-
-            db.session.commit()
-            logger.info(f"Started a {session_duration_minutes} min (+{activation_buffer_seconds}s buffer) paid session for user {user.id}.")
-            return jsonify({
-                'message': f'جلسه {session_duration_minutes} دقیقه‌ای شما شروع شد.',
-                'remaining_time': total_seconds_to_add,
-                'is_free_chat': False,
-            })
-
-        elif not user.free_chat_used:
-            total_seconds_to_add = (free_session_duration_minutes * 60) + activation_buffer_seconds
-            user.session_end_time = now + timedelta(seconds=total_seconds_to_add)
-            user.free_chat_used = True
-            db.session.commit()
-            logger.info(f"Started {free_session_duration_minutes} min free chat session for user {user.id}.")
-            return jsonify({
-                'message': f'چت رایگان {free_session_duration_minutes} دقیقه‌ای شما شروع شد.',
-                'remaining_time': total_seconds_to_add,
-                'is_free_chat': True,
-            })
-
-        else:
-            return jsonify({'error': 'شما دقیقه گفتگو ندارید. لطفا ابتدا یک جلسه خریداری کنید.', 'needs_purchase': True}), 400
+        return jsonify({'error': 'شما دقیقه گفتگو ندارید. لطفا ابتدا یک جلسه خریداری کنید.', 'needs_purchase': True}), 400
 
     except Exception as e:
         db.session.rollback()
-        logger.error(f"Error starting session for user {user.id}: {e}", exc_info=True)
+        logger.error("Error starting session for user %s: %s", user_id, e, exc_info=True)
         return jsonify({'error': 'خطا در شروع جلسه'}), 500
     
-@app.route('/create-session', methods=['POST'])
+@bp.route('/create-session', methods=['POST'])
 def create_metis_session():
     """Creates a new session in the MetisAI platform for the authenticated user."""
     user = get_current_user()
@@ -687,71 +1481,74 @@ def create_metis_session():
          logger.error("Chatbot URL or Token not configured.")
          return jsonify({'error': 'Chat service connection not configured'}), 500
 
-    try:
-        # Use phone number as the unique user ID for MetisAI
-        user_payload = {
-            "id": user.phone_number,
-            "name": user.phone_number # Can add more user info if MetisAI uses it
-        }
+    # Use phone number as the unique user ID for MetisAI
+    user_payload = {
+        "id": user.phone_number,
+        "name": user.phone_number # Can add more user info if MetisAI uses it
+    }
 
-        initial_message = """سلام دوست من! ✨
+    initial_message = """سلام دوست من! ✨
 خوشحالم که اومدی پیشم. من دلیار هستم، دوستی که هر وقت دلت خواست کنارته.
 چی تو دلت هست که دوست داری باهام درمیون بذاری؟ من اینجام که گوش کنم... ♥️"""
 
-        # Allow frontend to potentially override initial message? For now, use fixed one.
-        session_data = {
-            "botId": BOT_ID,
-            "user": user_payload,
-            "initialMessages": [{"type": "AI", "content": initial_message}]
-            # Add "title" here if you want to pre-set it
-        }
-        logger.info(f"Creating session with URL: {CHATBOT_URL}/chat/session, Bot ID: {BOT_ID}, Headers: {CHATBOT_HEADERS}, Data: {session_data}")
-        response = requests.post(
-            f"{CHATBOT_URL}/chat/session",
-            headers=CHATBOT_HEADERS,
-            json=session_data,
-            timeout=20
-        )
+    # Allow frontend to potentially override initial message? For now, use fixed one.
+    session_data = {
+        "botId": BOT_ID,
+        "user": user_payload,
+        "initialMessages": [{"type": "AI", "content": initial_message}]
+        # Add "title" here if you want to pre-set it
+    }
+    logger.debug("Creating session with URL: %s/chat/session, Bot ID: %s, Data: %s", CHATBOT_URL, BOT_ID, logs.payload(session_data))
+    user_id = user.id
+    phone_number = user.phone_number
+
+    def finish(response):
         response.raise_for_status()
 
         session_response = response.json()
         # The response should contain the new session ID, e.g., session_response['id']
         if not session_response.get('id'):
-             logger.error(f"MetisAI created session but did not return an ID for user {user.id}")
-             return jsonify({'error': 'Failed to get session ID from chat service'}), 500
+            logger.error("MetisAI created session but did not return an ID for user %s", user_id)
+            return jsonify({'error': 'Failed to get session ID from chat service'}), 500
 
-        logger.info(f"MetisAI chat session created for user {user.id}, session ID: {session_response['id']}")
+        logger.info("MetisAI chat session created for user %s, session ID: %s", user_id, session_response['id'])
+        transcript_store.create_session(session_response['id'], phone_number,
+                                        [{'type': 'AI', 'content': initial_message, 'timestamp': transcripts.utc_timestamp()}])
+        invalidate_chat_caches(phone_number)
         return jsonify(session_response), response.status_code
 
-    except requests.exceptions.Timeout:
-        logger.error(f"Timeout creating MetisAI session for user {user.id}")
-        return jsonify({'error': 'Failed to create session (Timeout)'}), 504
-    except requests.exceptions.RequestException as e:
-         logger.error(f"Error creating MetisAI session for user {user.id}: {e}", exc_info=True)
-         status = e.response.status_code if e.response is not None else 503
-         return jsonify({'error': f'Failed to create session (Code: {status})'}), status
-    except Exception as e:
-        logger.error(f"Unexpected error creating MetisAI session for user {user.id}: {str(e)}", exc_info=True)
+    def fail(e):
+        if isinstance(e, requests.exceptions.Timeout):
+            logger.error("Timeout creating MetisAI session for user %s", user_id)
+            return jsonify({'error': 'Failed to create session (Timeout)'}), 504
+        if isinstance(e, requests.exceptions.RequestException):
+            logger.error("Error creating MetisAI session for user %s: %s", user_id, e, exc_info=True)
+            status = e.response.status_code if e.response is not None else 503
+            return jsonify({'error': f'Failed to create session (Code: {status})'}), status
+        logger.error("Unexpected error creating MetisAI session for user %s: %s", user_id, str(e), exc_info=True)
         return jsonify({'error': f'Failed to create session: {str(e)}'}), 500
 
-@app.route('/respond', methods=['POST'])
-def respond_to_chat():
-    user = get_current_user()
-    if not user: return jsonify({'error': 'User not authenticated'}), 401
+    return call_upstream('POST', f"{CHATBOT_URL}/chat/session", finish, fail,
+                         headers=CHATBOT_HEADERS, json=session_data, timeout=20)
 
-    data = request.json
+def prepare_chat_message(user, data):
+    """Validates a chat turn and builds the MetisAI message payload.
+
+    Returns (session_id, message_data, None) on success, or (None, None, error_response).
+    """
     session_id = data.get('sessionId')
     content = data.get('content')
     is_first_message = data.get('isFirstMessage', False)
 
-    if not session_id or not content: return jsonify({'error': 'Session ID and content are required'}), 400
+    if not session_id or not content:
+        return None, None, (jsonify({'error': 'Session ID and content are required'}), 400)
 
     # Check session time BEFORE processing
     now = datetime.utcnow()
     if not user.session_end_time or user.session_end_time <= now:
-        return jsonify({'error': 'زمان جلسه شما به پایان رسیده است.', 'session_ended': True, 'needs_purchase': True}), 403
+        return None, None, (jsonify({'error': 'زمان جلسه شما به پایان رسیده است.', 'session_ended': True, 'needs_purchase': True}), 403)
 
-    # Prepare message content with context (unchanged)
+    # Prepare message content with context
     processed_content = content
     if is_first_message:
         context_parts = []
@@ -763,34 +1560,103 @@ def respond_to_chat():
             profile_summary = " ؛ ".join(context_parts)
             context = f"[یادداشت سیستمی برای دلیار: اطلاعات کاربر '{user_identifier}' - {profile_summary}. این اطلاعات را در طول گفتگو به خاطر بسپار و در صورت لزوم به آنها اشاره کن.]\n\nپیام کاربر: {content}"
             processed_content = context
-            logger.debug(f"Added profile context for user {user.id} on first message.")
+            logger.debug("Added profile context for user %s on first message.", user.id)
 
-    # Send message to MetisAI (unchanged)
-    message_url = f"{CHATBOT_URL}/chat/session/{session_id}/message"
     message_data = {"message": {"content": processed_content, "type": "USER"}}
+    return session_id, message_data, None
 
-    try:
-        response = requests.post(message_url, headers=CHATBOT_HEADERS, json=message_data, timeout=90)
+@bp.route('/respond', methods=['POST'])
+def respond_to_chat():
+    with metrics.phase('auth'):
+        user = get_current_user()
+    if not user: return jsonify({'error': 'User not authenticated'}), 401
+
+    with metrics.phase('prepare'):
+        session_id, message_data, error_response = prepare_chat_message(user, request.json)
+    if error_response: return error_response
+
+    message_url = f"{CHATBOT_URL}/chat/session/{session_id}/message"
+    user_id = user.id
+    phone_number = user.phone_number
+    user_message = {**message_data['message'], 'timestamp': transcripts.utc_timestamp()}
+    invalidate_chat_caches(phone_number, session_id)
+
+    def finish(response):
+        invalidate_chat_caches(phone_number, session_id) # Transcript now includes the reply
         response.raise_for_status()
         response_data = response.json()
         if 'content' not in response_data:
-            logger.error(f"MetisAI response for session {session_id} missing 'content'. Response: {response_data}")
+            logger.error("MetisAI response for session %s missing 'content'. Response: %s", session_id, logs.payload(response_data))
             return jsonify({'error': 'پاسخ نامعتبر از سرویس گفتگو'}), 500
+        transcript_store.append(session_id, phone_number, [
+            user_message,
+            {'type': 'AI', 'content': response_data['content'], 'timestamp': response_data.get('timestamp')},
+        ])
         return jsonify(response_data), response.status_code
-    except requests.exceptions.Timeout:
-        logger.error(f"Timeout sending message to MetisAI for session {session_id} (User: {user.id})")
-        return jsonify({'error': 'پاسخ از سرویس گفتگو دریافت نشد (Timeout)'}), 504
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending message to MetisAI for session {session_id} (User: {user.id}): {e}", exc_info=True)
-        status_code = e.response.status_code if e.response is not None else 503
-        return jsonify({'error': f'خطا در ارسال پیام به سرویس گفتگو ({status_code})'}), status_code
-    except Exception as e:
-        logger.error(f"Unexpected error responding to chat for session {session_id} (User: {user.id}): {e}", exc_info=True)
+
+    def fail(e):
+        transcript_store.mark_incomplete(session_id) # MetisAI may still have recorded the turn
+        if isinstance(e, requests.exceptions.Timeout):
+            logger.error("Timeout sending message to MetisAI for session %s (User: %s)", session_id, user_id)
+            return jsonify({'error': 'پاسخ از سرویس گفتگو دریافت نشد (Timeout)'}), 504
+        if isinstance(e, requests.exceptions.RequestException):
+            logger.error("Error sending message to MetisAI for session %s (User: %s): %s", session_id, user_id, e, exc_info=True)
+            status_code = e.response.status_code if e.response is not None else 503
+            return jsonify({'error': f'خطا در ارسال پیام به سرویس گفتگو ({status_code})'}), status_code
+        logger.error("Unexpected error responding to chat for session %s (User: %s): %s", session_id, user_id, e, exc_info=True)
+        return jsonify({'error': 'خطای پیش‌بینی نشده در پردازش پیام'}), 500
+
+    return call_upstream('POST', message_url, finish, fail,
+                         headers=CHATBOT_HEADERS, json=message_data, timeout=CHATBOT_MESSAGE_TIMEOUT)
+
+@bp.route('/respond/stream', methods=['POST'])
+def respond_to_chat_stream():
+    """Same as /respond, but relays MetisAI tokens to the browser as Server-Sent Events.
+
+    Emits `data: {"delta": ...}` frames as text arrives, then a final `done` event carrying
+    the full reply, or an `error` event if the upstream stream breaks midway.
+    """
+    user = get_current_user()
+    if not user: return jsonify({'error': 'User not authenticated'}), 401
+
+    session_id, message_data, error_response = prepare_chat_message(user, request.json)
+    if error_response: return error_response
+
+    message_url = f"{CHATBOT_URL}/chat/session/{session_id}/message/stream"
+    stream_headers = {**CHATBOT_HEADERS, 'Accept': 'text/event-stream'}
+    user_id = user.id
+    phone_number = user.phone_number
+    invalidate_chat_caches(phone_number, session_id)
+
+    def fail(e):
+        if isinstance(e, requests.exceptions.Timeout):
+            logger.error("Timeout opening MetisAI stream for session %s (User: %s)", session_id, user_id)
+            return jsonify({'error': 'پاسخ از سرویس گفتگو دریافت نشد (Timeout)'}), 504
+        if isinstance(e, requests.exceptions.RequestException):
+            logger.error("Error opening MetisAI stream for session %s (User: %s): %s", session_id, user_id, e, exc_info=True)
+            status_code = e.response.status_code if e.response is not None else 503
+            return jsonify({'error': f'خطا در ارسال پیام به سرویس گفتگو ({status_code})'}), status_code
+        logger.error("Unexpected error opening MetisAI stream for session %s (User: %s): %s", session_id, user_id, e, exc_info=True)
         return jsonify({'error': 'خطای پیش‌بینی نشده در پردازش پیام'}), 500
+
+    user_message = {**message_data['message'], 'timestamp': transcripts.utc_timestamp()}
+
+    def on_finish():
+        invalidate_chat_caches(phone_number, session_id)
+        if relay.finished and relay.content:
+            transcript_store.append(session_id, phone_number, [user_message, {'type': 'AI', 'content': relay.content}])
+        else:
+            # The exchange may or may not have been recorded upstream; let the next read re-sync from MetisAI
+            transcript_store.mark_incomplete(session_id)
+
+    relay = ChatStreamRelay(session_id, user_id, on_finish=on_finish)
+    return stream_upstream('POST', message_url, relay, fail,
+                           headers=stream_headers, json=message_data,
+                           timeout=(CHATBOT_STREAM_CONNECT_TIMEOUT, CHATBOT_MESSAGE_TIMEOUT))
     
 # --- Payment Gateway Endpoints ---
 
-@app.route('/api/payment/request', methods=['POST'])
+@bp.route('/api/payment/request', methods=['POST'])
 def payment_request():
     user = get_current_user()
     if not user:
@@ -807,7 +1673,7 @@ def payment_request():
     # Verify amount matches expected price server-side
     expected_amount = session_count * SESSION_PRICE
     if amount != expected_amount:
-         logger.warning(f"Payment request amount mismatch user {user.id}. Expected: {expected_amount}, Got: {amount}")
+         logger.warning("Payment request amount mismatch user %s. Expected: %s, Got: %s", user.id, expected_amount, amount)
          return jsonify({'error': 'مبلغ درخواستی با تعداد جلسات همخوانی ندارد'}), 400
 
     # Handle discount code
@@ -816,41 +1682,44 @@ def payment_request():
     applied_discount_code = None
 
     if discount_code:
-        if discount_code in DISCOUNT_CODES:
-            applied_discount_percentage = DISCOUNT_CODES[discount_code]
+        offer = discount_codes.redeemable(discount_code)
+        if offer:
+            applied_discount_percentage = offer.percent
             discount_multiplier = (100 - applied_discount_percentage) / 100
             payment_amount = int(expected_amount * discount_multiplier)
-            applied_discount_code = discount_code
-            logger.info(f"Applied discount code {applied_discount_code} ({applied_discount_percentage}%) for user {user.id}. Original: {expected_amount}, Payment: {payment_amount}")
+            applied_discount_code = offer.code
+            logger.info("Applied discount code %s (%s%%) for user %s. Original: %s, Payment: %s", applied_discount_code, applied_discount_percentage, user.id, expected_amount, payment_amount)
 
             # Handle 100% discount
             if applied_discount_percentage == 100:
+                user_id = user.id
                 try:
-                    user.wallet_balance = (user.wallet_balance or 0) + expected_amount
+                    balance = accounts.credit_wallet(user_id, expected_amount, kind=accounting.DISCOUNT_CREDIT, reference=applied_discount_code)
                     now = datetime.utcnow()
                     new_purchase = Purchase(
-                        user_id=user.id,
+                        user_id=user_id,
                         purchase_time=now,
                         amount_paid=0,  # No payment made
                         sessions_purchased=0,
-                        payment_ref_id=f"DISC100_{discount_code}_{now.strftime('%Y%m%d%H%M%S')}"  # Unique ref ID
+                        payment_ref_id=f"DISC100_{applied_discount_code}_{now.strftime('%Y%m%d%H%M%S')}"  # Unique ref ID
                     )
                     db.session.add(new_purchase)
                     db.session.commit()
-                    logger.info(f"100% discount applied for user {user.id}. Credited {expected_amount} to wallet. Purchase ID: {new_purchase.id}")
+                    discount_codes.record_use(applied_discount_code, expected_amount)
+                    logger.info("100%% discount applied for user %s. Credited %s to wallet. Purchase ID: %s", user_id, expected_amount, new_purchase.id)
                     return jsonify({
                         'status': 200,
                         'message': 'کد تخفیف 100% اعمال شد و کیف پول شارژ شد',
                         'original_amount': expected_amount,
                         'payment_amount': 0,
-                        'wallet_balance': user.wallet_balance
+                        'wallet_balance': balance.wallet_balance
                     }), 200
                 except Exception as e:
                     db.session.rollback()
-                    logger.error(f"Error applying 100% discount for user {user.id}: {str(e)}", exc_info=True)
+                    logger.error("Error applying 100%% discount for user %s: %s", user_id, str(e), exc_info=True)
                     return jsonify({'error': 'خطا در اعمال کد تخفیف 100%'}), 500
         else:
-            logger.warning(f"Invalid discount code {discount_code} attempted by user {user.id}")
+            logger.warning("Invalid discount code %s attempted by user %s", discount_code, user.id)
             return jsonify({'error': 'کد تخفیف نامعتبر است'}), 400
 
     if not ZARINPAL_MERCHANT_ID:
@@ -858,15 +1727,14 @@ def payment_request():
          return jsonify({'error': 'سرویس پرداخت در دسترس نیست'}), 503
 
     try:
-        client = Client(ZARINPAL_WEBSERVICE)
-        callback_url = url_for('payment_verify', _external=True, _scheme='https' if os.getenv('FLASK_ENV') != 'development' else 'http')
-        logger.info(f"Zarinpal Callback URL: {callback_url}")
+        callback_url = url_for('.payment_verify', _external=True, _scheme='https' if os.getenv('FLASK_ENV') != 'development' else 'http')
+        logger.info("Zarinpal Callback URL: %s", callback_url)
 
         description = f"خرید {session_count} جلسه مشاوره دلیار"
         if applied_discount_code:
             description += f" با کد تخفیف {applied_discount_code}"
 
-        result = client.service.PaymentRequest(
+        result = zarinpal_gateway.payment_request(
             ZARINPAL_MERCHANT_ID,
             payment_amount,
             description,
@@ -886,7 +1754,7 @@ def payment_request():
             )
             db.session.add(pending)
             db.session.commit()
-            logger.info(f"Payment request initiated for user {user.id}, Authority: {result.Authority}, Discount: {applied_discount_percentage}%")
+            logger.info("Payment request initiated for user %s, Authority: %s, Discount: %s%%", user.id, result.Authority, applied_discount_percentage)
             payment_url = f"{ZARINPAL_STARTPAY_URL}{result.Authority}"
             return jsonify({
                 'status': 100,
@@ -896,21 +1764,70 @@ def payment_request():
                 'payment_amount': payment_amount
             })
         else:
-            logger.error(f"Zarinpal PaymentRequest failed user {user.id}. Status: {result.Status}, Message: {result.Message}")
+            logger.error("Zarinpal PaymentRequest failed user %s. Status: %s, Message: %s", user.id, result.Status, result.Message)
             error_message = f'خطا در شروع فرآیند پرداخت (کد: {result.Status})'
             return jsonify({'error': error_message}), 400
 
     except requests.exceptions.RequestException as req_err:
         db.session.rollback()
-        logger.error(f"Suds/HTTP error during Zarinpal request for user {user.id}: {str(req_err)}", exc_info=True)
+        logger.error("Suds/HTTP error during Zarinpal request for user %s: %s", user.id, str(req_err), exc_info=True)
         return jsonify({'error': 'خطا در ارتباط با درگاه پرداخت'}), 503
     except Exception as e:
         db.session.rollback()
-        logger.error(f"Error during payment request for user {user.id}: {str(e)}", exc_info=True)
+        logger.error("Error during payment request for user %s: %s", user.id, str(e), exc_info=True)
         return jsonify({'error': 'خطای سیستمی در هنگام درخواست پرداخت'}), 500
 
 # Update /api/payment/verify endpoint
-@app.route('/api/payment/verify', methods=['GET'])
+def settle_verified_payment(authority, ref_id):
+    """Claims the pending row of a gateway-verified payment and credits its wallet, in one transaction.
+
+    Returns (claimed, balance). `claimed` is None if a concurrent callback or the reconciler
+    already settled it; `balance` is None if the user no longer exists, in which case the
+    payment is moved to orphaned_payments so it is reported once and never retried.
+    """
+    claimed = accounts.claim_pending_payment(authority)
+    if claimed is None:
+        db.session.rollback()
+        return None, None
+
+    # Credit the ORIGINAL amount to the wallet
+    balance = accounts.credit_wallet_by_phone(claimed.phone_number, claimed.original_amount, reference=str(ref_id))
+    if balance is None:
+        db.session.add(OrphanedPayment(
+            authority=authority, ref_id=str(ref_id), phone_number=claimed.phone_number,
+            amount=claimed.amount, original_amount=claimed.original_amount, discount_code=claimed.discount_code,
+        ))
+        db.session.commit()
+        return claimed, None
+
+    # Record the successful top-up
+    new_purchase = Purchase(
+        user_id=balance.user_id,
+        purchase_time=datetime.utcnow(),
+        amount_paid=claimed.amount,  # Record actual paid amount
+        sessions_purchased=0,
+        payment_ref_id=str(ref_id),
+    )
+    db.session.add(new_purchase)
+    db.session.commit()
+    if claimed.discount_code:
+        discount_codes.record_use(claimed.discount_code, claimed.original_amount - claimed.amount)
+    return claimed, balance
+
+def expire_pending_payment(authority):
+    """Drops an unpaid pending row; False if it was already gone."""
+    claimed = accounts.claim_pending_payment(authority)
+    db.session.commit()
+    return claimed is not None
+
+payment_reconciler = reconcile.PaymentReconciler(
+    db, PendingTransaction,
+    verify=lambda authority, amount: zarinpal_gateway.payment_verification(ZARINPAL_MERCHANT_ID, authority, amount),
+    settle=settle_verified_payment,
+    expire=expire_pending_payment,
+)
+
+@bp.route('/api/payment/verify', methods=['GET'])
 def payment_verify():
     authority = request.args.get('Authority')
     status = request.args.get('Status')
@@ -920,18 +1837,19 @@ def payment_verify():
         return redirect(f"{FRONTEND_URL}/start?status=failed&reason=no_authority")
 
     if status != 'OK':
-        logger.info(f"Payment cancelled or failed by user. Status: {status}, Authority: {authority}")
+        logger.info("Payment cancelled or failed by user. Status: %s, Authority: %s", status, authority)
         try:
             PendingTransaction.query.filter_by(authority=authority).delete()
             db.session.commit()
         except Exception as del_err:
             db.session.rollback()
-            logger.error(f"Error deleting pending transaction for cancelled payment {authority}: {del_err}")
+            logger.error("Error deleting pending transaction for cancelled payment %s: %s", authority, del_err)
         return redirect(f"{FRONTEND_URL}/start?status=cancelled")
 
-    pending = PendingTransaction.query.filter_by(authority=authority).first()
+    with metrics.phase('pending_lookup'):
+        pending = PendingTransaction.query.filter_by(authority=authority).first()
     if not pending:
-        logger.warning(f"Payment verification attempt for unknown or already processed Authority: {authority}")
+        logger.warning("Payment verification attempt for unknown or already processed Authority: %s", authority)
         return redirect(f"{FRONTEND_URL}/start?status=already_verified_or_invalid")
 
     if not ZARINPAL_MERCHANT_ID:
@@ -939,53 +1857,36 @@ def payment_verify():
         return redirect(f"{FRONTEND_URL}/start?status=failed&reason=internal_config_error")
 
     try:
-        client = Client(ZARINPAL_WEBSERVICE)
-        result = client.service.PaymentVerification(ZARINPAL_MERCHANT_ID, authority, pending.amount)
+        with metrics.phase('gateway_verify'):
+            result = zarinpal_gateway.payment_verification(ZARINPAL_MERCHANT_ID, authority, pending.amount)
 
-        if result.Status == 100:
-            logger.info(f"Zarinpal verification successful. Authority: {authority}, RefID: {result.RefID}")
-            user = User.query.filter_by(phone_number=pending.phone_number).first()
-
-            if not user:
-                logger.error(f"CRITICAL: Zarinpal payment verified (RefID: {result.RefID}) but user {pending.phone_number} not found!")
-                return redirect(f"{FRONTEND_URL}/start?status=failed&reason=user_sync_error&refid={result.RefID}")
+        # 101 means the gateway verified it before, but a row that is still pending was never credited
+        if result.Status in reconcile.VERIFIED_STATUSES:
+            logger.info("Zarinpal verification successful (Status %s). Authority: %s, RefID: %s", result.Status, authority, result.RefID)
+            phone_number = pending.phone_number
 
             try:
-                # Credit the ORIGINAL amount to the wallet
-                user.wallet_balance = (user.wallet_balance or 0) + pending.original_amount
-                now = datetime.utcnow()
-
-                # Record the successful top-up
-                new_purchase = Purchase(
-                    user_id=user.id,
-                    purchase_time=now,
-                    amount_paid=pending.amount,  # Record actual paid amount
-                    sessions_purchased=0,
-                    payment_ref_id=str(result.RefID),
-                )
-                db.session.add(new_purchase)
-                db.session.delete(pending)
-                db.session.commit()
-
-                logger.info(f"DB updated successfully for user {user.id} after Zarinpal payment. Added {pending.original_amount} to wallet (Paid: {pending.amount}). New balance: {user.wallet_balance}. RefID: {result.RefID}.")
+                # Claiming the pending row and crediting happen in one transaction; a concurrent
+                # duplicate callback blocks on the DELETE and then finds nothing to claim
+                with metrics.phase('settle'):
+                    claimed, balance = settle_verified_payment(authority, result.RefID)
+                if claimed is None:
+                    logger.info("Payment %s was already credited by a concurrent callback. RefID: %s", authority, result.RefID)
+                    return redirect(f"{FRONTEND_URL}/start?status=already_verified&refid={result.RefID}")
+                if balance is None:
+                    logger.error("CRITICAL: Zarinpal payment verified (RefID: %s) but user %s not found; moved to orphaned_payments", result.RefID, phone_number)
+                    return redirect(f"{FRONTEND_URL}/start?status=failed&reason=user_sync_error&refid={result.RefID}")
+
+                logger.info("DB updated successfully for user %s after Zarinpal payment. Added %s to wallet (Paid: %s). New balance: %s. RefID: %s.", balance.user_id, claimed.original_amount, claimed.amount, balance.wallet_balance, result.RefID)
                 return redirect(f"{FRONTEND_URL}/start?status=success&refid={result.RefID}")
 
             except Exception as db_err:
                 db.session.rollback()
-                logger.error(f"CRITICAL: DB error after successful Zarinpal verification (RefID: {result.RefID}, User: {user.id}): {db_err}", exc_info=True)
+                logger.error("CRITICAL: DB error after successful Zarinpal verification (RefID: %s, User: %s): %s", result.RefID, phone_number, db_err, exc_info=True)
                 return redirect(f"{FRONTEND_URL}/start?status=failed&reason=db_update_failed&refid={result.RefID}")
 
-        elif result.Status == 101:
-            logger.info(f"Payment already verified by Zarinpal for authority: {authority}. RefID: {result.RefID}")
-            if pending:
-                try:
-                    db.session.delete(pending)
-                    db.session.commit()
-                except:
-                    db.session.rollback()
-            return redirect(f"{FRONTEND_URL}/start?status=already_verified&refid={result.RefID}")
         else:
-            logger.error(f"Zarinpal PaymentVerification failed for Authority {authority}. Status: {result.Status}")
+            logger.error("Zarinpal PaymentVerification failed for Authority %s. Status: %s", authority, result.Status)
             try:
                 db.session.delete(pending)
                 db.session.commit()
@@ -994,12 +1895,12 @@ def payment_verify():
             return redirect(f"{FRONTEND_URL}/start?status=failed&code={result.Status}")
 
     except Exception as e:
-        logger.error(f"Error during Zarinpal payment verification process for Authority {authority}: {str(e)}", exc_info=True)
+        logger.error("Error during Zarinpal payment verification process for Authority %s: %s", authority, str(e), exc_info=True)
         return redirect(f"{FRONTEND_URL}/start?status=failed&reason=verification_error")
     
 # --- Feedback Endpoint ---
 
-@app.route('/api/feedback', methods=['POST'])
+@bp.route('/api/feedback', methods=['POST'])
 def submit_feedback():
     user = get_current_user()
     if not user:
@@ -1029,81 +1930,390 @@ def submit_feedback():
         )
         db.session.add(feedback)
         db.session.commit()
-        logger.info(f"Feedback submitted by user {user.id}, Rating: {validated_rating}")
+        logger.info("Feedback submitted by user %s, Rating: %s", user.id, validated_rating)
         return jsonify({'message': 'از بازخورد ارزشمند شما متشکریم!'}), 201
 
     except Exception as e:
         db.session.rollback()
-        logger.error(f"Error saving feedback for user {user.id}: {e}", exc_info=True)
+        logger.error("Error saving feedback for user %s: %s", user.id, e, exc_info=True)
         return jsonify({'error': 'خطا در ثبت بازخورد'}), 500
 
-@app.route('/api/stt/transcribe', methods=['POST'])
+# --- Admin Endpoints ---
+
+def parse_report_day(value, default):
+    return datetime.strptime(value, '%Y-%m-%d').date() if value else default
+
+@bp.route('/api/admin/reports/daily', methods=['GET'])
+def get_daily_report():
+    """Per-day metrics for ?from=YYYY-MM-DD&to=YYYY-MM-DD (local days), read from the rollups only."""
+    if not is_admin_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    today = rollups.local_day(datetime.utcnow())
+    try:
+        end = parse_report_day(request.args.get('to'), today)
+        start = parse_report_day(request.args.get('from'), end - timedelta(days=REPORT_DEFAULT_DAYS - 1))
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD'}), 400
+    if start > end or (end - start).days >= REPORT_MAX_DAYS:
+        return jsonify({'error': f'Range must be 1 to {REPORT_MAX_DAYS} days'}), 400
+
+    days = reports.daily(start, end)
+    totals = dict.fromkeys(rollups.METRICS, 0)
+    for day in days:
+        for metric in rollups.METRICS:
+            totals[metric] += day[metric]
+
+    def with_derived(values):
+        values['discounted'] = max(values['wallet_credited'] - values['revenue'], 0)
+        values['sessions_started'] = values['paid_sessions'] + values['free_sessions']
+        values['average_rating'] = round(values['rating_sum'] / values['rating_count'], 2) if values['rating_count'] else None
+        return values
+
+    return jsonify({
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'days': [with_derived({
+            **{metric: day[metric] for metric in rollups.METRICS},
+            'day': day['day'].isoformat(),
+        }) for day in days],
+        'totals': with_derived(totals),
+        'refreshed_at': {source: at.isoformat() for source, at in reports.freshness().items()},
+    })
+
+@bp.route('/api/admin/reports/refresh', methods=['POST'])
+def refresh_reports():
+    """Folds new rows into the rollups now instead of waiting for the background refresh."""
+    if not is_admin_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    try:
+        folded = reports.refresh()
+    except Exception as e:
+        logger.error("Manual rollup refresh failed: %s", e, exc_info=True)
+        return jsonify({'error': 'Rollup refresh failed'}), 500
+    return jsonify({'folded': folded})
+
+@bp.route('/api/admin/payments/reconcile', methods=['POST'])
+def reconcile_payments():
+    """Runs a reconciliation pass over stale pending payments now; returns the outcome counts."""
+    if not is_admin_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    if not ZARINPAL_MERCHANT_ID:
+        return jsonify({'error': 'Zarinpal is not configured'}), 503
+    try:
+        counts = payment_reconciler.run_once()
+    except Exception as e:
+        logger.error("Manual payment reconciliation failed: %s", e, exc_info=True)
+        return jsonify({'error': 'Reconciliation failed'}), 500
+    return jsonify({'counts': dict(counts)})
+
+@bp.route('/api/admin/discount-codes', methods=['GET'])
+def list_discount_codes():
+    """All codes with their usage statistics (as of the last flush on each node)."""
+    if not is_admin_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    codes = DiscountCode.query.order_by(DiscountCode.created_at.desc()).all()
+    return jsonify({'codes': [code.to_dict() for code in codes]})
+
+def parse_utc_datetime(value):
+    """ISO 8601 -> naive UTC, as the DateTime columns store it. Values without an offset are taken as UTC."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+@bp.route('/api/admin/discount-codes/<code>', methods=['PUT'])
+def put_discount_code(code):
+    """Creates or updates a code. Body: percent, active, starts_at, ends_at (ISO; UTC unless an offset is given), max_uses."""
+    if not is_admin_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    code = discounts.normalize_code(code)
+    data = request.json or {}
+    discount = db.session.get(DiscountCode, code) or DiscountCode(code=code, used_count=0, discount_total=0)
+    try:
+        if 'percent' in data or discount.percent is None:
+            percent = int(data['percent'])
+            if not 1 <= percent <= 100:
+                raise ValueError('percent must be 1-100')
+            discount.percent = percent
+        if 'active' in data:
+            discount.active = bool(data['active'])
+        for field in ('starts_at', 'ends_at'):
+            if field in data:
+                setattr(discount, field, parse_utc_datetime(data[field]) if data[field] else None)
+        if 'max_uses' in data:
+            discount.max_uses = int(data['max_uses']) if data['max_uses'] is not None else None
+    except (KeyError, TypeError, ValueError) as e:
+        db.session.rollback()
+        return jsonify({'error': f'Invalid discount code fields: {e}'}), 400
+    if discount.active is None:
+        discount.active = True
+    discount.updated_at = datetime.utcnow()
+    db.session.add(discount)
+    db.session.commit()
+    discount_codes.invalidate(code)
+    logger.info("Discount code %s saved: %s%%, active=%s, max_uses=%s", code, discount.percent, discount.active, discount.max_uses)
+    return jsonify(discount.to_dict())
+
+@bp.route('/api/admin/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition; ?format=json gives estimated percentiles and current admission state."""
+    if not is_admin_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    if request.args.get('format') == 'json':
+        return jsonify({'metrics': metrics.registry.summary(), 'admission': admission_control.snapshot()})
+    return Response(metrics.registry.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/api/admin/profiler', methods=['GET', 'POST', 'DELETE'])
+def manage_profiler():
+    """POST {"rate": 0.05, "duration": 300} starts sampling (this process only), DELETE stops it.
+
+    GET returns the status, or with ?format=folded the collected stacks for a flame graph.
+    """
+    if not is_admin_request():
+        return jsonify({'error': 'Forbidden'}), 403
+    if request.method == 'POST':
+        data = request.json or {}
+        try:
+            rate = float(data.get('rate', 0.01))
+            duration = int(data.get('duration', 300))
+            if not 0 < rate <= 1 or duration <= 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            return jsonify({'error': 'rate must be in (0, 1] and duration a positive number of seconds'}), 400
+        sampling_profiler.start(rate, duration, reset=bool(data.get('reset', True)))
+        logger.info("Sampling profiler started at rate %s for %ss", rate, duration)
+    elif request.method == 'DELETE':
+        sampling_profiler.stop()
+    elif request.args.get('format') == 'folded':
+        return Response(sampling_profiler.folded(), mimetype='text/plain')
+    return jsonify({'pid': os.getpid(), **sampling_profiler.status()})
+
+def transcribe_chunk(upload, headers):
+    """Transcribes one (filename, fileobj, mimetype) chunk of a long recording; returns its text."""
+    response = upstream.request('POST', STT_API_URL, files={'file': upload},
+                                data={'model': STT_MODEL}, headers=headers, timeout=STT_TIMEOUT)
+    response.raise_for_status()
+    text = response.json().get('text')
+    if text is None:
+        raise ValueError(f"STT API returned no 'text' for a chunk: {response.text[:200]}")
+    return text
+
+@bp.route('/api/stt/transcribe', methods=['POST'])
 def transcribe_audio():
-    logger.info(f"STT request received. Session details: user_id={session.get('user_id')}, phone={session.get('phone_number')}")
+    logger.info("STT request received. Session details: user_id=%s, phone=%s", session.get('user_id'), session.get('phone_number'))
     user = get_current_user()  # Optional: Keep for logging/context, but no auth check
     user_id = user.id if user else "Unknown"
 
     if 'file' not in request.files:
-        logger.error(f"No 'file' part in STT request from user {user_id}")
+        logger.error("No 'file' part in STT request from user %s", user_id)
         return jsonify({'error': 'فایل صوتی در درخواست یافت نشد'}), 400
 
     audio_file = request.files['file']
     if not audio_file or audio_file.filename == '':
-        logger.error(f"Empty/No selected file in STT request from user {user_id}")
+        logger.error("Empty/No selected file in STT request from user %s", user_id)
         return jsonify({'error': 'فایل صوتی انتخاب نشده یا نامعتبر است'}), 400
 
     if not STT_API_KEY:
         logger.error("STT_API_KEY is not configured in the backend environment.")
         return jsonify({'error': 'سرویس تبدیل گفتار به متن پیکربندی نشده است'}), 503
 
-    try:
-        files = {
-            'file': (audio_file.filename, audio_file.stream, audio_file.mimetype or 'application/octet-stream')
-        }
-        data = {'model': 'whisper-1'}
-        headers = {'Authorization': f'Bearer {STT_API_KEY}'}
-        logger.info(f"Sending STT request to {STT_API_URL} for user {user_id}. Filename: {audio_file.filename}, Mimetype: {audio_file.mimetype}")
-        response = requests.post(STT_API_URL, files=files, data=data, headers=headers, timeout=60)
-        logger.debug(f"STT API responded with Status Code: {response.status_code}")
+    # Copy the upload now: under the ASGI entry point the upstream call outlives this request context
+    spool, cache_key = stt.spool_upload(audio_file.stream, STT_MODEL)
+    cached_transcription = stt_cache.get(cache_key)
+    if cached_transcription is not None:
+        logger.info("STT cache hit for user %s. Transcription length: %s", user_id, len(cached_transcription))
+        return jsonify({'transcription': cached_transcription}), 200
+
+    data = {'model': STT_MODEL}
+    headers = {'Authorization': f'Bearer {STT_API_KEY}'}
+
+    def finish(response):
+        logger.debug("STT API responded with Status Code: %s", response.status_code)
         response.raise_for_status()
         result = response.json()
         transcription = result.get('text')
         if transcription is not None:
-            logger.info(f"STT successful for user {user_id}. Transcription length: {len(transcription)}")
+            logger.info("STT successful for user %s. Transcription length: %s", user_id, len(transcription))
+            stt_cache.set(cache_key, transcription)
             return jsonify({'transcription': transcription}), 200
         else:
-            logger.warning(f"STT API returned 200 OK but no 'text' field for user {user_id}. Response: {result}")
+            logger.warning("STT API returned 200 OK but no 'text' field for user %s. Response: %s", user_id, logs.payload(result))
             return jsonify({'error': 'متن از فایل صوتی استخراج نشد (پاسخ نامعتبر)'}), 500
-    except requests.exceptions.Timeout:
-        logger.error(f"STT API request timed out for user {user_id}")
-        return jsonify({'error': 'خطا در ارتباط با سرویس تبدیل گفتار (Timeout)'}), 504
-    except requests.exceptions.RequestException as e:
-        status = e.response.status_code if e.response is not None else 503
-        error_body = e.response.text if e.response is not None else "N/A"
-        logger.error(f"STT API request failed for user {user_id}. Status: {status}, Error: {e}, Body: {error_body}", exc_info=True)
-        user_error = f'خطا در سرویس تبدیل گفتار ({status})'
-        if status == 401:
-            user_error = 'خطای احراز هویت در سرویس تبدیل گفتار (کلید API؟)'
-        elif status == 400:
-            user_error = 'درخواست نامعتبر به سرویس تبدیل گفتار (فرمت فایل؟)'
-        elif status == 429:
-            user_error = 'تعداد درخواست‌ها به سرویس تبدیل گفتار بیش از حد مجاز است.'
-        elif status >= 500:
-            user_error = 'خطای داخلی در سرویس تبدیل گفتار.'
-        return jsonify({'error': user_error}), status
-    except Exception as e:
-        logger.error(f"Unexpected error during STT processing for user {user_id}: {e}", exc_info=True)
+
+    def fail(e):
+        if isinstance(e, requests.exceptions.Timeout):
+            logger.error("STT API request timed out for user %s", user_id)
+            return jsonify({'error': 'خطا در ارتباط با سرویس تبدیل گفتار (Timeout)'}), 504
+        if isinstance(e, requests.exceptions.RequestException):
+            status = e.response.status_code if e.response is not None else 503
+            error_body = e.response.text if e.response is not None else "N/A"
+            logger.error("STT API request failed for user %s. Status: %s, Error: %s, Body: %s", user_id, status, e, logs.payload(error_body), exc_info=True)
+            user_error = f'خطا در سرویس تبدیل گفتار ({status})'
+            if status == 401:
+                user_error = 'خطای احراز هویت در سرویس تبدیل گفتار (کلید API؟)'
+            elif status == 400:
+                user_error = 'درخواست نامعتبر به سرویس تبدیل گفتار (فرمت فایل؟)'
+            elif status == 429:
+                user_error = 'تعداد درخواست‌ها به سرویس تبدیل گفتار بیش از حد مجاز است.'
+            elif status >= 500:
+                user_error = 'خطای داخلی در سرویس تبدیل گفتار.'
+            return jsonify({'error': user_error}), status
+        logger.error("Unexpected error during STT processing for user %s: %s", user_id, e, exc_info=True)
         return jsonify({'error': 'خطای سیستمی هنگام پردازش صدا'}), 500
 
+    # WAV is shrunk to trimmed 16 kHz mono; long recordings are split at silence and the chunks transcribed in parallel
+    try:
+        uploads = stt.prepare_uploads(spool, audio_file.filename, audio_file.mimetype or 'application/octet-stream')
+    except Exception as e:
+        logger.warning("Audio preprocessing failed for user %s, sending the upload as is: %s", user_id, e, exc_info=True)
+        spool.seek(0)
+        uploads = [(audio_file.filename, spool, audio_file.mimetype or 'application/octet-stream')]
+    if len(uploads) > 1:
+        logger.info("Sending STT request to %s for user %s in %s chunks. Filename: %s", STT_API_URL, user_id, len(uploads), audio_file.filename)
+        try:
+            texts = list(stt_chunk_executor.map(lambda upload: transcribe_chunk(upload, headers), uploads))
+        except Exception as e:
+            return fail(e)
+        transcription = stt.stitch(texts)
+        stt_cache.set(cache_key, transcription)
+        logger.info("Chunked STT successful for user %s. Transcription length: %s", user_id, len(transcription))
+        return jsonify({'transcription': transcription}), 200
+
+    files = {'file': uploads[0]}
+    logger.info("Sending STT request to %s for user %s. Filename: %s, Mimetype: %s", STT_API_URL, user_id, uploads[0][0], uploads[0][2])
+    return call_upstream('POST', STT_API_URL, finish, fail, files=files, data=data, headers=headers, timeout=STT_TIMEOUT)
+
+
+# --- Background Workers ---
+# Threads don't survive a fork, so each process starts its own on its first request instead of
+# at import; a pre-fork master (see preload()) never starts any.
+_workers_pid = None
+_workers_lock = threading.Lock()
+
+@bp.before_app_request
+def start_background_workers():
+    global _workers_pid
+    if _workers_pid == os.getpid():
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _workers_pid = os.getpid()
+        app = current_app._get_current_object()
+        if isinstance(app.session_interface, DatabaseSessionInterface):
+            app.session_interface.start_sweeper(app)
+        if rollups.ROLLUP_INTERVAL > 0:
+            reports.start_refresher()
+        if ZARINPAL_MERCHANT_ID:
+            zarinpal_gateway.warm_up_in_background() # Parse the WSDL before the first checkout needs it; instant if preloaded
+            if reconcile.PAYMENT_RECONCILE_INTERVAL > 0:
+                payment_reconciler.start()
+
+# --- Application Factory ---
+_engines = [] # Engines of every app built here, for the after-fork reset
+_default_app_lock = threading.Lock()
+
+def create_app(config=None):
+    """Builds the Flask app: config, CORS, sessions, the database binding and the routes on `bp`.
+
+    `config` overrides single settings, e.g. {'SQLALCHEMY_DATABASE_URI': ...} for a scratch
+    database. No connections are opened and no threads started here.
+    """
+    logs.configure() # Queued JSON logging; levels from LOG_LEVEL / LOG_LEVELS
+    app = Flask(__name__)
+    app.config.from_object(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.update(config or {})
+    logger.info("Database URL: %s", sa_make_url(app.config['SQLALCHEMY_DATABASE_URI']).render_as_string(hide_password=True))
+
+    CORS(app, origins=[FRONTEND_URL], supports_credentials=True, methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"])
+    if app.config['SESSION_TYPE'] == 'database':
+        app.session_interface = database_session_interface
+    else:
+        # Create the session directory if it doesn't exist (for filesystem type)
+        if app.config['SESSION_TYPE'] == 'filesystem' and not os.path.exists(app.config['SESSION_FILE_DIR']):
+            os.makedirs(app.config['SESSION_FILE_DIR'])
+            logger.info("Created session directory: %s", app.config['SESSION_FILE_DIR'])
+        Session(app)
+
+    db.init_app(app)
+    with app.app_context():
+        _engines.extend(db.engines.values())
+    for extension in (transcript_store, discount_codes, reports, title_worker, payment_reconciler):
+        extension.init_app(app) # Their worker threads open app contexts on this app
+
+    if TRUSTED_PROXY_HOPS > 0:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS, x_proto=TRUSTED_PROXY_HOPS)
+    app.wsgi_app = metrics.TimingMiddleware(app.wsgi_app, REQUEST_METRICS_ENVIRON_KEY)
+    app.json = TimedJSONProvider(app)
+    app.register_blueprint(bp)
+    return app
+
+def preload():
+    """Warm-up for pre-fork servers, run once in the master (see gunicorn.conf.py).
+
+    Does the slow one-off work that forked workers then inherit: importing NumPy and suds and
+    parsing the Zarinpal WSDL. It leaves no threads behind, and inherited connections are
+    dropped in each child (below and in upstream.py), so a new worker serves at once.
+    """
+    started = time.monotonic()
+    stt.load_numpy()
+    if ZARINPAL_MERCHANT_ID:
+        zarinpal_gateway.warm_up()
+    logger.info("Preloaded in %.0fms", (time.monotonic() - started) * 1000)
+
+def _dispose_engines_after_fork():
+    # Pooled connections from the parent would share its sockets; the child opens its own
+    for engine in _engines:
+        engine.dispose(close=False)
+
+os.register_at_fork(after_in_child=_dispose_engines_after_fork)
+
+def __getattr__(name):
+    # `app:app` (gunicorn, flask run) and asgi.py's `from app import app` share one default app, built on first access
+    if name == 'app':
+        global app
+        with _default_app_lock:
+            if 'app' not in globals():
+                app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# --- Database Setup ---
+# Run on every deploy, before the servers start: `flask --app app init-db`. Servers (gunicorn.conf.py,
+# asgi.py) don't do this themselves, so workers never race each other on DDL.
+def init_database():
+    """Creates missing tables, seeds the default discount codes and opens ledger accounts; safe to repeat."""
+    logger.info("Attempting to create database tables...")
+    db.create_all()
+    # create_all() leaves existing tables alone, so indexes added to them later (such as
+    # pending_transactions.created_at, which the payment reconciler scans by) are created here
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    logger.info("Database tables created successfully")
+    seeded = discount_codes.seed(DEFAULT_DISCOUNT_CODES)
+    if seeded:
+        logger.info("Seeded %s default discount codes", seeded)
+    opened = accounts.open_missing_accounts()
+    if opened:
+        logger.info("Recorded opening ledger balances for %s existing users", opened)
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """Create missing tables and seed reference data (run on every deploy)."""
+    init_database()
+
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         try:
-            logger.info("Attempting to create database tables...")
-            db.create_all()
-            logger.info("Database tables created successfully")
+            init_database()
         except Exception as e:
-            logger.error(f"Error creating database tables: {str(e)}", exc_info=True)
+            logger.error("Error creating database tables: %s", str(e), exc_info=True)
     
     port = 5000
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
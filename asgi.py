@@ -0,0 +1,318 @@
+"""ASGI entry point for the Delyar backend.
+
+Serve with any ASGI server, e.g.:
+
+    flask --app app init-db   # once per deploy: creates missing tables and seeds
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+Every request still goes through the Flask app (auth, sessions, CORS) on a small thread
+pool, but views that talk to MetisAI or the STT API hand their upstream call back here
+through call_upstream / stream_upstream in app.py. The call then runs on the event loop
+with one shared httpx client, so a slow upstream holds a coroutine instead of a thread and
+a single process can keep hundreds of chat and STT calls in flight.
+"""
+import asyncio
+import io
+import os
+import sys
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import requests
+
+import metrics
+import upstream
+from app import (app, finish_request_timing, ADMISSION_TICKET_ENVIRON_KEY, DEFERRED_UPSTREAM_ENVIRON_KEY,
+                 REQUEST_METRICS_ENVIRON_KEY, SSE_RESPONSE_HEADERS)
+
+logger = logging.getLogger(__name__)
+
+# Threads only run the (fast) Flask part of each request, so this can stay small
+ASGI_WSGI_THREADS = int(os.getenv('ASGI_WSGI_THREADS', 32))
+ASGI_UPSTREAM_MAX_CONNECTIONS = int(os.getenv('ASGI_UPSTREAM_MAX_CONNECTIONS', 500))
+ASGI_UPSTREAM_MAX_KEEPALIVE = int(os.getenv('ASGI_UPSTREAM_MAX_KEEPALIVE', 100))
+
+# Headers set by Flask on the placeholder response that must carry over to the final one
+FORWARDED_HEADER_PREFIXES = ('set-cookie', 'access-control-', 'vary')
+
+
+class DeferredCall:
+    """An upstream call handed over by a Flask view, with the handlers that render its outcome."""
+
+    def __init__(self, method, url, kwargs, finish=None, fail=None, relay=None, timing=None):
+        self.method = method
+        self.url = url
+        self.kwargs = kwargs
+        self.finish = finish
+        self.fail = fail
+        self.relay = relay
+        self.timing = timing # The request's metrics.RequestTiming, for its 'upstream' phase
+
+
+def as_requests_error(e):
+    """Maps httpx exceptions onto the requests hierarchy that the views' fail() handlers expect."""
+    if isinstance(e, httpx.TimeoutException):
+        return requests.exceptions.Timeout(str(e))
+    if isinstance(e, httpx.HTTPStatusError):
+        return requests.exceptions.HTTPError(str(e), response=e.response)
+    if isinstance(e, httpx.HTTPError):
+        return requests.exceptions.ConnectionError(str(e))
+    return e
+
+
+def httpx_kwargs(kwargs):
+    """Converts requests-style keyword arguments to their httpx equivalents."""
+    kwargs = dict(kwargs)
+    timeout = kwargs.get('timeout')
+    if isinstance(timeout, tuple):
+        connect, read = timeout
+        kwargs['timeout'] = httpx.Timeout(read, connect=connect)
+    return kwargs
+
+
+def build_environ(scope, body):
+    """Builds a WSGI environ from an ASGI HTTP scope and its fully read body."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf8').decode('latin1'),
+        'PATH_INFO': scope['path'].encode('utf8').decode('latin1'),
+        'QUERY_STRING': scope['query_string'].decode('ascii'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+        environ['REMOTE_PORT'] = str(scope['client'][1])
+    for raw_name, raw_value in scope['headers']:
+        name = raw_name.decode('latin1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        value = raw_value.decode('latin1')
+        if key in environ:
+            value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
+
+
+def run_wsgi(wsgi_app, environ):
+    """Runs a WSGI app to completion and returns (status, headers, body)."""
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured['status'] = int(status.split(' ', 1)[0])
+        captured['headers'] = headers
+
+    result = wsgi_app(environ, start_response)
+    try:
+        body = b''.join(result)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    return captured['status'], captured['headers'], body
+
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message['type'] != 'http.request':
+            break
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    return bytes(body)
+
+
+def merge_headers(headers, forwarded):
+    """Adds forwarded headers that the final response doesn't already set (cookies always pass)."""
+    present = {name.lower() for name, _ in headers}
+    return headers + [(k, v) for k, v in forwarded if k.lower() not in present or k.lower() == 'set-cookie']
+
+
+def encode_headers(headers):
+    return [(name.lower().encode('latin1'), value.encode('latin1')) for name, value in headers]
+
+
+class DelyarASGIApp:
+    def __init__(self, flask_app, threads=ASGI_WSGI_THREADS):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        self.client = None
+
+    def get_client(self):
+        # Created lazily so it binds to the server's running event loop
+        if self.client is None:
+            self.client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=ASGI_UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=ASGI_UPSTREAM_MAX_KEEPALIVE,
+            ))
+        return self.client
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return  # No websocket routes
+
+        body = await read_body(receive)
+        environ = build_environ(scope, body)
+        deferred = []
+
+        def defer(method, url, kwargs, **handlers):
+            deferred.append(DeferredCall(method, url, kwargs, timing=environ.get(REQUEST_METRICS_ENVIRON_KEY), **handlers))
+            return '', 202  # Placeholder; only its headers (cookies, CORS) are kept
+
+        environ[DEFERRED_UPSTREAM_ENVIRON_KEY] = defer
+        loop = asyncio.get_running_loop()
+        sent_status = []
+
+        async def tracked_send(message):
+            if message['type'] == 'http.response.start':
+                sent_status.append(message['status'])
+                timing = environ.get(REQUEST_METRICS_ENVIRON_KEY)
+                if deferred and timing is not None: # Flask's Server-Timing predates the upstream call
+                    message = {**message, 'headers': message['headers'] + [(b'server-timing', timing.server_timing().encode('latin1'))]}
+            await send(message)
+
+        try:
+            status, headers, body = await loop.run_in_executor(self.executor, run_wsgi, self.flask_app, environ)
+
+            if not deferred:
+                await tracked_send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(headers)})
+                await tracked_send({'type': 'http.response.body', 'body': body})
+                return
+
+            forwarded = [(k, v) for k, v in headers if k.lower().startswith(FORWARDED_HEADER_PREFIXES)]
+            call = deferred[0]
+            if call.relay is not None:
+                await self.send_stream(call, forwarded, tracked_send)
+            else:
+                await self.send_call(call, forwarded, tracked_send)
+        finally:
+            # The admission slot covers the deferred upstream call, not just the Flask part
+            ticket = environ.get(ADMISSION_TICKET_ENVIRON_KEY)
+            if ticket is not None:
+                ticket.release()
+            timing = environ.get(REQUEST_METRICS_ENVIRON_KEY)
+            if timing is not None:
+                finish_request_timing(timing, sent_status[0] if sent_status else 500)
+
+    async def request(self, call, stream=False):
+        """Sends a deferred call under the same breaker and GET-retry policy as upstream.request()."""
+        client = self.get_client()
+        breaker = upstream.client_for(call.url).breaker
+        attempts = 1 if stream else upstream.attempts_for(call.method)
+        operation = upstream.operation_for(call.method, call.url, call.kwargs.get('headers'))
+        for attempt in range(attempts):
+            try:
+                breaker.before_call()
+            except upstream.UpstreamUnavailable:
+                metrics.registry.inc('upstream_circuit_rejections_total', operation)
+                raise
+            last_attempt = attempt + 1 >= attempts
+            try:
+                with metrics.UpstreamTimer(operation, timing=call.timing) as timer:
+                    response = await client.send(client.build_request(call.method, call.url, **httpx_kwargs(call.kwargs)), stream=stream)
+                    timer.outcome = metrics.outcome_for(response.status_code)
+            except httpx.TransportError:
+                breaker.record_failure()
+                if last_attempt:
+                    raise
+            except Exception:
+                breaker.record_failure() # Not retried, but a half-open probe must still resolve
+                raise
+            else:
+                breaker.record_status(response.status_code)
+                if last_attempt or response.status_code not in upstream.RETRYABLE_STATUS_CODES:
+                    return response
+                await response.aclose()
+            await asyncio.sleep(upstream.retry_delay(attempt))
+
+    async def render(self, handler, arg):
+        """Runs a view's finish/fail handler on the thread pool and returns (status, headers, body).
+
+        Handlers may query the database (e.g. stored chat titles), so they must not run on the loop.
+        """
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.render_sync, handler, arg)
+
+    def render_sync(self, handler, arg):
+        with self.flask_app.app_context():
+            response = self.flask_app.make_response(handler(arg))
+        return response.status_code, list(response.headers.items()), response.get_data()
+
+    async def send_call(self, call, forwarded, send):
+        try:
+            response = await self.request(call)
+            status, headers, body = await self.render(call.finish, response)
+        except Exception as e:
+            status, headers, body = await self.render(call.fail, as_requests_error(e))
+
+        await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(merge_headers(headers, forwarded))})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def send_stream(self, call, forwarded, send):
+        relay = call.relay
+        upstream_response = None
+        try:
+            upstream_response = await self.request(call, stream=True)
+            upstream_response.raise_for_status()
+        except Exception as e:
+            if upstream_response is not None:
+                await upstream_response.aclose()
+            status, headers, body = await self.render(call.fail, as_requests_error(e))
+            await send({'type': 'http.response.start', 'status': status, 'headers': encode_headers(merge_headers(headers, forwarded))})
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        headers = [('Content-Type', 'text/event-stream; charset=utf-8'), *SSE_RESPONSE_HEADERS.items(), *forwarded]
+        await send({'type': 'http.response.start', 'status': 200, 'headers': encode_headers(headers)})
+
+        async def send_frame(frame):
+            if frame:
+                await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+
+        try:
+            if 'text/event-stream' not in upstream_response.headers.get('Content-Type', ''):
+                await upstream_response.aread()
+                await send_frame(relay.feed_json(upstream_response.json()))
+            else:
+                async for line in upstream_response.aiter_lines():
+                    await send_frame(relay.feed_line(line.rstrip('\r\n')))
+                    if relay.finished:
+                        break
+            await send_frame(relay.done())
+        except Exception as e:
+            await send_frame(relay.error(as_requests_error(e)))
+        finally:
+            await upstream_response.aclose()
+            await send({'type': 'http.response.body', 'body': b''})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.client is not None:
+                    await self.client.aclose()
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = DelyarASGIApp(app)
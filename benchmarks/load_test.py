@@ -0,0 +1,454 @@
+"""Load test for the Flask backend, with local stand-ins for MetisAI, Zarinpal, Melipayamak and STT.
+
+Virtual users run the journey a real user does: OTP login, check-access polling, a wallet
+top-up through Zarinpal and a session purchase, start-session, a new MetisAI chat, chat turns
+(some streamed, some preceded by a voice message) and the chat sidebar. The report gives
+throughput and latency percentiles per endpoint; a run can be saved as a baseline and later
+runs compared against it, failing (exit 1) on a regression.
+
+    python benchmarks/load_test.py --users 20 --duration 60
+    python benchmarks/load_test.py --latency metis=3,stt=4 --errors metis=0.05 --users 50
+    python benchmarks/load_test.py --save-baseline main
+    python benchmarks/load_test.py --compare main --tolerance 0.2
+
+The app runs in this process behind a threaded WSGI server (or uvicorn with --server asgi)
+against a throwaway SQLite file, or BENCH_DATABASE_URL, e.g. a scratch PostgreSQL database
+for numbers that match production. Its tables are dropped and recreated on every run, so
+never point it at a real database.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wave
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import requests
+
+import standins
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+SESSION_PRICE = 39000
+REQUEST_TIMEOUT = 120
+
+# Differences smaller than this are noise, whatever the relative change
+MIN_LATENCY_REGRESSION_MS = 5
+MIN_ERROR_RATE_REGRESSION = 0.01
+MIN_COUNT_FOR_P99 = 100 # Below this, p99 is just the slowest request or two
+
+
+# --- Recording ---
+
+class Recorder:
+    """Latencies (ms) and outcomes per endpoint, from all virtual users."""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int) # 5xx and transport failures
+        self.rejected = defaultdict(int) # 4xx, e.g. a 429 from the OTP limiter
+        self.journeys = 0
+        self.failed_journeys = 0
+        self._lock = threading.Lock()
+
+    def record(self, name, elapsed, status):
+        with self._lock:
+            self.latencies[name].append(elapsed * 1000)
+            if status is None or status >= 500:
+                self.errors[name] += 1
+            elif status >= 400:
+                self.rejected[name] += 1
+
+    def journey_done(self, ok):
+        with self._lock:
+            self.journeys += 1
+            self.failed_journeys += not ok
+
+    def results(self, wall):
+        endpoints = {}
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            endpoints[name] = {
+                'count': len(values),
+                'rps': round(len(values) / wall, 2),
+                'errors': self.errors[name],
+                'rejected': self.rejected[name],
+                'error_rate': round(self.errors[name] / len(values), 4),
+                'mean_ms': round(sum(values) / len(values), 1),
+                'p50_ms': round(percentile(values, .5), 1),
+                'p90_ms': round(percentile(values, .9), 1),
+                'p95_ms': round(percentile(values, .95), 1),
+                'p99_ms': round(percentile(values, .99), 1),
+                'max_ms': round(values[-1], 1),
+            }
+        return {
+            'wall_seconds': round(wall, 1),
+            'journeys': self.journeys,
+            'failed_journeys': self.failed_journeys,
+            'journeys_per_second': round(self.journeys / wall, 3),
+            'requests_per_second': round(sum(len(v) for v in self.latencies.values()) / wall, 2),
+            'endpoints': endpoints,
+        }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class JourneyFailed(Exception):
+    pass
+
+
+class Client:
+    """One virtual user's cookie session; every call is timed into the recorder under `name`."""
+
+    def __init__(self, base_url, recorder, address=None):
+        self.base_url = base_url
+        self.recorder = recorder
+        self.http = requests.Session()
+        if address:
+            self.http.headers['X-Forwarded-For'] = address # As the reverse proxy would add it
+
+    def call(self, name, method, path, expect=(200,), **kwargs):
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        kwargs.setdefault('allow_redirects', False)
+        started = time.perf_counter()
+        try:
+            response = self.http.request(method, self.base_url + path, **kwargs)
+            response.content # Time the whole body
+        except requests.exceptions.RequestException as e:
+            self.recorder.record(name, time.perf_counter() - started, None)
+            raise JourneyFailed(f"{name}: {e.__class__.__name__}") from e
+        self.recorder.record(name, time.perf_counter() - started, response.status_code)
+        if response.status_code not in expect:
+            raise JourneyFailed(f"{name}: HTTP {response.status_code}")
+        return response
+
+    def stream(self, name, path, **kwargs):
+        """POSTs and reads an SSE response; records time to the first frame and to the end."""
+        started = time.perf_counter()
+        first = None
+        broken = False
+        try:
+            with self.http.post(self.base_url + path, stream=True, timeout=REQUEST_TIMEOUT, **kwargs) as response:
+                for line in response.iter_lines(chunk_size=1): # Unbuffered, to see when each frame arrives
+                    if first is None and line:
+                        first = time.perf_counter()
+                        self.recorder.record(f"{name} (first frame)", first - started, response.status_code)
+                    broken = broken or line.startswith(b'event: error')
+        except requests.exceptions.RequestException as e:
+            self.recorder.record(name, time.perf_counter() - started, None)
+            raise JourneyFailed(f"{name}: {e.__class__.__name__}") from e
+        # A stream that breaks midway still answered 200; count it as the upstream failure it is
+        self.recorder.record(name, time.perf_counter() - started, 502 if broken else response.status_code)
+        if broken or response.status_code != 200:
+            raise JourneyFailed(f"{name}: {'stream error event' if broken else f'HTTP {response.status_code}'}")
+
+
+# --- Journey ---
+
+def voice_message(rng, seconds=3.0, rate=16000):
+    """A short 16 kHz mono WAV of a wavering tone plus noise; unique per call, so STT caching can't hide the upload."""
+    frames = bytearray()
+    pitch = rng.uniform(150, 300)
+    for i in range(int(seconds * rate)):
+        t = i / rate
+        sample = 0.3 * math.sin(2 * math.pi * pitch * t * (1 + 0.05 * math.sin(3 * t))) + rng.uniform(-0.05, 0.05)
+        frames += struct.pack('<h', int(sample * 32767))
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(bytes(frames))
+    return buffer.getvalue()
+
+
+class Journey:
+    def __init__(self, args, base_url, stand_ins, recorder):
+        self.args = args
+        self.base_url = base_url
+        self.stand_ins = stand_ins
+        self.recorder = recorder
+        self._phones = iter(range(10 ** 8))
+        self._lock = threading.Lock()
+
+    def next_phone(self):
+        with self._lock:
+            return f"093{next(self._phones):08d}"
+
+    def think(self, rng):
+        if self.args.think > 0:
+            time.sleep(rng.uniform(0, 2 * self.args.think))
+
+    def run(self, rng):
+        args = self.args
+        phone = self.next_phone()
+        serial = int(phone[3:])
+        client = Client(self.base_url, self.recorder, address=f"10.{serial >> 16 & 255}.{serial >> 8 & 255}.{serial & 255}")
+
+        # OTP login; the code comes back through the SMS stand-in
+        client.call('POST /api/auth/request-otp', 'POST', '/api/auth/request-otp', json={'phone_number': phone})
+        code = self.stand_ins.sms.wait_for_code(phone)
+        if code is None:
+            raise JourneyFailed('OTP SMS never arrived')
+        self.think(rng)
+        client.call('POST /api/auth/verify-otp', 'POST', '/api/auth/verify-otp', json={'phone_number': phone, 'otp': code})
+
+        for _ in range(args.polls):
+            client.call('GET /api/chat/check-access', 'GET', '/api/chat/check-access')
+            client.call('GET /api/wallet/balance', 'GET', '/api/wallet/balance')
+            self.think(rng)
+
+        if rng.random() < args.purchase_rate:
+            response = client.call('POST /api/payment/request', 'POST', '/api/payment/request',
+                                   json={'amount': SESSION_PRICE, 'sessionCount': 1})
+            authority = response.json()['authority']
+            self.think(rng)
+            response = client.call('GET /api/payment/verify', 'GET', '/api/payment/verify', expect=(302,),
+                                   params={'Authority': authority, 'Status': 'OK'})
+            if 'status=success' not in response.headers.get('Location', ''):
+                raise JourneyFailed(f"payment not credited: {response.headers.get('Location')}")
+            client.call('POST /api/chat/purchase-session', 'POST', '/api/chat/purchase-session')
+
+        client.call('POST /api/chat/start-session', 'POST', '/api/chat/start-session')
+        session_id = client.call('POST /create-session', 'POST', '/create-session').json()['id']
+        client.call('GET /api/chat/sessions', 'GET', '/api/chat/sessions')
+
+        for turn in range(args.turns):
+            self.think(rng)
+            if rng.random() < args.voice_rate:
+                files = {'file': ('voice.wav', voice_message(rng), 'audio/wav')}
+                client.call('POST /api/stt/transcribe', 'POST', '/api/stt/transcribe', files=files)
+            message = {'sessionId': session_id, 'content': f"پیام شماره {turn + 1}", 'isFirstMessage': turn == 0}
+            if rng.random() < args.stream_rate:
+                client.stream('POST /respond/stream', '/respond/stream', json=message)
+            else:
+                client.call('POST /respond', 'POST', '/respond', json=message)
+
+        client.call('GET /api/chat/sessions/summary', 'GET', '/api/chat/sessions/summary')
+
+    def virtual_user(self, index, deadline, remaining):
+        rng = random.Random(self.args.seed * 1000 + index)
+        time.sleep(index * self.args.ramp_up / max(1, self.args.users)) # Stagger the starts
+        while time.monotonic() < deadline:
+            if remaining is not None:
+                with self._lock:
+                    if remaining[0] <= 0:
+                        return
+                    remaining[0] -= 1
+            try:
+                self.run(rng)
+                self.recorder.journey_done(True)
+            except JourneyFailed as e:
+                self.recorder.journey_done(False)
+                if self.args.verbose:
+                    print(f"  journey failed: {e}", file=sys.stderr)
+
+
+# --- App under test ---
+
+def configure_app_environment(stand_ins, workdir, args):
+    # SQLite serializes writers; the timeout makes them wait for the lock, as PostgreSQL rows would
+    database_url = os.getenv('BENCH_DATABASE_URL') or f"sqlite:///{os.path.join(workdir, 'delyar_load_test.db')}?timeout=30"
+    os.environ.update(stand_ins.env())
+    os.environ.update({
+        'DATABASE_URL': database_url,
+        'FLASK_SECRET_KEY': 'load-test',
+        'FLASK_ENV': 'development',
+        'ZARINPAL_WSDL_CACHE_DIR': os.path.join(workdir, 'wsdl_cache'),
+        # The app sees each virtual user's own address through X-Forwarded-For
+        'TRUSTED_PROXY_HOPS': '1',
+        'LOG_LEVEL': 'INFO' if args.verbose else 'WARNING',
+        'LOG_LEVELS': '' if args.verbose else 'werkzeug=WARNING',
+        'PAYMENT_RECONCILE_INTERVAL': '0',
+    })
+    return database_url
+
+
+def load_app():
+    sys.path.insert(0, ROOT)
+    import app as app_module
+    with app_module.app.app_context():
+        app_module.db.drop_all()
+        app_module.db.create_all()
+        app_module.discount_codes.seed(app_module.DEFAULT_DISCOUNT_CODES)
+    return app_module
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def serve(app_module, kind):
+    """Starts the app on a local port in a background thread; returns its base URL."""
+    port = free_port()
+    if kind == 'asgi':
+        try:
+            import uvicorn
+        except ImportError:
+            sys.exit('--server asgi needs uvicorn (pip install uvicorn)')
+        import asgi
+        server = uvicorn.Server(uvicorn.Config(asgi.application, host='127.0.0.1', port=port, log_level='warning'))
+        threading.Thread(target=server.run, name='app-server', daemon=True).start()
+    else:
+        from werkzeug.serving import make_server
+        server = make_server('127.0.0.1', port, app_module.app, threaded=True)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            requests.get(base_url + '/api/auth/status', timeout=1)
+            return base_url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    sys.exit('App server did not come up')
+
+
+# --- Baselines ---
+
+def baseline_path(name):
+    return name if name.endswith('.json') else os.path.join(BASELINE_DIR, f"{name}.json")
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def save_baseline(name, config, results):
+    path = baseline_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'created_at': datetime.now(timezone.utc).isoformat(timespec='seconds'), 'revision': git_revision(),
+                   'config': config, 'results': results}, f, ensure_ascii=False, indent=2, sort_keys=True)
+        f.write('\n')
+    print(f"Baseline saved to {path}")
+
+
+def compare(baseline, results, tolerance):
+    """Returns a list of regressions of `results` against a saved baseline."""
+    regressions = []
+    base_endpoints = baseline['results']['endpoints']
+    for name, current in results['endpoints'].items():
+        base = base_endpoints.get(name)
+        if base is None:
+            continue
+        keys = ('p50_ms', 'p95_ms', 'p99_ms') if min(base['count'], current['count']) >= MIN_COUNT_FOR_P99 else ('p50_ms', 'p95_ms')
+        for key in keys:
+            limit = base[key] * (1 + tolerance)
+            if current[key] > limit and current[key] - base[key] > MIN_LATENCY_REGRESSION_MS:
+                regressions.append(f"{name}: {key} {current[key]} > {base[key]} (+{(current[key] / base[key] - 1) * 100:.0f}%)")
+        if current['error_rate'] - base['error_rate'] > MIN_ERROR_RATE_REGRESSION:
+            regressions.append(f"{name}: error rate {current['error_rate']:.2%} > {base['error_rate']:.2%}")
+    base_rate = baseline['results']['journeys_per_second']
+    if base_rate and results['journeys_per_second'] < base_rate * (1 - tolerance):
+        regressions.append(f"throughput {results['journeys_per_second']} journeys/s < {base_rate}")
+    return regressions
+
+
+# --- Report ---
+
+def print_report(results, stand_ins):
+    print(f"\n{results['journeys']} journeys ({results['failed_journeys']} failed) in {results['wall_seconds']}s: "
+          f"{results['journeys_per_second']} journeys/s, {results['requests_per_second']} requests/s")
+    print(f"\n{'endpoint':<44}{'count':>7}{'req/s':>8}{'err':>6}{'4xx':>6}{'p50':>9}{'p90':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, row in results['endpoints'].items():
+        print(f"{name:<44}{row['count']:>7}{row['rps']:>8}{row['errors']:>6}{row['rejected']:>6}"
+              f"{row['p50_ms']:>9}{row['p90_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}{row['max_ms']:>9}")
+    print('(latencies in ms)')
+    calls = ', '.join(f"{name} {stand_ins.calls[name]} ({stand_ins.injected_errors[name]} failed)" for name in standins.SERVICES)
+    print(f"Upstream calls: {calls}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=10, help='concurrent virtual users')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run')
+    parser.add_argument('--journeys', type=int, help='stop after this many journeys instead')
+    parser.add_argument('--ramp-up', type=float, default=5, help='seconds over which the users start')
+    parser.add_argument('--think', type=float, default=0.5, help='mean pause between steps, seconds')
+    parser.add_argument('--polls', type=int, default=3, help='check-access polls per journey')
+    parser.add_argument('--turns', type=int, default=3, help='chat turns per journey')
+    parser.add_argument('--purchase-rate', type=float, default=0.5, help='share of journeys that top up and buy a session')
+    parser.add_argument('--voice-rate', type=float, default=0.3, help='share of turns sent as a voice message first')
+    parser.add_argument('--stream-rate', type=float, default=0.5, help='share of turns sent to /respond/stream')
+    parser.add_argument('--latency', help="upstream latency in seconds, e.g. 'metis=1.5,stt=2,sms=0.3,zarinpal=0.4'")
+    parser.add_argument('--jitter', type=float, default=0.5, help='latency varies uniformly by this fraction')
+    parser.add_argument('--errors', help="upstream error rates, e.g. 'metis=0.05,stt=0.1'")
+    parser.add_argument('--server', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save-baseline', metavar='NAME', help=f'write the results to {os.path.relpath(BASELINE_DIR, ROOT)}/NAME.json')
+    parser.add_argument('--compare', metavar='NAME', help='compare with a saved baseline; exit 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown before --compare fails')
+    parser.add_argument('--json', metavar='PATH', help='also write the results to PATH')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    stand_ins = standins.StandIns(standins.parse_behaviors(args.latency, args.errors, args.jitter)).start()
+    workdir = tempfile.mkdtemp(prefix='delyar_load_test_')
+    database_url = configure_app_environment(stand_ins, workdir, args)
+    app_module = load_app()
+    base_url = serve(app_module, args.server)
+
+    config = {key: value for key, value in vars(args).items() if key not in ('save_baseline', 'compare', 'json', 'verbose')}
+    config['database'] = database_url.split(':', 1)[0]
+    config['upstreams'] = {name: behavior._asdict() for name, behavior in stand_ins.behaviors.items()}
+    length = f"{args.journeys} journeys" if args.journeys else f"{args.duration:g}s"
+    print(f"{args.users} users for {length} against {args.server} on {config['database']}; stand-ins at {stand_ins.url}")
+
+    recorder = Recorder()
+    journey = Journey(args, base_url, stand_ins, recorder)
+    deadline = time.monotonic() + (args.duration if not args.journeys else float('inf'))
+    remaining = [args.journeys] if args.journeys else None
+    started = time.perf_counter()
+    users = [threading.Thread(target=journey.virtual_user, args=(i, deadline, remaining), daemon=True) for i in range(args.users)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    results = recorder.results(time.perf_counter() - started)
+
+    print_report(results, stand_ins)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'config': config, 'results': results}, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        save_baseline(args.save_baseline, config, results)
+    failed = False
+    if args.compare:
+        with open(baseline_path(args.compare), encoding='utf-8') as f:
+            baseline = json.load(f)
+        changed = sorted(key for key in config if baseline['config'].get(key) != config[key] and key != 'seed')
+        if changed:
+            print(f"Warning: run settings differ from the baseline's: {', '.join(changed)}")
+        regressions = compare(baseline, results, args.tolerance)
+        print(f"\nCompared with {args.compare} ({baseline.get('revision') or 'unknown revision'}, {baseline['created_at']}):")
+        for regression in regressions:
+            print(f"  REGRESSION {regression}")
+        if not regressions:
+            print(f"  no regressions beyond {args.tolerance:.0%}")
+        failed = bool(regressions)
+    stand_ins.stop()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+"""Local stand-ins for the backend's upstream services, for load tests.
+
+One threaded HTTP server on localhost plays all four:
+
+    /metis/...     MetisAI chat API (sessions, messages, streamed messages)
+    /stt/...       OpenAI-style audio transcription endpoint
+    /sms/send      Melipayamak shared-number send; the codes it "sends" can be read back
+    /zarinpal/...  Zarinpal WebGate: the WSDL plus PaymentRequest / PaymentVerification
+
+Every service has its own Behavior: a latency with jitter, and an error rate at which it
+answers with `error_status` instead. Point the app at `StandIns.env()` before importing it.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+SERVICES = ('metis', 'stt', 'sms', 'zarinpal')
+
+Behavior = namedtuple('Behavior', ['latency', 'jitter', 'error_rate', 'error_status'])
+Behavior.__new__.__defaults__ = (0.0, 0.5, 0.0, 503)
+
+# Typical production latencies, seconds
+DEFAULT_LATENCY = {'metis': 1.5, 'stt': 2.0, 'sms': 0.3, 'zarinpal': 0.4}
+
+CHAT_REPLY = "ممنونم که گفتی. بیشتر برام تعریف کن، از کی این حس رو داری و چه چیزی حالت رو بهتر می‌کنه؟"
+TRANSCRIPTION = "سلام، امروز حالم خیلی خوب نیست و دلم می‌خواد با یکی حرف بزنم."
+STREAM_CHUNKS = 8
+
+ZARINPAL_NS = 'http://zarinpal.com/'
+ZARINPAL_WSDL = """<?xml version="1.0" encoding="UTF-8"?>
+<definitions xmlns="http://schemas.xmlsoap.org/wsdl/" xmlns:soap="http://schemas.xmlsoap.org/wsdl/soap/"
+             xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:tns="{ns}" targetNamespace="{ns}">
+  <types>
+    <xsd:schema targetNamespace="{ns}" elementFormDefault="qualified">
+      <xsd:element name="PaymentRequest"><xsd:complexType><xsd:sequence>
+        <xsd:element name="MerchantID" type="xsd:string"/>
+        <xsd:element name="Amount" type="xsd:int"/>
+        <xsd:element name="Description" type="xsd:string"/>
+        <xsd:element name="Email" type="xsd:string" minOccurs="0" nillable="true"/>
+        <xsd:element name="Mobile" type="xsd:string" minOccurs="0" nillable="true"/>
+        <xsd:element name="CallbackURL" type="xsd:string"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="PaymentRequestResponse"><xsd:complexType><xsd:sequence>
+        <xsd:element name="Status" type="xsd:int"/>
+        <xsd:element name="Authority" type="xsd:string"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="PaymentVerification"><xsd:complexType><xsd:sequence>
+        <xsd:element name="MerchantID" type="xsd:string"/>
+        <xsd:element name="Authority" type="xsd:string"/>
+        <xsd:element name="Amount" type="xsd:int"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+      <xsd:element name="PaymentVerificationResponse"><xsd:complexType><xsd:sequence>
+        <xsd:element name="Status" type="xsd:int"/>
+        <xsd:element name="RefID" type="xsd:long"/>
+      </xsd:sequence></xsd:complexType></xsd:element>
+    </xsd:schema>
+  </types>
+  <message name="PaymentRequestIn"><part name="parameters" element="tns:PaymentRequest"/></message>
+  <message name="PaymentRequestOut"><part name="parameters" element="tns:PaymentRequestResponse"/></message>
+  <message name="PaymentVerificationIn"><part name="parameters" element="tns:PaymentVerification"/></message>
+  <message name="PaymentVerificationOut"><part name="parameters" element="tns:PaymentVerificationResponse"/></message>
+  <portType name="PaymentGatewayImplementationServicePortType">
+    <operation name="PaymentRequest"><input message="tns:PaymentRequestIn"/><output message="tns:PaymentRequestOut"/></operation>
+    <operation name="PaymentVerification"><input message="tns:PaymentVerificationIn"/><output message="tns:PaymentVerificationOut"/></operation>
+  </portType>
+  <binding name="PaymentGatewayImplementationServiceBinding" type="tns:PaymentGatewayImplementationServicePortType">
+    <soap:binding style="document" transport="http://schemas.xmlsoap.org/soap/http"/>
+    <operation name="PaymentRequest">
+      <soap:operation soapAction="#PaymentRequest"/>
+      <input><soap:body use="literal"/></input><output><soap:body use="literal"/></output>
+    </operation>
+    <operation name="PaymentVerification">
+      <soap:operation soapAction="#PaymentVerification"/>
+      <input><soap:body use="literal"/></input><output><soap:body use="literal"/></output>
+    </operation>
+  </binding>
+  <service name="PaymentGatewayImplementationService">
+    <port name="PaymentGatewayImplementationServicePort" binding="tns:PaymentGatewayImplementationServiceBinding">
+      <soap:address location="{location}"/>
+    </port>
+  </service>
+</definitions>
+"""
+SOAP_RESPONSE = ('<?xml version="1.0" encoding="UTF-8"?>'
+                 '<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:ns1="{ns}">'
+                 '<SOAP-ENV:Body><ns1:{operation}Response>{fields}</ns1:{operation}Response></SOAP-ENV:Body>'
+                 '</SOAP-ENV:Envelope>')
+
+
+def parse_behaviors(latency=None, errors=None, jitter=0.5):
+    """Builds {service: Behavior} from 'metis=1.5,stt=2' style latency and error-rate specs."""
+    latencies = {**DEFAULT_LATENCY, **_parse_spec(latency)}
+    error_rates = _parse_spec(errors)
+    return {name: Behavior(latencies[name], jitter, error_rates.get(name, 0.0)) for name in SERVICES}
+
+
+def _parse_spec(spec):
+    values = {}
+    for item in (spec or '').split(','):
+        name, _, value = item.partition('=')
+        if not name.strip():
+            continue
+        if name.strip() not in SERVICES:
+            raise ValueError(f"Unknown service {name.strip()!r}; expected one of {', '.join(SERVICES)}")
+        values[name.strip()] = float(value)
+    return values
+
+
+class SmsInbox:
+    """The last code "sent" to each phone number."""
+
+    def __init__(self):
+        self._codes = {}
+        self._changed = threading.Condition()
+
+    def deliver(self, phone_number, code):
+        with self._changed:
+            self._codes[phone_number] = code
+            self._changed.notify_all()
+
+    def wait_for_code(self, phone_number, timeout=10):
+        """Pops the phone's code, waiting up to `timeout` seconds for the dispatcher to send it."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while phone_number not in self._codes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+            return self._codes.pop(phone_number)
+
+
+class StandIns:
+    def __init__(self, behaviors, host='127.0.0.1', port=0):
+        self.behaviors = behaviors
+        self.sms = SmsInbox()
+        self.sessions = {} # MetisAI session id -> session dict
+        self.payments = {} # Zarinpal authority -> {'amount': ..., 'verified': bool}
+        self.calls = {name: 0 for name in SERVICES}
+        self.injected_errors = {name: 0 for name in SERVICES}
+        self._lock = threading.Lock()
+        self._authorities = 0
+        self.server = ThreadingHTTPServer((host, port), _handler_for(self))
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='standins', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def env(self):
+        """Environment variables that point the app at these stand-ins."""
+        return {
+            'CHATBOT_URL': f"{self.url}/metis",
+            'CHATBOT_TOKEN': 'bench-token',
+            'BOT_ID': 'bench-bot',
+            'API_KEY': 'bench-stt-key',
+            'STT_API_URL': f"{self.url}/stt/audio/transcriptions",
+            'MELIPAYAMAK_SEND_URL': f"{self.url}/sms/send",
+            'MELIPAYAMAK_USERNAME': 'bench',
+            'MELIPAYAMAK_PASSWORD': 'bench',
+            'MELIPAYAMAK_TEMPLATE': '1',
+            'MMERCHANT_ID': 'bench-merchant-0000-0000-000000000000',
+            'ZARINPAL_WEBSERVICE': f"{self.url}/zarinpal/wsdl",
+            'ZARINPAL_STARTPAY_URL': f"{self.url}/zarinpal/startpay/",
+        }
+
+    # --- Behavior ---
+
+    def delay(self, service, fraction=1.0):
+        behavior = self.behaviors[service]
+        if behavior.latency > 0:
+            spread = behavior.latency * behavior.jitter
+            time.sleep(max(0.0, random.uniform(behavior.latency - spread, behavior.latency + spread)) * fraction)
+
+    def inject_error(self, service):
+        """Counts the call; returns the status to fail it with, or None."""
+        behavior = self.behaviors[service]
+        with self._lock:
+            self.calls[service] += 1
+            if behavior.error_rate and random.random() < behavior.error_rate:
+                self.injected_errors[service] += 1
+                return behavior.error_status
+        return None
+
+    # --- MetisAI ---
+
+    def create_session(self, body):
+        session_id = str(uuid.uuid4())
+        now = _timestamp()
+        session = {'id': session_id, 'botId': body.get('botId'), 'user': body.get('user') or {}, 'title': None,
+                   'createdAt': now, 'updatedAt': now,
+                   'messages': [{**m, 'timestamp': now} for m in body.get('initialMessages') or []]}
+        with self._lock:
+            self.sessions[session_id] = session
+        return session
+
+    def add_exchange(self, session_id, body):
+        """Appends the user's message and the canned reply; returns the reply, or None for an unknown session."""
+        message = (body.get('message') or {})
+        reply = {'type': 'AI', 'content': CHAT_REPLY, 'timestamp': _timestamp()}
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            session['messages'].append({'type': 'USER', 'content': message.get('content', ''), 'timestamp': _timestamp()})
+            session['messages'].append(reply)
+            session['updatedAt'] = reply['timestamp']
+        return reply
+
+    def list_sessions(self, user_id, page, size):
+        with self._lock:
+            sessions = [s for s in self.sessions.values() if s['user'].get('id') == user_id]
+        sessions.sort(key=lambda s: s['updatedAt'], reverse=True)
+        return [{key: s[key] for key in ('id', 'title', 'createdAt', 'updatedAt')}
+                for s in sessions[page * size:(page + 1) * size]]
+
+    # --- Zarinpal ---
+
+    def payment_request(self, amount):
+        with self._lock:
+            self._authorities += 1
+            authority = f"A{self._authorities:035d}"
+            self.payments[authority] = {'amount': amount, 'verified': False}
+        return authority
+
+    def payment_verification(self, authority, amount):
+        """Returns (status, ref_id) the way Zarinpal does: 100, then 101 for repeats, -21 if unknown."""
+        with self._lock:
+            payment = self.payments.get(authority)
+            if payment is None or payment['amount'] != amount:
+                return -21, 0
+            status = 101 if payment['verified'] else 100
+            payment['verified'] = True
+        return status, int(authority[1:]) + 10 ** 9
+
+
+def _timestamp():
+    return datetime.now(timezone.utc).isoformat(timespec='milliseconds')
+
+
+def _xml_field(body, name):
+    match = re.search(rf'<(?:\w+:)?{name}>([^<]*)</(?:\w+:)?{name}>', body)
+    return match.group(1) if match else None
+
+
+def _handler_for(standins):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # Keep-alive, like the real services
+
+        def log_message(self, format, *args):
+            pass
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            return self.rfile.read(length) if length else b''
+
+        def _send(self, status, body=b'', content_type='application/json'):
+            if not isinstance(body, bytes):
+                body = (body if isinstance(body, str) else json.dumps(body, ensure_ascii=False)).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _fail(self, service):
+            status = standins.inject_error(service)
+            if status is None:
+                return False
+            standins.delay(service, 0.5) # Errors tend to come back faster than answers
+            self._send(status, {'error': 'injected failure'})
+            return True
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == '/zarinpal/wsdl':
+                location = f"{standins.url}/zarinpal/soap"
+                self._send(200, ZARINPAL_WSDL.format(ns=ZARINPAL_NS, location=location), 'text/xml; charset=utf-8')
+            elif url.path == '/metis/chat/session':
+                if self._fail('metis'):
+                    return
+                standins.delay('metis', 0.3)
+                self._send(200, standins.list_sessions(query.get('userId'), int(query.get('page', 0)), int(query.get('size', 10))))
+            elif url.path.startswith('/metis/chat/session/'):
+                if self._fail('metis'):
+                    return
+                standins.delay('metis', 0.3)
+                session = standins.sessions.get(url.path.rsplit('/', 1)[1])
+                if session is None:
+                    self._send(404, {'error': 'Session not found'})
+                else:
+                    self._send(200, session)
+            else:
+                self._send(404, {'error': 'Not found'})
+
+        def do_POST(self):
+            path = urlsplit(self.path).path
+            body = self._body()
+            if path == '/sms/send':
+                self._sms(body)
+            elif path == '/stt/audio/transcriptions':
+                if not self._fail('stt'):
+                    standins.delay('stt')
+                    self._send(200, {'text': TRANSCRIPTION})
+            elif path == '/zarinpal/soap':
+                self._zarinpal(body.decode('utf-8', errors='replace'))
+            elif path == '/metis/chat/session':
+                if not self._fail('metis'):
+                    standins.delay('metis', 0.3)
+                    self._send(200, standins.create_session(json.loads(body or b'{}')))
+            elif re.fullmatch(r'/metis/chat/session/[^/]+/message(/stream)?', path):
+                self._chat(path, json.loads(body or b'{}'))
+            else:
+                self._send(404, {'error': 'Not found'})
+
+        def _sms(self, body):
+            if self._fail('sms'):
+                return
+            standins.delay('sms')
+            form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+            standins.sms.deliver(form.get('to'), form.get('text'))
+            self._send(200, {'Value': str(random.randint(10 ** 9, 10 ** 10)), 'RetStatus': 1, 'StrRetStatus': 'Ok'})
+
+        def _zarinpal(self, body):
+            if self._fail('zarinpal'):
+                return
+            standins.delay('zarinpal')
+            if 'PaymentVerification' in self.headers.get('SOAPAction', ''):
+                status, ref_id = standins.payment_verification(_xml_field(body, 'Authority'), int(_xml_field(body, 'Amount') or 0))
+                operation, fields = 'PaymentVerification', f"<ns1:Status>{status}</ns1:Status><ns1:RefID>{ref_id}</ns1:RefID>"
+            else:
+                authority = standins.payment_request(int(_xml_field(body, 'Amount') or 0))
+                operation, fields = 'PaymentRequest', f"<ns1:Status>100</ns1:Status><ns1:Authority>{authority}</ns1:Authority>"
+            self._send(200, SOAP_RESPONSE.format(ns=ZARINPAL_NS, operation=operation, fields=fields), 'text/xml; charset=utf-8')
+
+        def _chat(self, path, body):
+            if self._fail('metis'):
+                return
+            session_id = path.split('/')[4]
+            streamed = path.endswith('/stream')
+            if not streamed:
+                standins.delay('metis')
+                reply = standins.add_exchange(session_id, body)
+                if reply is None:
+                    self._send(404, {'error': 'Session not found'})
+                else:
+                    self._send(200, reply)
+                return
+            # Streamed: the first token after a third of the latency, the rest spread over the remainder
+            standins.delay('metis', 1 / 3)
+            reply = standins.add_exchange(session_id, body)
+            if reply is None:
+                self._send(404, {'error': 'Session not found'})
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            words = reply['content'].split(' ')
+            step = max(1, len(words) // STREAM_CHUNKS)
+            for i in range(0, len(words), step):
+                chunk = ' '.join(words[i:i + step]) + (' ' if i + step < len(words) else '')
+                self._write_chunk(f"data: {json.dumps({'content': chunk}, ensure_ascii=False)}\n\n".encode())
+                standins.delay('metis', 2 / 3 / STREAM_CHUNKS)
+            self._write_chunk(b"data: [DONE]\n\n")
+            self._write_chunk(b'')
+
+        def _write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    return Handler
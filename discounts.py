@@ -0,0 +1,159 @@
+"""Discount codes stored in the database, with a cached lookup and batched usage counters.
+
+Checkout reads codes through a small per-process TTL cache (misses are cached too, so
+guessing codes doesn't reach the database), and editing a code through the admin endpoint
+drops it from this process's cache right away; other nodes pick the change up within
+DISCOUNT_CACHE_TTL. Redemptions are counted in memory and added to the code's row by a
+background flush every DISCOUNT_FLUSH_INTERVAL seconds, one UPDATE per code per flush, so a
+campaign sending thousands of checkouts to one code doesn't queue them all on its row lock.
+
+Usage caps therefore are soft: each node checks the flushed count plus its own unflushed
+uses, so a busy code can overshoot its cap by what other nodes redeemed since their last flush.
+"""
+import atexit
+import os
+import threading
+import time
+import logging
+from collections import Counter, namedtuple
+from datetime import datetime
+
+from sqlalchemy import select, update
+
+from caching import TTLCache
+
+logger = logging.getLogger(__name__)
+
+DISCOUNT_CACHE_TTL = float(os.getenv('DISCOUNT_CACHE_TTL', 30))
+DISCOUNT_CACHE_SIZE = int(os.getenv('DISCOUNT_CACHE_SIZE', 1000))
+DISCOUNT_FLUSH_INTERVAL = float(os.getenv('DISCOUNT_FLUSH_INTERVAL', 5))
+
+DiscountOffer = namedtuple('DiscountOffer', ['code', 'percent', 'active', 'starts_at', 'ends_at', 'max_uses', 'used_count'])
+
+_NOT_FOUND = 'not-found' # Cached for unknown codes
+
+
+def normalize_code(code):
+    return code.strip().lower() if isinstance(code, str) else None
+
+
+class DiscountCodes:
+    def __init__(self, db, model):
+        self.app = None # Bound by init_app()
+        self.db = db
+        self.table = model.__table__
+        self._cache = TTLCache(DISCOUNT_CACHE_SIZE, DISCOUNT_CACHE_TTL)
+        self._uses = Counter() # code -> redemptions not yet flushed
+        self._discounts = Counter() # code -> Rials discounted, not yet flushed
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+
+    # --- Lookup ---
+
+    def lookup(self, code):
+        """The code's offer as last read from the database, or None if there is no such code."""
+        code = normalize_code(code)
+        if not code:
+            return None
+        offer = self._cache.get(code)
+        if offer is None:
+            table = self.table
+            with self.db.engine.connect() as conn:
+                row = conn.execute(select(
+                    table.c.code, table.c.percent, table.c.active, table.c.starts_at,
+                    table.c.ends_at, table.c.max_uses, table.c.used_count,
+                ).where(table.c.code == code)).first()
+            offer = DiscountOffer(*row) if row else _NOT_FOUND
+            self._cache.set(code, offer)
+        return None if offer is _NOT_FOUND else offer
+
+    def redeemable(self, code, now=None):
+        """The offer if the code exists, is active, inside its window and under its cap; otherwise None."""
+        offer = self.lookup(code)
+        if offer is None or not offer.active:
+            return None
+        now = now or datetime.utcnow()
+        if (offer.starts_at and now < offer.starts_at) or (offer.ends_at and now >= offer.ends_at):
+            return None
+        if offer.max_uses is not None:
+            with self._lock:
+                unflushed = self._uses[offer.code]
+            if offer.used_count + unflushed >= offer.max_uses:
+                return None
+        return offer
+
+    def invalidate(self, code=None):
+        if code is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(normalize_code(code))
+
+    # --- Usage counters ---
+
+    def record_use(self, code, discount_amount):
+        """Counts one redemption; written to the database by the next flush."""
+        code = normalize_code(code)
+        if not code:
+            return
+        with self._lock:
+            self._uses[code] += 1
+            self._discounts[code] += discount_amount
+            if self._thread is None: # Started on first use so forked workers get their own thread
+                self._thread = threading.Thread(target=self._run, name='discount-flusher', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def flush(self):
+        """Adds the buffered counts to their rows in one transaction; returns the number of codes written."""
+        with self._lock:
+            uses, discounts = self._uses, self._discounts
+            self._uses, self._discounts = Counter(), Counter()
+        if not uses:
+            return 0
+        table = self.table
+        now = datetime.utcnow()
+        try:
+            with self.app.app_context():
+                with self.db.engine.begin() as conn:
+                    for code in sorted(uses): # Fixed order, so concurrent flushes from other nodes can't deadlock
+                        conn.execute(update(table).where(table.c.code == code).values(
+                            used_count=table.c.used_count + uses[code],
+                            discount_total=table.c.discount_total + discounts[code],
+                            last_used_at=now,
+                        ))
+        except Exception:
+            with self._lock: # Keep the counts for the next attempt
+                self._uses.update(uses)
+                self._discounts.update(discounts)
+            raise
+        for code in uses:
+            self._cache.pop(code) # Re-read so the cap check sees the flushed total
+        return len(uses)
+
+    def _run(self):
+        while True:
+            time.sleep(DISCOUNT_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Discount usage flush failed: %s", e, exc_info=True)
+
+    # --- Seeding ---
+
+    def seed(self, percents):
+        """Inserts {code: percent} entries that don't exist yet; returns how many were added."""
+        table = self.table
+        now = datetime.utcnow()
+        rows = [{'code': normalize_code(code), 'percent': percent, 'active': True, 'used_count': 0,
+                 'discount_total': 0, 'created_at': now, 'updated_at': now} for code, percent in percents.items()]
+        with self.db.engine.begin() as conn:
+            if conn.dialect.name == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            added = conn.execute(insert(table).values(rows).on_conflict_do_nothing(index_elements=[table.c.code])).rowcount
+        self.invalidate()
+        return added
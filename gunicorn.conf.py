@@ -0,0 +1,29 @@
+"""gunicorn settings for the Delyar backend:
+
+    flask --app app init-db   # once per deploy: creates missing tables and seeds
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is built and warmed up once in the master (preload_app + app.preload()), and workers
+are forked from it, so a worker added while scaling out starts serving right away instead of
+repeating the imports, the engine setup and the WSDL parse.
+
+This deployment sits behind nginx, so the app trusts one X-Forwarded-For hop
+(TRUSTED_PROXY_HOPS, default 1 here; match it to the number of proxies in front). Don't
+expose the gunicorn port directly, or clients could forge their address.
+"""
+import os
+
+# Read by app.py when the master preloads it, which happens after this file is loaded
+os.environ.setdefault('TRUSTED_PROXY_HOPS', '1')
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', 4))
+threads = int(os.getenv('GUNICORN_THREADS', 32)) # Views mostly wait on MetisAI, STT and the database
+worker_class = 'gthread'
+timeout = 120 # Above the 90 s chat timeout
+preload_app = True
+
+
+def when_ready(server):
+    import app
+    app.preload()
@@ -0,0 +1,174 @@
+"""Non-blocking, structured logging.
+
+Request threads only build the log record and put it on a bounded in-memory queue; a
+background listener thread serializes it (JSON by default, one object per line) and does
+the I/O. When the queue is full the record is dropped and counted instead of making the
+request wait on a slow disk or pipe. Messages use %-style arguments, so a record below
+its logger's level is never formatted at all.
+
+Levels are set per subsystem: LOG_LEVEL for everything, LOG_LEVELS to override single
+loggers, e.g. `LOG_LEVELS=upstream=DEBUG,delyar.requests=WARNING`. Payloads (upstream
+responses, request bodies) go through payload(), which truncates them to LOG_MAX_FIELD_CHARS
+only when the record is actually emitted.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+from datetime import datetime, timezone
+
+import metrics
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '') # Comma-separated logger=LEVEL overrides
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json') # 'json' or 'text'
+LOG_FILE = os.getenv('LOG_FILE') # Defaults to stderr
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000)) # Records waiting for the writer
+LOG_MAX_FIELD_CHARS = int(os.getenv('LOG_MAX_FIELD_CHARS', 500)) # Per payload() argument
+LOG_MAX_MESSAGE_CHARS = int(os.getenv('LOG_MAX_MESSAGE_CHARS', 4000)) # Whole message, after formatting
+
+# Chatty third-party loggers that DEBUG on the root would otherwise turn on
+DEFAULT_LEVELS = {'urllib3': 'WARNING', 'suds': 'INFO', 'sqlalchemy.engine': 'WARNING', 'werkzeug': 'INFO'}
+
+# Attributes every LogRecord has; anything else came in through `extra=`
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+metrics.registry.define(metrics.COUNTER, 'log_records_dropped_total', 'Log records dropped because the writer queue was full')
+
+
+def truncate(text, limit=LOG_MAX_FIELD_CHARS):
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}... [{len(text) - limit} more chars]"
+
+
+class payload:
+    """Wraps a log argument so it is rendered (JSON where possible) and truncated only when emitted.
+
+    `logger.debug("MetisAI replied: %s", logs.payload(response_data))`
+    """
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=LOG_MAX_FIELD_CHARS):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        value = self.value
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', errors='replace')
+        if not isinstance(value, str):
+            try:
+                value = json.dumps(value, ensure_ascii=False, default=str)
+            except (TypeError, ValueError):
+                value = repr(value)
+        return truncate(value, self.limit)
+
+    __repr__ = __str__
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per record: ts, level, logger, msg, fields passed via `extra=`, and exc."""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': truncate(record.getMessage(), LOG_MAX_MESSAGE_CHARS),
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s [%(threadName)s] %(message)s')
+
+    def formatMessage(self, record):
+        record.message = truncate(record.message, LOG_MAX_MESSAGE_CHARS)
+        return super().formatMessage(record)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that never blocks: when the queue is full, the record is counted and dropped."""
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.registry.inc('log_records_dropped_total')
+
+    def prepare(self, record):
+        # Merge the arguments now, while they still hold their values; JSON and I/O happen on the writer
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None # Don't keep the traceback's frames alive in the queue
+        return record
+
+
+_listener = None
+_lock = threading.Lock()
+
+
+def parse_levels(spec):
+    """'upstream=DEBUG, suds=WARNING' -> {'upstream': 'DEBUG', 'suds': 'WARNING'}"""
+    levels = {}
+    for item in spec.split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def _start_listener(handler):
+    global _listener
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    handler.queue = records
+    if LOG_FILE:
+        writer = logging.handlers.WatchedFileHandler(LOG_FILE, encoding='utf-8')
+    else:
+        writer = logging.StreamHandler(sys.stderr)
+    writer.setFormatter(JSONFormatter() if LOG_FORMAT == 'json' else TextFormatter())
+    _listener = logging.handlers.QueueListener(records, writer, respect_handler_level=False)
+    _listener.start()
+
+
+def configure():
+    """Routes the root logger through the queue and applies the levels. Safe to call more than once."""
+    with _lock:
+        if _listener is not None:
+            return
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        handler = DroppingQueueHandler(None)
+        _start_listener(handler)
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        for name, level in {**DEFAULT_LEVELS, **parse_levels(LOG_LEVELS)}.items():
+            logging.getLogger(name).setLevel(level)
+        atexit.register(shutdown)
+        # A forked worker inherits the queue but not the writer thread; give it both anew
+        os.register_at_fork(after_in_child=lambda: _start_listener(handler))
+
+
+def shutdown():
+    """Writes out whatever is still queued."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
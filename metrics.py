@@ -0,0 +1,362 @@
+"""In-process latency histograms, counters and gauges, exposed in Prometheus text format.
+
+Recording is lock-light: every thread writes to its own shard, guarded by a lock only that
+thread and the (rare) scrape ever take, so request threads never contend with each other.
+A scrape merges all shards. Shards of exited threads are folded into one retired shard, so
+thread-per-request servers don't grow the shard list without bound. Gauges are kept as +1/-1 counters and summed the same way, so
+a slot taken on one thread and released on another still adds up.
+
+Request timings are started by TimingMiddleware and carried on the WSGI environ, so that
+asgi.py can close them after a deferred upstream call. Database queries, upstream calls and
+tagged phases are attributed to the request bound to the current thread.
+"""
+import bisect
+import functools
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Seconds; spans fast DB-only endpoints up to the 90 s chat timeout
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+SHARD_FOLD_MIN = 64 # Exited threads' shards are folded away once at least this many exist
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+
+class _Shard:
+    def __init__(self, thread=None):
+        self.thread = thread # Owning thread; None for the registry's retired aggregate
+        self.lock = threading.Lock()
+        self.values = defaultdict(float) # (name, labels) -> counter or gauge total
+        self.histograms = {} # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+
+class Registry:
+    def __init__(self):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard() # Totals of threads that have exited
+        self._fold_at = SHARD_FOLD_MIN
+        self._lock = threading.Lock()
+        self._metrics = {} # name -> (type, help, label names, buckets)
+
+    def define(self, kind, name, help_text, labels=(), buckets=None):
+        self._metrics[name] = (kind, help_text, tuple(labels), tuple(buckets) if buckets else None)
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+                # Thread-per-request servers would otherwise leave one shard behind per request
+                if len(self._shards) >= self._fold_at:
+                    self._retire_dead_shards()
+        return shard
+
+    def _retire_dead_shards(self):
+        """Folds the shards of exited threads into the retired aggregate. Call with self._lock held."""
+        live = []
+        retired = self._retired
+        for shard in self._shards:
+            if shard.thread.is_alive():
+                live.append(shard)
+                continue
+            with shard.lock, retired.lock:
+                for key, value in shard.values.items():
+                    retired.values[key] += value
+                for key, series in shard.histograms.items():
+                    total = retired.histograms.get(key)
+                    retired.histograms[key] = list(series) if total is None else [a + b for a, b in zip(total, series)]
+        self._shards = live
+        self._fold_at = max(SHARD_FOLD_MIN, 2 * len(live)) # Amortized: a fold at most every len(live) new threads
+
+    # --- Recording ---
+
+    def inc(self, name, *labels, amount=1):
+        shard = self._shard()
+        with shard.lock:
+            shard.values[(name, labels)] += amount
+
+    def observe(self, name, value, *labels):
+        buckets = self._metrics[name][3]
+        shard = self._shard()
+        key = (name, labels)
+        with shard.lock:
+            series = shard.histograms.get(key)
+            if series is None:
+                series = shard.histograms[key] = [0] * (len(buckets) + 2)
+            series[bisect.bisect_left(buckets, value)] += 1
+            series[-1] += value
+
+    # --- Reading ---
+
+    def collect(self):
+        """Merged {name: {labels: value or histogram list}} across all threads."""
+        with self._lock:
+            self._retire_dead_shards()
+            shards = [self._retired, *self._shards]
+        merged = defaultdict(dict)
+        for shard in shards:
+            with shard.lock:
+                values = list(shard.values.items())
+                histograms = [(key, list(series)) for key, series in shard.histograms.items()]
+            for (name, labels), value in values:
+                merged[name][labels] = merged[name].get(labels, 0) + value
+            for (name, labels), series in histograms:
+                total = merged[name].get(labels)
+                merged[name][labels] = series if total is None else [a + b for a, b in zip(total, series)]
+        return merged
+
+    def render_prometheus(self):
+        merged = self.collect()
+        lines = []
+        for name, (kind, help_text, label_names, buckets) in sorted(self._metrics.items()):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(merged.get(name, {}).items()):
+                if kind != HISTOGRAM:
+                    lines.append(f"{name}{_labels(label_names, labels)} {_number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else _number(bound)
+                    lines.append(f"{name}_bucket{_labels(label_names + ('le',), labels + (le,))} {cumulative}")
+                lines.append(f"{name}_sum{_labels(label_names, labels)} {_number(value[-1])}")
+                lines.append(f"{name}_count{_labels(label_names, labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Human-readable view: counters and gauges as numbers, histograms as count/mean/p50/p95/p99."""
+        merged = self.collect()
+        result = {}
+        for name, (kind, _, label_names, buckets) in sorted(self._metrics.items()):
+            series = []
+            for labels, value in sorted(merged.get(name, {}).items()):
+                entry = dict(zip(label_names, labels))
+                if kind == HISTOGRAM:
+                    count = sum(value[:-1])
+                    entry.update(count=count, mean=round(value[-1] / count, 4) if count else None,
+                                 p50=percentile(buckets, value, 0.5), p95=percentile(buckets, value, 0.95),
+                                 p99=percentile(buckets, value, 0.99))
+                else:
+                    entry['value'] = value
+                series.append(entry)
+            result[name] = series
+        return result
+
+
+def percentile(buckets, series, fraction):
+    """Estimates a percentile from bucket counts by interpolating inside the bucket."""
+    counts = series[:-1]
+    total = sum(counts)
+    if not total:
+        return None
+    rank = fraction * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            if i >= len(buckets): # Beyond the last bound; report the bound
+                return buckets[-1]
+            lower = buckets[i - 1] if i else 0
+            return round(lower + (buckets[i] - lower) * (rank - seen) / count, 4)
+        seen += count
+    return buckets[-1]
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+registry = Registry()
+registry.define(HISTOGRAM, 'http_request_duration_seconds', 'Flask request latency, including deferred upstream calls',
+                ('endpoint', 'method', 'status'), LATENCY_BUCKETS)
+registry.define(GAUGE, 'http_requests_in_flight', 'Requests being handled', ('endpoint',))
+registry.define(HISTOGRAM, 'http_request_db_queries', 'Database queries issued per request', ('endpoint',), QUERY_COUNT_BUCKETS)
+registry.define(COUNTER, 'db_queries_total', 'Database queries, by whether a request view issued them (other: session I/O, background workers)', ('scope',))
+registry.define(HISTOGRAM, 'upstream_request_duration_seconds', 'Upstream call latency per attempt (time to headers for streams)',
+                ('operation', 'outcome'), LATENCY_BUCKETS)
+registry.define(GAUGE, 'upstream_requests_in_flight', 'Upstream calls waiting for a response', ('operation',))
+registry.define(COUNTER, 'upstream_circuit_rejections_total', 'Upstream calls failed fast by an open circuit breaker', ('operation',))
+
+
+# --- Requests ---
+
+_current = threading.local()
+
+
+class RequestTiming:
+    """Latency, query count and named phase durations of one request.
+
+    Phases are summed per name and may overlap (a session load also counts as db time).
+    """
+
+    def __init__(self, method):
+        self.endpoint = 'unmatched'
+        self.method = method
+        self.status = None
+        self.queries = 0
+        self.phases = defaultdict(float) # name -> seconds
+        self.started = time.perf_counter()
+        self.routed = False
+        self.finished = False
+
+    def route(self, endpoint):
+        """Called once Flask has matched the URL; from here the request counts as in flight."""
+        self.endpoint = endpoint or 'unmatched'
+        self.routed = True
+        registry.inc('http_requests_in_flight', self.endpoint)
+
+    def add(self, phase, seconds):
+        self.phases[phase] += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        """Server-Timing header value: each phase plus the total so far, in milliseconds."""
+        parts = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in sorted(self.phases.items())]
+        parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ', '.join(parts)
+
+    def finish(self, status=None):
+        """Records the request; returns a compact summary dict, or None if it was already finished."""
+        if self.finished:
+            return None
+        self.finished = True
+        elapsed = self.elapsed()
+        status = str(status or self.status or 500)
+        if self.routed:
+            registry.inc('http_requests_in_flight', self.endpoint, amount=-1)
+        registry.observe('http_request_duration_seconds', elapsed, self.endpoint, self.method, status)
+        registry.observe('http_request_db_queries', self.queries, self.endpoint)
+        return {
+            'endpoint': self.endpoint,
+            'method': self.method,
+            'status': int(status),
+            'ms': round(elapsed * 1000, 1),
+            'queries': self.queries,
+            'phases': {name: round(seconds * 1000, 1) for name, seconds in sorted(self.phases.items())},
+        }
+
+
+def bind(timing):
+    """Attributes this thread's queries and phases to `timing` (None to unbind)."""
+    _current.timing = timing
+
+
+def current():
+    return getattr(_current, 'timing', None)
+
+
+@contextmanager
+def phase(name, timing=None):
+    """Adds the time spent in the block to the bound request's `name` phase; no-op outside a request."""
+    timing = timing or current()
+    if timing is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.add(name, time.perf_counter() - started)
+
+
+def timed_phase(name):
+    """Decorator form of phase()."""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def query_started(conn, cursor, statement, parameters, context, executemany):
+    """SQLAlchemy before_cursor_execute listener."""
+    timing = current()
+    if timing is None:
+        registry.inc('db_queries_total', 'other')
+        return
+    timing.queries += 1
+    registry.inc('db_queries_total', 'request')
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def query_finished(conn, cursor, statement, parameters, context, executemany):
+    """SQLAlchemy after_cursor_execute listener."""
+    started = conn.info.get('query_started')
+    timing = current()
+    if started and timing is not None:
+        timing.add('db', time.perf_counter() - started.pop())
+
+
+class TimingMiddleware:
+    """WSGI middleware that starts each request's RequestTiming before Flask opens the session.
+
+    The timing is left on the environ under `environ_key` and bound to the thread; the app
+    finishes it (or asgi.py, after a deferred upstream call). Responses get a Server-Timing header.
+    """
+
+    def __init__(self, wsgi_app, environ_key):
+        self.wsgi_app = wsgi_app
+        self.environ_key = environ_key
+
+    def __call__(self, environ, start_response):
+        timing = RequestTiming(environ.get('REQUEST_METHOD', 'GET'))
+        environ[self.environ_key] = timing
+        bind(timing)
+
+        def timed_start_response(status, headers, exc_info=None):
+            # Called after the view, after_request hooks and the session save
+            return start_response(status, headers + [('Server-Timing', timing.server_timing())], exc_info)
+
+        return self.wsgi_app(environ, timed_start_response)
+
+
+# --- Upstream calls ---
+
+def outcome_for(status_code=None, error=None):
+    if error is not None:
+        return error.__class__.__name__
+    return f"{status_code // 100}xx"
+
+
+class UpstreamTimer:
+    """Times one upstream attempt: `with UpstreamTimer(op) as t: ...; t.outcome = outcome_for(...)`.
+
+    The time is also added to the request's 'upstream' phase (the thread's bound request unless given).
+    """
+
+    def __init__(self, operation, timing=None):
+        self.operation = operation
+        self.outcome = None
+        self.timing = timing or current()
+
+    def __enter__(self):
+        registry.inc('upstream_requests_in_flight', self.operation)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.started
+        registry.inc('upstream_requests_in_flight', self.operation, amount=-1)
+        if self.timing is not None:
+            self.timing.add('upstream', elapsed)
+        outcome = self.outcome or (outcome_for(error=exc) if exc is not None else 'unknown')
+        registry.observe('upstream_request_duration_seconds', elapsed, self.operation, outcome)
+        return False
@@ -0,0 +1,185 @@
+"""One-time-password subsystem: storage, rate limiting and background SMS dispatch.
+
+OTPs live in their own table keyed by phone number (not in the cookie session), so any app
+node can verify them. Each row also carries the phone's token bucket, updated under a row
+lock, which throttles repeated sends across all nodes. Per-IP buckets are kept in memory
+per process. SMS sends go onto a bounded queue drained by a small worker pool, so
+request_otp returns without waiting on the SMS provider.
+"""
+import os
+import hmac
+import hashlib
+import queue
+import secrets
+import string
+import threading
+import logging
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+import logs
+
+logger = logging.getLogger(__name__)
+
+OTP_LENGTH = 4
+OTP_TTL_SECONDS = int(os.getenv('OTP_TTL_SECONDS', 20 * 60))
+OTP_MAX_ATTEMPTS = int(os.getenv('OTP_MAX_ATTEMPTS', 5))
+# Token buckets: `capacity` sends in a burst, then one more every `refill` seconds
+OTP_PHONE_BUCKET_CAPACITY = int(os.getenv('OTP_PHONE_BUCKET_CAPACITY', 3))
+OTP_PHONE_REFILL_SECONDS = int(os.getenv('OTP_PHONE_REFILL_SECONDS', 120))
+OTP_IP_BUCKET_CAPACITY = int(os.getenv('OTP_IP_BUCKET_CAPACITY', 10))
+OTP_IP_REFILL_SECONDS = int(os.getenv('OTP_IP_REFILL_SECONDS', 30))
+OTP_IP_BUCKETS_MAX = 100000 # Oldest idle IP buckets are dropped beyond this
+SMS_DISPATCH_WORKERS = int(os.getenv('SMS_DISPATCH_WORKERS', 4))
+SMS_DISPATCH_QUEUE_SIZE = int(os.getenv('SMS_DISPATCH_QUEUE_SIZE', 1000))
+
+# verify() outcomes
+VERIFIED = 'verified'
+INVALID = 'invalid'
+EXPIRED = 'expired'
+MISSING = 'missing'
+LOCKED = 'locked'
+
+
+def refill_tokens(tokens, updated_at, now, capacity, refill_seconds):
+    """Returns the bucket level at `now` after refilling since `updated_at`."""
+    elapsed = (now - updated_at).total_seconds()
+    return min(capacity, tokens + elapsed / refill_seconds)
+
+
+def seconds_until_token(tokens, refill_seconds):
+    return max(1, int((1 - tokens) * refill_seconds) + 1)
+
+
+class IpRateLimiter:
+    """In-process token buckets keyed by client IP."""
+
+    def __init__(self, capacity=OTP_IP_BUCKET_CAPACITY, refill_seconds=OTP_IP_REFILL_SECONDS):
+        self.capacity = capacity
+        self.refill_seconds = refill_seconds
+        self._buckets = OrderedDict() # ip -> (tokens, updated_at)
+        self._lock = threading.Lock()
+
+    def take(self, ip):
+        """Consumes one token; returns 0 on success or the seconds to wait before retrying."""
+        now = datetime.utcnow()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(ip, (self.capacity, now))
+            tokens = refill_tokens(tokens, updated_at, now, self.capacity, self.refill_seconds)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                retry_after = seconds_until_token(tokens, self.refill_seconds)
+            self._buckets[ip] = (tokens, now)
+            if len(self._buckets) > OTP_IP_BUCKETS_MAX:
+                self._buckets.popitem(last=False)
+            return retry_after
+
+
+class OtpStore:
+    def __init__(self, db, model, secret_key):
+        self.db = db
+        self.model = model
+        self.secret_key = secret_key.encode() if isinstance(secret_key, str) else secret_key
+
+    def _digest(self, phone_number, code):
+        return hmac.new(self.secret_key, f"{phone_number}:{code}".encode(), hashlib.sha256).hexdigest()
+
+    def _locked_row(self, phone_number):
+        return self.db.session.query(self.model).filter_by(phone_number=phone_number).with_for_update().first()
+
+    def issue(self, phone_number):
+        """Creates a fresh OTP if the phone's bucket allows it.
+
+        Returns (code, 0) on success or (None, retry_after_seconds) when rate limited.
+        """
+        for _ in range(2): # Second pass only if a concurrent first send for this phone won the insert
+            now = datetime.utcnow()
+            row = self._locked_row(phone_number)
+            if row is None:
+                row = self.model(phone_number=phone_number, send_tokens=OTP_PHONE_BUCKET_CAPACITY, tokens_updated_at=now)
+                self.db.session.add(row)
+
+            tokens = refill_tokens(row.send_tokens, row.tokens_updated_at, now, OTP_PHONE_BUCKET_CAPACITY, OTP_PHONE_REFILL_SECONDS)
+            if tokens < 1:
+                self.db.session.rollback()
+                return None, seconds_until_token(tokens, OTP_PHONE_REFILL_SECONDS)
+
+            code = ''.join(secrets.choice(string.digits) for _ in range(OTP_LENGTH))
+            row.code_hash = self._digest(phone_number, code)
+            row.expires_at = now + timedelta(seconds=OTP_TTL_SECONDS)
+            row.attempts = 0
+            row.send_tokens = tokens - 1
+            row.tokens_updated_at = now
+            try:
+                self.db.session.commit()
+                return code, 0
+            except IntegrityError:
+                self.db.session.rollback()
+        return None, OTP_PHONE_REFILL_SECONDS
+
+    def verify(self, phone_number, code):
+        """Checks a submitted code; returns one of VERIFIED, INVALID, EXPIRED, MISSING, LOCKED."""
+        row = self._locked_row(phone_number)
+        try:
+            if row is None or row.code_hash is None:
+                return MISSING
+            if datetime.utcnow() > row.expires_at:
+                row.code_hash = None
+                return EXPIRED
+            if row.attempts >= OTP_MAX_ATTEMPTS:
+                return LOCKED
+            if hmac.compare_digest(row.code_hash, self._digest(phone_number, str(code))):
+                row.code_hash = None # Single use; the row itself stays to keep the send bucket
+                return VERIFIED
+            row.attempts += 1
+            return INVALID
+        finally:
+            self.db.session.commit()
+
+
+class SmsDispatcher:
+    """Bounded queue of (phone_number, code) sends drained by background worker threads."""
+
+    def __init__(self, send, workers=SMS_DISPATCH_WORKERS, max_queue=SMS_DISPATCH_QUEUE_SIZE):
+        self.send = send
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f'sms-dispatch-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, phone_number, code):
+        """Queues an OTP SMS; returns False if the queue is full."""
+        self._start() # Started on first use so forked workers get their own threads
+        try:
+            self._queue.put_nowait((phone_number, code))
+            return True
+        except queue.Full:
+            logger.error("SMS dispatch queue full; dropping OTP send to %s", phone_number)
+            return False
+
+    def _run(self):
+        while True:
+            phone_number, code = self._queue.get()
+            try:
+                response = self.send(code, phone_number)
+                if response.get('StrRetStatus') == 'Ok':
+                    logger.info("OTP SMS delivered to provider for %s", phone_number)
+                else:
+                    logger.error("Melipayamak failed to send OTP to %s: %s", phone_number, logs.payload(response))
+            except Exception as e:
+                logger.error("Error dispatching OTP SMS to %s: %s", phone_number, e, exc_info=True)
+            finally:
+                self._queue.task_done()
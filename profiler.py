@@ -0,0 +1,121 @@
+"""On-demand sampling profiler for a fraction of requests, with flame-graph output.
+
+An admin turns it on for a while with a sample rate. Each request then has that chance to
+be tracked, and while any tracked request is running, a sampler thread snapshots the stacks
+of the tracked threads every PROFILER_INTERVAL seconds via sys._current_frames(). Stacks
+are aggregated per endpoint in "folded" form (`endpoint;file:function;... count`), which
+flamegraph.pl, speedscope and most flame-graph viewers read directly. Untracked requests
+pay only one random() call, and nothing runs at all while the profiler is off.
+
+State is per process: with several workers, each one is toggled and read separately.
+"""
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', 0.005)) # Seconds between stack samples
+PROFILER_MAX_DURATION = int(os.getenv('PROFILER_MAX_DURATION', 3600)) # Longest allowed session, seconds
+PROFILER_MAX_STACKS = int(os.getenv('PROFILER_MAX_STACKS', 20000)) # Distinct folded stacks kept
+PROFILER_MAX_DEPTH = 64
+
+
+def fold_stack(frame):
+    """`file:function` entries from the outermost caller down to `frame`, joined with ';'."""
+    entries = []
+    while frame is not None and len(entries) < PROFILER_MAX_DEPTH:
+        code = frame.f_code
+        entries.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(entries))
+
+
+class SamplingProfiler:
+    def __init__(self):
+        self.rate = 0.0
+        self.until = 0.0
+        self.samples = Counter() # folded stack -> samples
+        self.requests = 0
+        self.dropped = 0
+        self._tracked = {} # thread id -> endpoint
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    @property
+    def active(self):
+        return self.rate > 0 and time.monotonic() < self.until
+
+    def start(self, rate, duration, reset=True):
+        duration = min(duration, PROFILER_MAX_DURATION)
+        with self._lock:
+            if reset:
+                self.samples.clear()
+                self.requests = 0
+                self.dropped = 0
+            self.rate = rate
+            self.until = time.monotonic() + duration
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self.rate = 0.0
+            self.until = 0.0
+
+    def maybe_track(self, endpoint):
+        """Tracks the calling thread's request with probability `rate`; returns whether it did."""
+        if not self.active or random.random() >= self.rate:
+            return False
+        with self._lock:
+            self._tracked[threading.get_ident()] = endpoint or 'unmatched'
+            self.requests += 1
+        self._wake.set()
+        return True
+
+    def untrack(self):
+        with self._lock:
+            self._tracked.pop(threading.get_ident(), None)
+
+    def _run(self):
+        while True:
+            if not self._tracked:
+                self._wake.wait(1)
+                self._wake.clear()
+                continue
+            time.sleep(PROFILER_INTERVAL)
+            with self._lock:
+                tracked = dict(self._tracked)
+            frames = sys._current_frames()
+            for thread_id, endpoint in tracked.items():
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = f"{endpoint};{fold_stack(frame)}"
+                with self._lock:
+                    if stack in self.samples or len(self.samples) < PROFILER_MAX_STACKS:
+                        self.samples[stack] += 1
+                    else:
+                        self.dropped += 1
+            del frames
+
+    def status(self):
+        with self._lock:
+            return {
+                'active': self.active,
+                'rate': self.rate,
+                'seconds_left': max(0, round(self.until - time.monotonic())) if self.active else 0,
+                'requests_sampled': self.requests,
+                'stacks': len(self.samples),
+                'samples': sum(self.samples.values()),
+                'dropped_samples': self.dropped,
+            }
+
+    def folded(self):
+        """All stacks in folded format, heaviest first."""
+        with self._lock:
+            stacks = self.samples.most_common()
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks)
@@ -0,0 +1,130 @@
+"""Background reconciliation of pending Zarinpal payments.
+
+A pending_transactions row normally disappears when the browser returns to the verify
+callback. Rows whose callback never came (closed tab, lost connection, crash mid-callback)
+are picked up here once they are PAYMENT_RECONCILE_AGE seconds old: scanned oldest first in
+keyset batches over the created_at index, verified with the gateway by a small thread pool,
+and then either credited or expired. Crediting goes through the same claim-and-credit
+transaction as the callback, so a row is credited exactly once however many callbacks and
+reconcilers race for it. Rows that fail with a transient error stay for the next pass.
+"""
+import os
+import threading
+import time
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, tuple_
+
+logger = logging.getLogger(__name__)
+
+PAYMENT_RECONCILE_INTERVAL = int(os.getenv('PAYMENT_RECONCILE_INTERVAL', 600)) # Seconds between passes
+PAYMENT_RECONCILE_AGE = int(os.getenv('PAYMENT_RECONCILE_AGE', 1800)) # Leave newer rows to the callback
+PAYMENT_RECONCILE_BATCH = int(os.getenv('PAYMENT_RECONCILE_BATCH', 100))
+PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv('PAYMENT_RECONCILE_CONCURRENCY', 4)) # Gateway calls in flight
+# Unverified payments are refunded by the gateway long before this; older rows are dropped
+PAYMENT_PENDING_MAX_AGE = int(os.getenv('PAYMENT_PENDING_MAX_AGE', 3 * 86400))
+
+VERIFIED_STATUSES = (100, 101) # Verified now, or verified earlier by a callback that never committed
+# The gateway has no successful payment for the authority: not found, not paid, failed, archived
+UNPAID_STATUSES = (-11, -21, -22, -54)
+
+# Outcomes counted per pass
+CREDITED = 'credited'
+ALREADY_SETTLED = 'already_settled' # A callback got there first
+EXPIRED = 'expired'
+UNKNOWN_USER = 'unknown_user' # Verified but the user is gone; moved to orphaned_payments by settle()
+RETRY = 'retry' # Gateway error or unexpected status; tried again next pass
+
+
+class PaymentReconciler:
+    def __init__(self, db, pending_model, verify, settle, expire):
+        """`verify(authority, amount)` returns the gateway result (Status, RefID).
+
+        `settle(authority, ref_id)` claims and credits a verified payment and returns
+        (claimed, balance) like the verify callback does; `expire(authority)` deletes a row.
+        """
+        self.app = None # Bound by init_app()
+        self.db = db
+        self.table = pending_model.__table__
+        self.verify = verify
+        self.settle = settle
+        self.expire = expire
+        self._executor = None
+        self._thread = None
+        self._lock = threading.Lock() # One pass at a time per process
+
+    def init_app(self, app):
+        self.app = app
+
+    def _stale_batch(self, cutoff, after):
+        table = self.table
+        query = select(table.c.authority, table.c.amount, table.c.created_at, table.c.id).where(table.c.created_at < cutoff)
+        if after is not None:
+            query = query.where(tuple_(table.c.created_at, table.c.id) > after)
+        with self.db.engine.connect() as conn:
+            return conn.execute(query.order_by(table.c.created_at, table.c.id).limit(PAYMENT_RECONCILE_BATCH)).all()
+
+    def run_once(self):
+        """Reconciles every stale row once; returns a Counter of outcomes."""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=PAYMENT_RECONCILE_CONCURRENCY, thread_name_prefix='payment-reconcile')
+            now = datetime.utcnow()
+            cutoff = now - timedelta(seconds=PAYMENT_RECONCILE_AGE)
+            expire_before = now - timedelta(seconds=PAYMENT_PENDING_MAX_AGE)
+            counts = Counter()
+            after = None
+            while True:
+                rows = self._stale_batch(cutoff, after)
+                counts.update(self._executor.map(lambda row: self._reconcile_safely(row, expire_before), rows))
+                if len(rows) < PAYMENT_RECONCILE_BATCH:
+                    return counts
+                after = (rows[-1].created_at, rows[-1].id)
+
+    def _reconcile_safely(self, row, expire_before):
+        with self.app.app_context():
+            try:
+                return self._reconcile(row, expire_before)
+            except Exception as e:
+                self.db.session.rollback()
+                logger.warning("Reconciling payment %s failed, will retry: %s", row.authority, e)
+                return RETRY
+            finally:
+                self.db.session.remove()
+
+    def _reconcile(self, row, expire_before):
+        result = self.verify(row.authority, row.amount)
+        if result.Status in VERIFIED_STATUSES:
+            claimed, balance = self.settle(row.authority, result.RefID)
+            if claimed is None:
+                return ALREADY_SETTLED
+            if balance is None:
+                logger.error("CRITICAL: Reconciled payment %s (RefID: %s) belongs to unknown user %s; moved to orphaned_payments", row.authority, result.RefID, claimed.phone_number)
+                return UNKNOWN_USER
+            logger.info("Reconciled payment %s for user %s: credited %s. RefID: %s", row.authority, balance.user_id, claimed.original_amount, result.RefID)
+            return CREDITED
+        if result.Status in UNPAID_STATUSES or row.created_at < expire_before:
+            return EXPIRED if self.expire(row.authority) else ALREADY_SETTLED
+        logger.warning("Gateway returned status %s while reconciling payment %s", result.Status, row.authority)
+        return RETRY
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(PAYMENT_RECONCILE_INTERVAL)
+                try:
+                    with self.app.app_context():
+                        counts = self.run_once()
+                    if counts:
+                        logger.info("Payment reconciliation: %s", dict(counts))
+                except Exception as e:
+                    logger.error("Payment reconciliation pass failed: %s", e, exc_info=True)
+
+        self._thread = threading.Thread(target=run, name='payment-reconciler', daemon=True)
+        self._thread.start()
@@ -0,0 +1,208 @@
+"""Daily business metrics, rolled up incrementally from the primary tables.
+
+Reports read only the small `daily_rollups` table. A refresh folds in just the rows added
+since the last one: each source table has an id watermark in `rollup_watermarks`, and a
+batch of newer rows is aggregated per day and added to the rollups in the same transaction
+that advances the watermark, so a crash or a concurrent refresh never counts a row twice.
+The watermark row is locked with SKIP LOCKED, so only one node refreshes a source at a time.
+
+Rows are folded in id order and only once they are ROLLUP_SETTLE_SECONDS old, which gives
+transactions that hold a lower id time to commit before the watermark passes it. Wallet
+credits and sessions come from the ledger, so those columns start when the ledger did.
+"""
+import os
+import threading
+import time
+import logging
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+import accounting
+
+logger = logging.getLogger(__name__)
+
+ROLLUP_INTERVAL = int(os.getenv('ROLLUP_INTERVAL', 300)) # Seconds between background refreshes
+ROLLUP_BATCH_SIZE = int(os.getenv('ROLLUP_BATCH_SIZE', 5000)) # Source rows per transaction
+ROLLUP_SETTLE_SECONDS = int(os.getenv('ROLLUP_SETTLE_SECONDS', 60))
+# Days are bucketed in local time; Iran has used a fixed UTC+03:30 since 2022
+ROLLUP_UTC_OFFSET_MINUTES = int(os.getenv('ROLLUP_UTC_OFFSET_MINUTES', 210))
+
+# Counter columns of daily_rollups
+METRICS = (
+    'revenue', # Rials actually paid through the gateway
+    'topups', # Paid top-ups
+    'wallet_credited', # Rials credited to wallets by top-ups and discount codes
+    'session_purchases', # Session minutes bought from the wallet
+    'paid_sessions', # Paid sessions started
+    'free_sessions', # Free sessions started
+    'new_users',
+    'feedback_count',
+    'rating_count',
+    'rating_sum',
+)
+
+
+def local_day(timestamp):
+    return (timestamp + timedelta(minutes=ROLLUP_UTC_OFFSET_MINUTES)).date()
+
+
+def insert_for(conn):
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+class Rollups:
+    def __init__(self, db, rollup_model, watermark_model, user_model, purchase_model, ledger_model, feedback_model):
+        self.app = None # Bound by init_app()
+        self.db = db
+        self.rollups = rollup_model.__table__
+        self.watermarks = watermark_model.__table__
+        users, purchases = user_model.__table__, purchase_model.__table__
+        ledger, feedback = ledger_model.__table__, feedback_model.__table__
+        # source name -> (table, timestamp column, extra columns, fold(row, counters))
+        self.sources = {
+            'users': (users, users.c.created_at, [], self._fold_user),
+            'purchases': (purchases, purchases.c.purchase_time,
+                          [purchases.c.amount_paid, purchases.c.sessions_purchased], self._fold_purchase),
+            'ledger_entries': (ledger, ledger.c.created_at, [ledger.c.kind, ledger.c.amount], self._fold_ledger),
+            'feedback': (feedback, feedback.c.created_at, [feedback.c.rating], self._fold_feedback),
+        }
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+
+    # --- Folding source rows into day counters ---
+
+    @staticmethod
+    def _fold_user(row, counters):
+        counters['new_users'] += 1
+
+    @staticmethod
+    def _fold_purchase(row, counters):
+        if row.sessions_purchased:
+            counters['session_purchases'] += 1
+        elif row.amount_paid: # Wallet top-up through the gateway; 100% discounts pay nothing
+            counters['revenue'] += row.amount_paid
+            counters['topups'] += 1
+
+    @staticmethod
+    def _fold_ledger(row, counters):
+        if row.kind in (accounting.TOPUP, accounting.DISCOUNT_CREDIT):
+            counters['wallet_credited'] += row.amount
+        elif row.kind == accounting.SESSION_START:
+            counters['paid_sessions'] += 1
+        elif row.kind == accounting.FREE_SESSION:
+            counters['free_sessions'] += 1
+
+    @staticmethod
+    def _fold_feedback(row, counters):
+        counters['feedback_count'] += 1
+        if row.rating is not None:
+            counters['rating_count'] += 1
+            counters['rating_sum'] += row.rating
+
+    # --- Refresh ---
+
+    def refresh(self):
+        """Folds all settled new rows into the rollups; returns {source: rows folded}."""
+        self._ensure_watermarks()
+        folded = {}
+        for name in self.sources:
+            total = 0
+            while True:
+                count, more = self._refresh_batch(name)
+                total += count
+                if not more:
+                    break
+            folded[name] = total
+        return folded
+
+    def _ensure_watermarks(self):
+        with self.db.engine.begin() as conn:
+            insert = insert_for(conn)
+            now = datetime.utcnow()
+            conn.execute(insert(self.watermarks).values([
+                {'source': name, 'last_id': 0, 'updated_at': now} for name in self.sources
+            ]).on_conflict_do_nothing(index_elements=[self.watermarks.c.source]))
+
+    def _refresh_batch(self, name):
+        """Folds one batch of `name` rows; returns (rows folded, whether more may be ready)."""
+        table, timestamp, columns, fold = self.sources[name]
+        watermarks = self.watermarks
+        cutoff = datetime.utcnow() - timedelta(seconds=ROLLUP_SETTLE_SECONDS)
+        with self.db.engine.begin() as conn:
+            last_id = conn.execute(
+                select(watermarks.c.last_id).where(watermarks.c.source == name).with_for_update(skip_locked=True)
+            ).scalar()
+            if last_id is None: # Another node is refreshing this source right now
+                return 0, False
+            rows = conn.execute(
+                select(table.c.id, timestamp.label('ts'), *columns)
+                .where(table.c.id > last_id)
+                .order_by(table.c.id)
+                .limit(ROLLUP_BATCH_SIZE)
+            ).all()
+            days = defaultdict(lambda: dict.fromkeys(METRICS, 0))
+            new_last_id = last_id
+            for row in rows:
+                if row.ts > cutoff: # Not settled yet; later ids wait behind it
+                    break
+                fold(row, days[local_day(row.ts)])
+                new_last_id = row.id
+            if new_last_id == last_id:
+                return 0, False
+            self._add(conn, days)
+            conn.execute(update(watermarks).where(watermarks.c.source == name).values(last_id=new_last_id, updated_at=datetime.utcnow()))
+        folded = sum(1 for row in rows if row.id <= new_last_id)
+        return folded, len(rows) == ROLLUP_BATCH_SIZE and folded == len(rows)
+
+    def _add(self, conn, days):
+        insert = insert_for(conn)
+        rollups = self.rollups
+        now = datetime.utcnow()
+        for day, counters in days.items():
+            statement = insert(rollups).values(day=day, updated_at=now, **counters)
+            conn.execute(statement.on_conflict_do_update(
+                index_elements=[rollups.c.day],
+                set_={**{metric: rollups.c[metric] + statement.excluded[metric] for metric in METRICS}, 'updated_at': now},
+            ))
+
+    def start_refresher(self):
+        if self._thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(ROLLUP_INTERVAL)
+                try:
+                    with self.app.app_context():
+                        folded = self.refresh()
+                    if any(folded.values()):
+                        logger.info("Rollup refresh folded %s", folded)
+                except Exception as e:
+                    logger.error("Rollup refresh failed: %s", e, exc_info=True)
+
+        self._thread = threading.Thread(target=run, name='rollup-refresher', daemon=True)
+        self._thread.start()
+
+    # --- Reads ---
+
+    def daily(self, start, end):
+        """Rollup rows for local days start..end inclusive, oldest first, as dicts."""
+        rollups = self.rollups
+        with self.db.engine.connect() as conn:
+            rows = conn.execute(
+                select(rollups).where(rollups.c.day >= start, rollups.c.day <= end).order_by(rollups.c.day)
+            ).all()
+        return [dict(row._mapping) for row in rows]
+
+    def freshness(self):
+        """{source: time its watermark last advanced}."""
+        with self.db.engine.connect() as conn:
+            return dict(conn.execute(select(self.watermarks.c.source, self.watermarks.c.updated_at)).all())
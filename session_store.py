@@ -0,0 +1,170 @@
+"""Database-backed server-side sessions with TTL expiry.
+
+Replaces flask_session's filesystem backend when SESSION_TYPE is 'database'. Each session
+is one row (id, compact JSON payload, expiry) in a shared table, so any app node can serve
+any request without sticky sessions. Rows are only rewritten when the session changes or
+its TTL is running low, and a background sweeper deletes expired rows in small batches.
+Session I/O uses its own short connections, never the views' db.session transaction.
+"""
+import os
+import secrets
+import threading
+import time
+import logging
+from datetime import datetime, timedelta
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import delete, select
+from werkzeug.datastructures import CallbackDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SESSION_IDLE_TTL = int(os.getenv('SESSION_IDLE_TTL', 3600)) # Seconds, for non-permanent (pre-login) sessions
+SESSION_REFRESH_FRACTION = float(os.getenv('SESSION_REFRESH_FRACTION', 0.5)) # Re-save once this much TTL is used
+SESSION_SWEEP_INTERVAL = int(os.getenv('SESSION_SWEEP_INTERVAL', 300))
+SESSION_SWEEP_BATCH = int(os.getenv('SESSION_SWEEP_BATCH', 1000))
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires_at = expires_at
+        self.modified = False
+
+
+def upsert_statement(conn, table, values):
+    """INSERT ... ON CONFLICT (session_id) DO UPDATE for the connection's dialect."""
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    statement = insert(table).values(**values)
+    return statement.on_conflict_do_update(
+        index_elements=[table.c.session_id],
+        set_={'data': statement.excluded.data, 'expires_at': statement.excluded.expires_at},
+    )
+
+
+class DatabaseSessionInterface(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, db, model):
+        self.db = db
+        self.table = model.__table__
+        self._sweeper = None
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='delyar-session')
+
+    def _ttl(self, app, session):
+        if session.permanent:
+            return app.permanent_session_lifetime
+        return timedelta(seconds=SESSION_IDLE_TTL)
+
+    def _new_session(self):
+        return ServerSession(sid=secrets.token_urlsafe(32), new=True)
+
+    @metrics.timed_phase('session')
+    def open_session(self, app, request):
+        signed_sid = request.cookies.get(self.get_cookie_name(app))
+        if not signed_sid:
+            return self._new_session()
+        try:
+            sid = self._signer(app).unsign(signed_sid).decode()
+        except BadSignature:
+            return self._new_session()
+
+        with self.db.engine.connect() as conn:
+            row = conn.execute(
+                select(self.table.c.data, self.table.c.expires_at).where(self.table.c.session_id == sid)
+            ).first()
+        if row is None or row.expires_at <= datetime.utcnow():
+            return self._new_session()
+        try:
+            data = self.serializer.loads(row.data.decode())
+        except ValueError:
+            logger.warning("Discarding unreadable session payload for sid %s...", sid[:8])
+            return self._new_session()
+        return ServerSession(data, sid=sid, expires_at=row.expires_at)
+
+    @metrics.timed_phase('session')
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            # Emptied (e.g. logout): drop the row and the cookie; never persist empty new sessions
+            if not session.new:
+                with self.db.engine.begin() as conn:
+                    conn.execute(delete(self.table).where(self.table.c.session_id == session.sid))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = datetime.utcnow()
+        ttl = self._ttl(app, session)
+        needs_refresh = session.expires_at is None or (session.expires_at - now) < ttl * (1 - SESSION_REFRESH_FRACTION)
+        if not (session.modified or session.new or needs_refresh):
+            return
+
+        expires_at = now + ttl
+        values = {
+            'session_id': session.sid,
+            'data': self.serializer.dumps(dict(session)).encode(),
+            'expires_at': expires_at,
+        }
+        with self.db.engine.begin() as conn:
+            conn.execute(upsert_statement(conn, self.table, values))
+
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+    def sweep_expired(self):
+        """Deletes expired rows in batches; returns the number removed."""
+        removed = 0
+        while True:
+            expired_ids = (
+                select(self.table.c.session_id)
+                .where(self.table.c.expires_at < datetime.utcnow())
+                .limit(SESSION_SWEEP_BATCH)
+                .scalar_subquery()
+            )
+            with self.db.engine.begin() as conn:
+                batch = conn.execute(delete(self.table).where(self.table.c.session_id.in_(expired_ids))).rowcount
+            removed += batch
+            if batch < SESSION_SWEEP_BATCH:
+                return removed
+
+    def start_sweeper(self, app):
+        if self._sweeper is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(SESSION_SWEEP_INTERVAL)
+                try:
+                    with app.app_context():
+                        removed = self.sweep_expired()
+                    if removed:
+                        logger.info("Session sweeper removed %s expired sessions", removed)
+                except Exception as e:
+                    logger.error("Session sweep failed: %s", e, exc_info=True)
+
+        self._sweeper = threading.Thread(target=run, name='session-sweeper', daemon=True)
+        self._sweeper.start()
@@ -56,7 +56,7 @@ const ChatPage = () => {
   const mediaRecorderRef = useRef(null);
   const audioChunksRef = useRef([]);
   const isInitialMount = useRef(true);
-  const streamingIntervalRef = useRef(null);
+  const streamAbortRef = useRef(null);
 
   const SESSION_PRICE = parseInt(process.env.REACT_APP_SESSION_PRICE, 10) || 39000;
 
@@ -105,36 +105,44 @@ const ChatPage = () => {
     return scrollHeight - scrollTop - clientHeight > 100;
   };
 
-  const simulateResponseStreaming = useCallback((botMessageId, fullResponse) => {
-    let currentIndex = 0;
-    const chunkSize = 1; // Number of characters per chunk
-    const streamingDelay = 35; // Milliseconds between chunks
-    
-    const streamInterval = setInterval(() => {
-      if (currentIndex < fullResponse.length) {
-        // Calculate next chunk end position
-        const nextIndex = Math.min(currentIndex + chunkSize, fullResponse.length);
-        const currentContent = fullResponse.substring(0, nextIndex);
-        
-        // Update message with current chunk
-        setMessages(prevMessages => {
-          return prevMessages.map(msg => 
-            msg.id === botMessageId 
-              ? { ...msg, content: currentContent }
-              : msg
-          );
+  // Reads the /respond/stream SSE body and hands each text delta to onDelta as it arrives
+  const readResponseStream = async (response, onDelta) => {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder('utf-8');
+    let buffer = '';
+    let fullContent = '';
+
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary;
+      while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+        const frame = buffer.slice(0, boundary);
+        buffer = buffer.slice(boundary + 2);
+
+        let eventName = 'message';
+        let data = '';
+        frame.split('\n').forEach(line => {
+          if (line.startsWith('event:')) eventName = line.slice(6).trim();
+          else if (line.startsWith('data:')) data += line.slice(5).trim();
         });
-        
-        currentIndex = nextIndex;
-      } else {
-        // Streaming complete
-        clearInterval(streamInterval);
+        if (!data) continue;
+
+        const payload = JSON.parse(data);
+        if (eventName === 'error') {
+          throw { response: { data: payload } }; // Same shape as an axios error for the caller
+        }
+        if (eventName === 'done') return payload.content ?? fullContent;
+        if (payload.delta) {
+          fullContent += payload.delta;
+          onDelta(fullContent);
+        }
       }
-    }, streamingDelay);
-    
-    // Store interval reference to clear it if needed
-    return streamInterval;
-  }, []);
+    }
+    return fullContent;
+  };
 
   // Update the sendMessage function with improved content handling
   const sendMessage = useCallback(async (contentOverride = null) => {
@@ -188,20 +196,39 @@ const ChatPage = () => {
     try {
         const firstUserMessage = messages.filter(msg => msg.type === 'USER').length === 0;
         
-        // Use the exact stored message in the API call
-        const response = await axios.post(`${API_URL}/respond`, {
-          sessionId,
-          content: exactUserMessage,
-          isFirstMessage: firstUserMessage,
-          messageType: 'USER'
-      });
-  
-        if (streamingIntervalRef.current) {
-            clearInterval(streamingIntervalRef.current);
+        if (streamAbortRef.current) streamAbortRef.current.abort();
+        const abortController = new AbortController();
+        streamAbortRef.current = abortController;
+
+        // Use the exact stored message in the API call; fetch is used because axios can't read a streamed body
+        const response = await fetch(`${API_URL}/respond/stream`, {
+          method: 'POST',
+          credentials: 'include',
+          headers: { 'Content-Type': 'application/json' },
+          body: JSON.stringify({
+            sessionId,
+            content: exactUserMessage,
+            isFirstMessage: firstUserMessage,
+            messageType: 'USER'
+          }),
+          signal: abortController.signal
+        });
+
+        if (!response.ok) {
+            const errorData = await response.json().catch(() => ({}));
+            throw { response: { status: response.status, data: errorData } };
         }
-        streamingIntervalRef.current = simulateResponseStreaming(botMessageId, response.data.content);
+
+        const updateBotMessage = (content) => {
+            setMessages(prevMessages => prevMessages.map(msg =>
+                msg.id === botMessageId ? { ...msg, content } : msg
+            ));
+        };
+        const finalContent = await readResponseStream(response, updateBotMessage);
+        updateBotMessage(finalContent);
 
     } catch (error) {
+        if (error.name === 'AbortError') return;
         console.error('Error sending message:', error.response?.data || error.message);
         const errorData = error.response?.data;
         showStatusMessage(errorData?.error || 'خطا در ارسال پیام', 5000, 'error');
@@ -365,7 +392,7 @@ const ChatPage = () => {
       console.log("--- ChatPage Cleanup ---");
       if (intervalRef.current) clearInterval(intervalRef.current);
       if (messageTimeoutRef.current) clearTimeout(messageTimeoutRef.current);
-      if (streamingIntervalRef.current) clearInterval(streamingIntervalRef.current);
+      if (streamAbortRef.current) streamAbortRef.current.abort();
     };
   }, [location.state?.sessionId, navigate, showStatusMessage, checkForNextSession]);
 
@@ -3,10 +3,9 @@ import { Plus, X, RotateCw, AlertCircle } from 'lucide-react';
 import axios from 'axios';
 import './ChatSidebar.css';
 
-// Constants for local storage keys
-const TITLE_GENERATION_MARKER = 'chatTitleGenerated_';
-const CHAT_TITLE_CACHE = 'chatTitleCache_';
-const TITLE_GENERATION_QUEUE = 'chatTitleQueue';
+const PAGE_SIZE = 15;
+const TITLE_REFRESH_DELAY = 10000; // Titles are generated server-side; re-check pending ones after this long
+const TITLE_REFRESH_LIMIT = 3;
 
 const API_URL = process.env.REACT_APP_API_URL;
 
@@ -25,86 +24,29 @@ const ChatSidebar = forwardRef(({ onSelectChat, onNewChat, isOpen, toggleSidebar
   const [error, setError] = useState(null);
   const [page, setPage] = useState(0);
   const [hasMore, setHasMore] = useState(true);
-  const [titleQueue, setTitleQueue] = useState(() => {
-    try {
-      return JSON.parse(localStorage.getItem(TITLE_GENERATION_QUEUE) || '[]');
-    } catch {
-      console.error("Failed to parse title queue from localStorage");
-      return [];
-    }
-  });
-  const [processingTitle, setProcessingTitle] = useState(false);
+  const [titleRefreshCount, setTitleRefreshCount] = useState(0);
 
   const userPhoneNumber = useMemo(() => currentUserData?.phone_number || getUserPhone(), [currentUserData]);
 
-  useEffect(() => {
-    try {
-      localStorage.setItem(TITLE_GENERATION_QUEUE, JSON.stringify(titleQueue));
-    } catch (e) {
-      console.error("Failed to save title queue to localStorage:", e);
-    }
-  }, [titleQueue]);
-
-  const fetchChatDetailsAndQueueTitle = useCallback(async (chatId) => {
-    const isGenerated = localStorage.getItem(TITLE_GENERATION_MARKER + chatId) === 'true';
-    const isQueued = localStorage.getItem(TITLE_GENERATION_MARKER + chatId) === 'queued';
-
-    if (isGenerated || isQueued) {
-      if (isGenerated) {
-        const cachedTitle = localStorage.getItem(CHAT_TITLE_CACHE + chatId) || 'گفتگوی قبلی';
-        setChats(prev => prev.map(c => c.id === chatId && c.title !== cachedTitle ? { ...c, title: cachedTitle } : c));
-      }
-      return;
-    }
-
-    try {
-      const detailResponse = await axios.get(`${API_URL}/api/chat/sessions/${chatId}`);
-      const messages = detailResponse.data?.messages || detailResponse.data?.history || [];
-      const metisTitle = detailResponse.data?.title;
-
-      let lastMsgTime = chats.find(c => c.id === chatId)?.lastMessageTime || new Date().toISOString();
-      if (messages.length > 0) {
-        const sortedMessages = [...messages].sort((a, b) => new Date(b.timestamp) - new Date(a.timestamp));
-        lastMsgTime = sortedMessages[0].timestamp || lastMsgTime;
-      }
-
-      let finalTitle = 'گفتگوی جدید';
-      let shouldQueue = false;
-
-      if (metisTitle && metisTitle.length > 1 && metisTitle !== 'گفتگوی جدید' && !metisTitle.includes('کاربر:')) {
-        finalTitle = metisTitle;
-        localStorage.setItem(CHAT_TITLE_CACHE + chatId, finalTitle);
-        localStorage.setItem(TITLE_GENERATION_MARKER + chatId, 'true');
-      } else if (messages.length > 0) {
-        finalTitle = 'در حال تولید عنوان...';
-        shouldQueue = true;
-      } else {
-        finalTitle = 'گفتگوی خالی';
-        localStorage.setItem(CHAT_TITLE_CACHE + chatId, finalTitle);
-        localStorage.setItem(TITLE_GENERATION_MARKER + chatId, 'true');
-      }
+  // Maps a session summary from /api/chat/sessions/summary to the title shown in the list
+  const titleFromSummary = (summary) => {
+    if (summary.title) return summary.title;
+    if (summary.detailsUnavailable) return 'خطا در بارگذاری عنوان';
+    if (summary.titlePending) return 'در حال تولید عنوان...';
+    if (summary.messageCount === 0) return 'گفتگوی خالی';
+    return null; // Falls back to the date label
+  };
 
-      setChats(prevChats => prevChats.map(chat =>
-        chat.id === chatId ? { ...chat, title: finalTitle, messages: messages.slice(0, 5), lastMessageTime: lastMsgTime } : chat
-      ));
+  // Drop the title caches and queue left behind by the old in-browser title generator
+  useEffect(() => {
+    Object.keys(localStorage)
+      .filter(key => key.startsWith('chatTitleGenerated_') || key.startsWith('chatTitleCache_') || key === 'chatTitleQueue')
+      .forEach(key => localStorage.removeItem(key));
+  }, []);
 
-      if (shouldQueue) {
-        const contextMessages = messages.slice(0, 5).map(m => ({ type: m.type, content: m.content?.substring(0, 150) }));
-        localStorage.setItem(TITLE_GENERATION_MARKER + chatId, 'queued'); // Mark as queued
-        setTitleQueue(prevQueue => {
-          if (!prevQueue.some(item => item.id === chatId)) {
-            return [...prevQueue, { id: chatId, messages: contextMessages }];
-          }
-          return prevQueue;
-        });
-      }
-    } catch (error) {
-      console.error(`Error fetching chat details for ${chatId}:`, error);
-      setChats(prevChats => prevChats.map(chat =>
-        chat.id === chatId ? { ...chat, title: 'خطا در بارگذاری عنوان' } : chat
-      ));
-    }
-  }, [chats]);
+  const fetchSummaryPage = (targetPage) => axios.get(`${API_URL}/api/chat/sessions/summary`, {
+    params: { page: targetPage, size: PAGE_SIZE }
+  });
 
   const fetchChats = useCallback(async (reset = false) => {
     if (loading || (!hasMore && !reset)) return;
@@ -119,36 +61,24 @@ const ChatSidebar = forwardRef(({ onSelectChat, onNewChat, isOpen, toggleSidebar
     const targetPage = reset ? 0 : page;
 
     try {
-      const response = await axios.get(`${API_URL}/api/chat/sessions`, {
-        params: { page: targetPage, size: 15 }
-      });
+      // One request returns the page with stored titles and previews; titles are generated by the server
+      const response = await fetchSummaryPage(targetPage);
 
-      const fetchedChats = response.data.map(chat => {
-        const cachedTitle = localStorage.getItem(CHAT_TITLE_CACHE + chat.id);
-        const isGenerated = localStorage.getItem(TITLE_GENERATION_MARKER + chat.id) === 'true';
-        const isQueued = localStorage.getItem(TITLE_GENERATION_MARKER + chat.id) === 'queued';
-        return {
-          ...chat,
-          id: chat.id,
-          title: (isGenerated && cachedTitle) ? cachedTitle : (isQueued ? 'در حال تولید عنوان...' : 'در حال بارگذاری عنوان...'),
-          lastMessageTime: chat.lastActivityDate || chat.startDate || new Date().toISOString(),
-          needsTitleCheck: !(isGenerated || isQueued),
-        };
-      });
+      const fetchedChats = response.data.map(chat => ({
+        ...chat,
+        title: titleFromSummary(chat),
+        lastMessageTime: chat.lastMessageTime || new Date().toISOString(),
+        sourcePage: targetPage,
+      }));
 
-      setHasMore(fetchedChats.length === 15);
+      setHasMore(fetchedChats.length === PAGE_SIZE);
       setChats(prevChats => {
         const existingIds = new Set(prevChats.map(c => c.id));
         const uniqueNewChats = fetchedChats.filter(c => !existingIds.has(c.id));
         return reset ? fetchedChats : [...prevChats, ...uniqueNewChats];
       });
       setPage(prevPage => reset ? 1 : prevPage + 1);
-
-      fetchedChats.forEach(chat => {
-        if (chat.needsTitleCheck) {
-          fetchChatDetailsAndQueueTitle(chat.id);
-        }
-      });
+      if (reset) setTitleRefreshCount(0);
     } catch (err) {
       console.error('Error fetching chats:', err.response?.data || err.message);
       setError('خطا در بارگذاری تاریخچه گفتگو');
@@ -156,7 +86,7 @@ const ChatSidebar = forwardRef(({ onSelectChat, onNewChat, isOpen, toggleSidebar
     } finally {
       setLoading(false);
     }
-  }, [userPhoneNumber, fetchChatDetailsAndQueueTitle]);
+  }, [userPhoneNumber]);
 
   useEffect(() => {
     if (isOpen && chats.length === 0) {
@@ -167,62 +97,29 @@ const ChatSidebar = forwardRef(({ onSelectChat, onNewChat, isOpen, toggleSidebar
     }
   }, [isOpen, fetchChats]);
 
+  // Re-fetches the pages that still have titles being generated and updates just those titles
   useEffect(() => {
-    const generatePendingTitle = async () => {
-      if (titleQueue.length === 0 || processingTitle) return;
-
-      setProcessingTitle(true);
-      const chatToProcess = titleQueue[0];
+    const pendingPages = [...new Set(chats.filter(c => c.titlePending).map(c => c.sourcePage))];
+    if (pendingPages.length === 0 || titleRefreshCount >= TITLE_REFRESH_LIMIT) return;
 
+    const timeoutId = setTimeout(async () => {
       try {
-        const isGenerated = localStorage.getItem(TITLE_GENERATION_MARKER + chatToProcess.id) === 'true';
-        if (isGenerated) {
-          const cachedTitle = localStorage.getItem(CHAT_TITLE_CACHE + chatToProcess.id) || 'گفتگوی قبلی';
-          setChats(prev => prev.map(c => c.id === chatToProcess.id ? { ...c, title: cachedTitle } : c));
-          setTitleQueue(prev => prev.slice(1));
-          setProcessingTitle(false);
-          return;
-        }
-        const titlePrompt = `با توجه به متن گفتگوی زیر، یک عنوان کوتاه و مناسب (حداکثر ۵ کلمه) پیشنهاد بده. فقط خود عنوان را بنویس:\n\n`;
-
-        const response = await axios.post(`${API_URL}/respond`, {
-          sessionId: chatToProcess.id,
-          content: titlePrompt,
-          isFirstMessage: false,
-          messageType: 'AI' // Custom flag for backend to recognize
-        }, { timeout: 30000 });
-
-        let generatedTitle = response.data?.content?.trim() || 'گفتگوی جدید';
-        generatedTitle = generatedTitle.replace(/^عنوان:\s*/i, '').replace(/["'*]/g, '');
-        if (generatedTitle.length > 40) generatedTitle = generatedTitle.substring(0, 37) + '...';
-        if (!generatedTitle || generatedTitle.toLowerCase().includes('کاربر:') || generatedTitle.length < 3) {
-          const chatDate = chats.find(c => c.id === chatToProcess.id)?.lastMessageTime || Date.now();
-          generatedTitle = `گفتگو (${new Date(chatDate).toLocaleDateString('fa-IR')})`;
-        }
-
-        localStorage.setItem(CHAT_TITLE_CACHE + chatToProcess.id, generatedTitle);
-        localStorage.setItem(TITLE_GENERATION_MARKER + chatToProcess.id, 'true');
-
-        setChats(prevChats => prevChats.map(chat =>
-          chat.id === chatToProcess.id ? { ...chat, title: generatedTitle } : chat
-        ));
-      } catch (error) {
-        console.error(`Error generating title for chat ${chatToProcess.id}:`, error.response?.data || error.message);
-        const fallbackTitle = 'خطا در تولید عنوان';
-        localStorage.setItem(CHAT_TITLE_CACHE + chatToProcess.id, fallbackTitle);
-        localStorage.setItem(TITLE_GENERATION_MARKER + chatToProcess.id, 'true');
-        setChats(prevChats => prevChats.map(chat =>
-          chat.id === chatToProcess.id ? { ...chat, title: fallbackTitle } : chat
-        ));
+        const responses = await Promise.all(pendingPages.map(fetchSummaryPage));
+        const updates = new Map(responses.flatMap(r => r.data).map(summary => [summary.id, summary]));
+        setChats(prevChats => prevChats.map(chat => {
+          const summary = updates.get(chat.id);
+          return summary && chat.titlePending
+            ? { ...chat, title: titleFromSummary(summary), titlePending: summary.titlePending }
+            : chat;
+        }));
+      } catch (err) {
+        console.error('Error refreshing chat titles:', err.response?.data || err.message);
       } finally {
-        setTitleQueue(prev => prev.slice(1));
-        setProcessingTitle(false);
+        setTitleRefreshCount(count => count + 1);
       }
-    };
-
-    const timeoutId = setTimeout(generatePendingTitle, 500);
+    }, TITLE_REFRESH_DELAY);
     return () => clearTimeout(timeoutId);
-  }, [titleQueue, processingTitle, chats]);
+  }, [chats, titleRefreshCount]);
 
   const formatDate = (dateString) => {
     if (!dateString) return 'زمان نامشخص';
@@ -286,7 +183,7 @@ const ChatSidebar = forwardRef(({ onSelectChat, onNewChat, isOpen, toggleSidebar
             title={`ادامه گفتگو: ${chat.title}`}
           >
             <span className="chat-title">
-              {chat.title && chat.title.includes('...') && !chat.title.includes('خطا') && <span className="loading-indicator" title="در حال تولید عنوان..."></span>}
+              {chat.titlePending && <span className="loading-indicator" title="در حال تولید عنوان..."></span>}
               {chat.title || `گفتگو (${formatDate(chat.lastMessageTime)})`}
             </span>
             <span className="chat-date">
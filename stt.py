@@ -0,0 +1,418 @@
+"""Speech-to-text helpers: spooling, preprocessing and splitting voice uploads.
+
+Uploads are first copied to a spooled temp file (kept in memory only while small) and hashed
+on the way. WAV/PCM input is then downmixed to mono, downsampled to 16 kHz and trimmed of
+leading and trailing silence with vectorized NumPy before upload, which is all the STT model
+uses anyway. Long recordings are cut into chunks of roughly STT_CHUNK_SECONDS, each cut placed at the
+quietest 20 ms frame near the target point so words are not split. The chunks are encoded as
+16-bit mono WAV and transcribed concurrently by the caller. Audio is decoded, resampled and cut
+one block at a time, so a long upload is never held in memory as a whole. WAV uploads are
+decoded in-process with NumPy. Other formats (the browser records webm/opus) are streamed
+through ffmpeg when it is installed, unless the upload is too small to need chunking, in which
+case it is sent as is. Anything that can't be decoded goes to the STT API in one request, as before.
+
+Results are cached by a hash of the audio bytes and the model name, so re-uploads of the same
+recording (frontend retries, resends after an error) don't call the STT API again.
+"""
+import os
+import json
+import shutil
+import hashlib
+import threading
+import subprocess
+import tempfile
+import time
+import wave
+import logging
+
+from caching import TTLCache
+
+np = None # NumPy, imported by load_numpy() on the first upload; chunked transcription is disabled without it
+_numpy_checked = False
+
+logger = logging.getLogger(__name__)
+
+STT_CHUNK_MIN_SECONDS = float(os.getenv('STT_CHUNK_MIN_SECONDS', 45)) # Shorter clips are sent in one request
+STT_CHUNK_SECONDS = float(os.getenv('STT_CHUNK_SECONDS', 30))
+STT_CHUNK_SEARCH_SECONDS = float(os.getenv('STT_CHUNK_SEARCH_SECONDS', 5)) # How far from each target cut to look for silence
+STT_FFMPEG = os.getenv('STT_FFMPEG') or shutil.which('ffmpeg')
+STT_DECODE_TIMEOUT = int(os.getenv('STT_DECODE_TIMEOUT', 30))
+STT_DECODE_RATE = 16000 # Sample rate ffmpeg decodes to and WAV input is downsampled to
+STT_MIN_BYTES_PER_SECOND = int(os.getenv('STT_MIN_BYTES_PER_SECOND', 2000)) # Lowest bitrate expected of compressed uploads; smaller ones are too short to chunk
+DECODE_BLOCK_SECONDS = 1 # Audio decoded per step; only the uncut tail of a recording is held in memory
+STT_SILENCE_DBFS = float(os.getenv('STT_SILENCE_DBFS', -45)) # Frames quieter than this count as silence
+STT_TRIM_PADDING_SECONDS = 0.3 # Silence kept around speech when trimming
+STT_SPOOL_MAX_MEMORY = int(os.getenv('STT_SPOOL_MAX_MEMORY', 1024 * 1024)) # Larger uploads spill to a temp file
+SPOOL_BLOCK_SIZE = 64 * 1024
+FRAME_SECONDS = 0.02
+STT_CACHE_SIZE = int(os.getenv('STT_CACHE_SIZE', 1000)) # In-memory entries
+STT_CACHE_TTL = int(os.getenv('STT_CACHE_TTL', 7 * 24 * 3600))
+STT_CACHE_DIR = os.getenv('STT_CACHE_DIR') # Unset keeps the cache in memory only
+STT_CACHE_DISK_MAX_ENTRIES = int(os.getenv('STT_CACHE_DISK_MAX_ENTRIES', 20000))
+STT_CACHE_PRUNE_EVERY = 100 # Disk writes between size checks
+
+
+def load_numpy():
+    """Imports NumPy on first use so importing this module (and forking workers) stays cheap."""
+    global np, _numpy_checked
+    if not _numpy_checked:
+        try:
+            import numpy
+            np = numpy
+        except ImportError:
+            pass
+        _numpy_checked = True
+    return np
+
+
+def is_wav(data):
+    return len(data) >= 12 and data[:4] == b'RIFF' and data[8:12] == b'WAVE'
+
+
+def pcm_to_float(raw, sample_width, channels):
+    """Converts interleaved integer PCM to mono float32 samples in [-1, 1]."""
+    if sample_width == 1:
+        samples = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif sample_width == 2:
+        samples = np.frombuffer(raw, dtype='<i2').astype(np.float32) / 32768
+    elif sample_width == 3:
+        # Widen 24-bit little-endian samples to int32 by shifting them into the top three bytes
+        triplets = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = ((triplets[:, 0] << 8) | (triplets[:, 1] << 16) | (triplets[:, 2] << 24)).astype(np.float32) / 2147483648
+    elif sample_width == 4:
+        samples = np.frombuffer(raw, dtype='<i4').astype(np.float32) / 2147483648
+    else:
+        return None
+    if channels > 1:
+        samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).mean(axis=1)
+    return samples
+
+
+class DecodeError(Exception):
+    """The upload could not be decoded; it is then sent to the STT API unchanged."""
+
+
+def wav_blocks(wav):
+    """Yields an open WAV reader's audio as mono float32 blocks of DECODE_BLOCK_SECONDS."""
+    channels, sample_width = wav.getnchannels(), wav.getsampwidth()
+    block_frames = max(1, int(wav.getframerate() * DECODE_BLOCK_SECONDS))
+    while True:
+        raw = wav.readframes(block_frames)
+        if not raw:
+            return
+        yield pcm_to_float(raw, sample_width, channels)
+
+
+def feed_process(pipe, fileobj):
+    try:
+        while True:
+            block = fileobj.read(SPOOL_BLOCK_SIZE)
+            if not block:
+                break
+            pipe.write(block)
+    except OSError:
+        pass # ffmpeg stopped reading; its exit status says why
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+
+def ffmpeg_blocks(fileobj):
+    """Yields audio decoded by ffmpeg as mono STT_DECODE_RATE float32 blocks of DECODE_BLOCK_SECONDS.
+
+    The upload is fed to ffmpeg from a helper thread while its output is read one block at a
+    time, so neither side is ever held whole. Raises DecodeError if ffmpeg fails or runs past
+    STT_DECODE_TIMEOUT.
+    """
+    with tempfile.TemporaryFile() as errors:
+        try:
+            process = subprocess.Popen(
+                [STT_FFMPEG, '-nostdin', '-loglevel', 'error', '-i', 'pipe:0',
+                 '-f', 's16le', '-ac', '1', '-ar', str(STT_DECODE_RATE), 'pipe:1'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=errors,
+            )
+        except OSError as e:
+            raise DecodeError(f"ffmpeg could not be started: {e}") from e
+        feeder = threading.Thread(target=feed_process, args=(process.stdin, fileobj), daemon=True)
+        feeder.start()
+        timer = threading.Timer(STT_DECODE_TIMEOUT, process.kill)
+        timer.start()
+        block_bytes = 2 * int(STT_DECODE_RATE * DECODE_BLOCK_SECONDS)
+        try:
+            while True:
+                raw = process.stdout.read(block_bytes)
+                if not raw:
+                    break
+                yield pcm_to_float(raw, 2, 1)
+            process.wait()
+            timed_out = not timer.is_alive()
+        finally:
+            timer.cancel()
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+            process.stdout.close()
+            feeder.join()
+        if timed_out:
+            raise DecodeError(f"ffmpeg took longer than {STT_DECODE_TIMEOUT} s")
+        if process.returncode != 0:
+            errors.seek(0)
+            raise DecodeError(f"ffmpeg failed: {errors.read(200).decode(errors='replace')}")
+
+
+def spool_upload(stream, model):
+    """Copies an upload into a spooled temp file while hashing it.
+
+    Returns (spool positioned at 0, cache key). The spool outlives the request, so deferred
+    upstream calls can still read it after Flask has closed the request's own files.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=STT_SPOOL_MAX_MEMORY)
+    digest = hashlib.sha256(model.encode())
+    digest.update(b'\0')
+    while True:
+        block = stream.read(SPOOL_BLOCK_SIZE)
+        if not block:
+            break
+        digest.update(block)
+        spool.write(block)
+    spool.seek(0)
+    return spool, digest.hexdigest()
+
+
+def upload_size(spool):
+    spool.seek(0, os.SEEK_END)
+    size = spool.tell()
+    spool.seek(0)
+    return size
+
+
+def resample_blocks(blocks, rate, target_rate=STT_DECODE_RATE):
+    """Downsamples a stream of blocks with a box low-pass and linear interpolation; lower rates are left alone.
+
+    The few source samples the next output sample still needs are carried into the next block,
+    so block edges leave no seams.
+    """
+    if rate <= target_rate:
+        yield from blocks
+        return
+    step = rate / target_rate
+    width = int(np.ceil(step))
+    kernel = np.full(width, 1 / width, dtype=np.float32)
+    pending = np.empty(0, dtype=np.float32)
+    offset = 0 # Source index of pending[0]
+    position = 0.0 # Source index of the next output sample
+    for block in blocks:
+        pending = np.concatenate([pending, block])
+        filtered = np.convolve(pending, kernel, mode='valid')
+        if len(filtered) < 2:
+            continue
+        positions = np.arange(position - offset, len(filtered) - 1, step)
+        if len(positions):
+            yield np.interp(positions, np.arange(len(filtered)), filtered).astype(np.float32)
+            position = offset + positions[-1] + step
+        keep = int(position) - offset
+        pending = pending[keep:]
+        offset += keep
+
+
+def frame_energy(samples, rate):
+    """RMS energy of consecutive FRAME_SECONDS frames."""
+    frame = max(1, int(rate * FRAME_SECONDS))
+    count = len(samples) // frame
+    frames = samples[:count * frame].reshape(count, frame)
+    return np.sqrt(np.mean(frames * frames, axis=1))
+
+
+def split_at_silence(blocks, rate):
+    """Yields the speech in a stream of sample blocks as chunks to transcribe, in order.
+
+    Leading and trailing frames below STT_SILENCE_DBFS are dropped, keeping a little padding.
+    Once the speech reaches STT_CHUNK_MIN_SECONDS, a chunk is cut off at the quietest frame
+    near every STT_CHUNK_SECONDS; shorter recordings come out as one chunk, and all-quiet ones
+    as none. Only the uncut tail of the recording is buffered, and pauses longer than a chunk
+    are shortened to the padding on either side.
+    """
+    frame = max(1, int(rate * FRAME_SECONDS))
+    threshold = 10 ** (STT_SILENCE_DBFS / 20)
+    padding = int(STT_TRIM_PADDING_SECONDS * rate)
+    chunk_frames = int(STT_CHUNK_SECONDS / FRAME_SECONDS)
+    search_frames = int(STT_CHUNK_SEARCH_SECONDS / FRAME_SECONDS)
+    buffer = np.empty(0, dtype=np.float32)
+    started = False # Leading silence is behind us
+    chunking = False
+    end = 0 # Length of buffer up to the last speech plus padding
+    for block in blocks:
+        buffer = np.concatenate([buffer, block])
+        energy = frame_energy(buffer, rate)
+        voiced = np.flatnonzero(energy > threshold)
+        if not started:
+            if len(voiced) == 0:
+                drop = max(0, len(buffer) - padding)
+                buffer = buffer[drop - drop % frame:]
+                continue
+            start = max(0, voiced[0] * frame - padding)
+            start -= start % frame
+            buffer, energy, voiced = buffer[start:], energy[start // frame:], voiced - start // frame
+            started = True
+        if len(voiced):
+            end = min(len(buffer), (voiced[-1] + 1) * frame + padding)
+        chunking = chunking or end >= STT_CHUNK_MIN_SECONDS * rate
+        while chunking and end // frame > chunk_frames + search_frames:
+            low, high = chunk_frames - search_frames, min(end // frame, chunk_frames + search_frames)
+            cut = (low + int(np.argmin(energy[low:high]))) * frame
+            yield buffer[:cut]
+            buffer, energy, end = buffer[cut:], energy[cut // frame:], end - cut
+        drop = len(buffer) - end - padding
+        if drop > STT_CHUNK_SECONDS * rate:
+            drop -= drop % frame
+            buffer = np.concatenate([buffer[:end], buffer[end + drop:]])
+    if started and end:
+        yield buffer[:end]
+
+
+def encode_wav(samples, rate, target=None):
+    """Writes mono float samples as 16-bit PCM WAV into `target` (a new spooled temp file by default)."""
+    pcm = (np.clip(samples, -1, 1) * 32767).astype('<i2')
+    target = target if target is not None else tempfile.SpooledTemporaryFile(max_size=STT_SPOOL_MAX_MEMORY)
+    with wave.open(target, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(pcm.tobytes())
+    target.seek(0)
+    return target
+
+
+def prepare_uploads(spool, filename, mimetype):
+    """Turns a spooled upload into the file parts to send to the STT API, in playback order.
+
+    Each part is a requests-style (filename, fileobj, mimetype) tuple. Long recordings are
+    decoded a block at a time and split at silence into several WAV parts. A short WAV is sent
+    as one preprocessed 16 kHz mono part. Other formats are sent unchanged when short, because
+    re-encoding compressed audio as WAV would make it bigger; those under
+    STT_CHUNK_MIN_SECONDS at STT_MIN_BYTES_PER_SECOND skip ffmpeg altogether.
+    """
+    passthrough = [(filename, spool, mimetype)]
+    if load_numpy() is None:
+        return passthrough
+    wav_input = is_wav(spool.read(12))
+    spool.seek(0)
+    if wav_input:
+        try:
+            wav = wave.open(spool, 'rb')
+        except (wave.Error, EOFError) as e: # e.g. float WAV, which the wave module does not read
+            logger.debug("WAV upload not decodable in-process: %s", e)
+            spool.seek(0)
+            return passthrough
+        if wav.getsampwidth() not in (1, 2, 3, 4):
+            spool.seek(0)
+            return passthrough
+        rate, blocks = wav.getframerate(), wav_blocks(wav)
+    elif STT_FFMPEG and upload_size(spool) >= STT_CHUNK_MIN_SECONDS * STT_MIN_BYTES_PER_SECOND:
+        rate, blocks = STT_DECODE_RATE, ffmpeg_blocks(spool)
+    else:
+        return passthrough
+
+    out_rate = min(rate, STT_DECODE_RATE)
+    parts = []
+    try:
+        for samples in split_at_silence(resample_blocks(blocks, rate), out_rate):
+            parts.append(encode_wav(samples, out_rate))
+    except DecodeError as e:
+        logger.warning("Could not decode audio upload: %s", e)
+        for part in parts:
+            part.close()
+        return passthrough
+    finally:
+        blocks.close()
+        spool.seek(0)
+    if len(parts) > 1:
+        return [(f'chunk-{i}.wav', part, 'audio/wav') for i, part in enumerate(parts)]
+    if wav_input and parts:
+        wav_name = f'{os.path.splitext(filename)[0] or "audio"}.wav'
+        return [(wav_name, parts[0], 'audio/wav')]
+    for part in parts:
+        part.close()
+    return passthrough
+
+
+def stitch(texts):
+    """Joins chunk transcriptions in order."""
+    return ' '.join(text.strip() for text in texts if text and text.strip())
+
+
+class TranscriptionCache:
+    """LRU transcription cache in memory, optionally backed by one small JSON file per entry on disk.
+
+    Disk entries are evicted oldest-access-first (file mtime is bumped on every hit) once there
+    are more than STT_CACHE_DISK_MAX_ENTRIES of them.
+    """
+
+    def __init__(self, max_size=STT_CACHE_SIZE, ttl=STT_CACHE_TTL, directory=STT_CACHE_DIR,
+                 max_disk_entries=STT_CACHE_DISK_MAX_ENTRIES):
+        self.memory = TTLCache(max_size=max_size, ttl=ttl)
+        self.ttl = ttl
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self._writes = 0
+        self._prune_lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.json')
+
+    def get(self, key):
+        text = self.memory.get(key)
+        if text is not None or not self.directory:
+            return text
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, encoding='utf-8') as f:
+                text = json.load(f)['text']
+            os.utime(path) # Marks the entry as recently used for eviction
+        except (OSError, ValueError, KeyError):
+            return None
+        self.memory.set(key, text)
+        return text
+
+    def set(self, key, text):
+        self.memory.set(key, text)
+        if not self.directory:
+            return
+        path = self._path(key)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'text': text}, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.warning("Could not write STT cache entry %s: %s", key[:12], e)
+            return
+        self._writes += 1
+        if self._writes % STT_CACHE_PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        """Deletes the least recently used disk entries beyond max_disk_entries."""
+        if not self._prune_lock.acquire(blocking=False):
+            return # Another thread is already pruning
+        try:
+            entries = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.json')]
+            excess = len(entries) - self.max_disk_entries
+            if excess <= 0:
+                return
+            entries.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in entries[:excess]:
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+            logger.info("STT cache pruned %s disk entries", excess)
+        finally:
+            self._prune_lock.release()
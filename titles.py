@@ -0,0 +1,154 @@
+"""Background chat title generation, persisted once per chat in the database.
+
+List endpoints enqueue sessions that have no stored title. A single worker thread drains the
+queue in batches, claims the batch's rows (so each chat is generated by one node only),
+generates titles with bounded concurrency and writes all results in one transaction.
+"""
+import os
+import queue
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, or_, select, update
+
+logger = logging.getLogger(__name__)
+
+TITLE_BATCH_SIZE = int(os.getenv('TITLE_BATCH_SIZE', 20))
+TITLE_BATCH_WAIT = float(os.getenv('TITLE_BATCH_WAIT', 2)) # Seconds to keep filling a batch
+TITLE_CONCURRENCY = int(os.getenv('TITLE_CONCURRENCY', 4))
+TITLE_RECLAIM_SECONDS = int(os.getenv('TITLE_RECLAIM_SECONDS', 600)) # Stale claims and retries
+TITLE_MAX_ATTEMPTS = int(os.getenv('TITLE_MAX_ATTEMPTS', 3))
+TITLE_QUEUE_SIZE = 10000
+
+# Row statuses
+PENDING = 'pending' # Claimed by a worker
+DONE = 'done'
+FAILED = 'failed' # Generation failed; retried up to TITLE_MAX_ATTEMPTS
+EMPTY = 'empty' # No messages yet; retried later without counting an attempt
+
+
+def insert_ignore(conn, table, rows):
+    """Bulk INSERT ... ON CONFLICT DO NOTHING for the connection's dialect."""
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    statement = insert(table).values(rows).on_conflict_do_nothing(index_elements=[table.c.session_id])
+    return conn.execute(statement.returning(table.c.session_id)).scalars()
+
+
+class TitleWorker:
+    def __init__(self, db, model, generate, on_stored=None):
+        """`generate(session_id, phone_number)` returns (status, title) with status DONE, FAILED or EMPTY.
+
+        `on_stored(session_id, phone_number)` runs after each title is committed, e.g. to drop caches.
+        """
+        self.app = None # Bound by init_app()
+        self.db = db
+        self.table = model.__table__
+        self.generate = generate
+        self.on_stored = on_stored
+        self._queue = queue.Queue(maxsize=TITLE_QUEUE_SIZE)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+
+    def enqueue(self, session_id, phone_number):
+        with self._lock:
+            if session_id in self._queued:
+                return
+            self._queued.add(session_id)
+            if self._thread is None: # Started on first use so forked workers get their own thread
+                self._thread = threading.Thread(target=self._run, name='title-worker', daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait((session_id, phone_number))
+        except queue.Full:
+            with self._lock:
+                self._queued.discard(session_id)
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = datetime.utcnow() + timedelta(seconds=TITLE_BATCH_WAIT)
+        while len(batch) < TITLE_BATCH_SIZE:
+            remaining = (deadline - datetime.utcnow()).total_seconds()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _claim(self, conn, batch):
+        """Marks the batch's rows as pending for this worker; returns the session ids it won."""
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=TITLE_RECLAIM_SECONDS)
+        ids = [session_id for session_id, _ in batch]
+        existing = set(conn.execute(select(self.table.c.session_id).where(self.table.c.session_id.in_(ids))).scalars())
+        new_rows = [
+            {'session_id': session_id, 'phone_number': phone_number, 'status': PENDING, 'attempts': 0, 'created_at': now, 'updated_at': now}
+            for session_id, phone_number in batch if session_id not in existing
+        ]
+        claimed = []
+        if new_rows:
+            # Rows inserted concurrently by another node are skipped and not returned
+            claimed.extend(insert_ignore(conn, self.table, new_rows))
+        if existing:
+            # Re-claim stale pending rows, empty chats and failed ones with attempts left
+            result = conn.execute(
+                update(self.table)
+                .where(self.table.c.session_id.in_(existing))
+                .where(self.table.c.updated_at < stale)
+                .where(or_(
+                    self.table.c.status.in_([PENDING, EMPTY]),
+                    and_(self.table.c.status == FAILED, self.table.c.attempts < TITLE_MAX_ATTEMPTS),
+                ))
+                .values(status=PENDING, updated_at=now)
+                .returning(self.table.c.session_id)
+            )
+            claimed.extend(result.scalars())
+        return claimed
+
+    def _run(self):
+        executor = ThreadPoolExecutor(max_workers=TITLE_CONCURRENCY, thread_name_prefix='title-gen')
+        while True:
+            batch = self._next_batch()
+            try:
+                with self.app.app_context():
+                    with self.db.engine.begin() as conn:
+                        claimed = self._claim(conn, batch)
+                    phone_numbers = dict(batch)
+                    results = list(executor.map(self._generate_safely, claimed, [phone_numbers[s] for s in claimed]))
+                    now = datetime.utcnow()
+                    with self.db.engine.begin() as conn:
+                        for session_id, (status, title) in zip(claimed, results):
+                            values = {'status': status, 'title': title, 'updated_at': now}
+                            if status == FAILED:
+                                values['attempts'] = self.table.c.attempts + 1
+                            conn.execute(update(self.table).where(self.table.c.session_id == session_id).values(**values))
+                    if self.on_stored:
+                        for session_id, (status, _) in zip(claimed, results):
+                            if status == DONE:
+                                self.on_stored(session_id, phone_numbers[session_id])
+                if claimed:
+                    done = sum(1 for status, _ in results if status == DONE)
+                    logger.info("Title worker processed %s chats (%s titled)", len(claimed), done)
+            except Exception as e:
+                logger.error("Title batch failed: %s", e, exc_info=True)
+            finally:
+                with self._lock:
+                    self._queued.difference_update(session_id for session_id, _ in batch)
+
+    def _generate_safely(self, session_id, phone_number):
+        try:
+            with self.app.app_context(): # Runs on the title-gen pool, outside _run's context
+                return self.generate(session_id, phone_number)
+        except Exception as e:
+            logger.warning("Title generation failed for session %s: %s", session_id, e)
+            return FAILED, None
@@ -0,0 +1,189 @@
+"""Local mirror of MetisAI chat transcripts with write-behind persistence.
+
+Chat endpoints hand new sessions and messages to TranscriptStore, which queues them and writes
+them from a background thread in batches, one transaction per batch, off the request path.
+History reads use the local copy when it holds the whole transcript and nothing for that
+session is still queued. Otherwise the caller falls back to MetisAI and backfills the mirror
+from its answer.
+"""
+import os
+import queue
+import threading
+import logging
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import delete, select, update
+
+logger = logging.getLogger(__name__)
+
+TRANSCRIPT_FLUSH_INTERVAL = float(os.getenv('TRANSCRIPT_FLUSH_INTERVAL', 0.5)) # Seconds to keep filling a batch
+TRANSCRIPT_BATCH_SIZE = int(os.getenv('TRANSCRIPT_BATCH_SIZE', 200)) # Operations per transaction
+TRANSCRIPT_QUEUE_SIZE = int(os.getenv('TRANSCRIPT_QUEUE_SIZE', 10000))
+
+# Queued operations
+CREATE = 'create' # Session started here, so the mirror holds its whole transcript
+APPEND = 'append' # New messages on a session that may predate the mirror
+REPLACE = 'replace' # Backfill from a full MetisAI transcript
+RESYNC = 'resync' # Local copy may have diverged; serve the next read from MetisAI
+
+
+def utc_timestamp():
+    return datetime.utcnow().isoformat() + 'Z'
+
+
+def insert_for(conn):
+    if conn.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+class TranscriptStore:
+    def __init__(self, db, session_model, message_model):
+        self.app = None # Bound by init_app()
+        self.db = db
+        self.sessions = session_model.__table__
+        self.messages = message_model.__table__
+        self._queue = queue.Queue(maxsize=TRANSCRIPT_QUEUE_SIZE)
+        self._pending = Counter() # session_id -> operations queued but not yet committed
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def init_app(self, app):
+        self.app = app
+
+    # --- Writes (queued) ---
+
+    def create_session(self, session_id, phone_number, messages):
+        self._put((CREATE, session_id, phone_number, None, messages, None))
+
+    def append(self, session_id, phone_number, messages):
+        self._put((APPEND, session_id, phone_number, None, messages, None))
+
+    def replace(self, session_id, phone_number, title, messages, fetched_at):
+        """Backfills a session from a MetisAI transcript requested at `fetched_at` (UTC).
+
+        Skipped while local writes for the session are queued here; the writer also skips it
+        if any node committed a write to the session after `fetched_at`, since the upstream
+        copy may then be missing that turn.
+        """
+        if self.has_pending(session_id):
+            return
+        self._put((REPLACE, session_id, phone_number, title, messages, fetched_at))
+
+    def mark_incomplete(self, session_id):
+        self._put((RESYNC, session_id, None, None, None, None))
+
+    def has_pending(self, session_id):
+        with self._lock:
+            return self._pending[session_id] > 0
+
+    def _put(self, op):
+        session_id = op[1]
+        with self._lock:
+            self._pending[session_id] += 1
+            if self._thread is None: # Started on first use so forked workers get their own thread
+                self._thread = threading.Thread(target=self._run, name='transcript-writer', daemon=True)
+                self._thread.start()
+        try:
+            self._queue.put_nowait(op)
+        except queue.Full:
+            logger.error("Transcript queue full; local copy of session %s marked incomplete", session_id)
+            self._settle([op], failed=True)
+
+    # --- Reads ---
+
+    def load(self, session_id):
+        """Returns (title, messages) from the local copy, or None if it can't answer on its own."""
+        if self.has_pending(session_id):
+            return None
+        with self.db.engine.connect() as conn:
+            session_row = conn.execute(
+                select(self.sessions.c.title, self.sessions.c.complete).where(self.sessions.c.session_id == session_id)
+            ).first()
+            if session_row is None or not session_row.complete:
+                return None
+            rows = conn.execute(
+                select(self.messages.c.type, self.messages.c.content, self.messages.c.timestamp)
+                .where(self.messages.c.session_id == session_id)
+                .order_by(self.messages.c.id)
+            ).all()
+        messages = [{'type': row.type, 'content': row.content, 'timestamp': row.timestamp} for row in rows]
+        return session_row.title, messages
+
+    # --- Background writer ---
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        while len(batch) < TRANSCRIPT_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get(timeout=TRANSCRIPT_FLUSH_INTERVAL))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            failed = False
+            try:
+                with self.app.app_context():
+                    with self.db.engine.begin() as conn:
+                        for op in batch:
+                            self._apply(conn, op)
+            except Exception as e:
+                failed = True
+                logger.error("Transcript batch of %s operations failed: %s", len(batch), e, exc_info=True)
+            self._settle(batch, failed)
+
+    def _settle(self, batch, failed):
+        if failed:
+            # The mirror now misses messages for these sessions; send their reads back to MetisAI
+            session_ids = {op[1] for op in batch}
+            try:
+                with self.app.app_context():
+                    with self.db.engine.begin() as conn:
+                        conn.execute(update(self.sessions).where(self.sessions.c.session_id.in_(session_ids)).values(complete=False))
+            except Exception as e:
+                logger.error("Could not mark transcripts incomplete for %s sessions: %s", len(session_ids), e)
+        with self._lock:
+            for op in batch:
+                self._pending[op[1]] -= 1
+                if self._pending[op[1]] <= 0:
+                    del self._pending[op[1]]
+
+    def _apply(self, conn, op):
+        kind, session_id, phone_number, title, messages, fetched_at = op
+        if kind == RESYNC:
+            conn.execute(update(self.sessions).where(self.sessions.c.session_id == session_id).values(complete=False))
+            return
+        if kind == REPLACE:
+            updated_at = conn.execute(
+                select(self.sessions.c.updated_at).where(self.sessions.c.session_id == session_id).with_for_update()
+            ).scalar()
+            if updated_at is not None and updated_at >= fetched_at:
+                return # Written since the MetisAI fetch began; keep the newer local copy
+        insert = insert_for(conn)
+        now = datetime.utcnow()
+        row = {'session_id': session_id, 'phone_number': phone_number, 'title': title,
+               'complete': kind != APPEND, 'created_at': now, 'updated_at': now}
+        statement = insert(self.sessions).values(**row)
+        if kind == REPLACE:
+            conn.execute(statement.on_conflict_do_update(
+                index_elements=[self.sessions.c.session_id],
+                set_={'title': title, 'complete': True, 'updated_at': now},
+            ))
+            conn.execute(delete(self.messages).where(self.messages.c.session_id == session_id))
+        else:
+            conn.execute(statement.on_conflict_do_update(
+                index_elements=[self.sessions.c.session_id],
+                set_={'updated_at': now},
+            ))
+        if messages:
+            conn.execute(self.messages.insert(), [
+                {'session_id': session_id, 'type': m.get('type'), 'content': m.get('content') or '',
+                 'timestamp': m.get('timestamp') or utc_timestamp()}
+                for m in messages
+            ])
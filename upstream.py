@@ -0,0 +1,181 @@
+"""Shared HTTP client layer for upstream services (MetisAI, STT, Melipayamak).
+
+Each upstream host gets one keep-alive requests.Session with its own connection pool, so
+repeated calls reuse TCP/TLS connections instead of handshaking every time. Idempotent
+GETs get bounded retries with jittered backoff, and every host has a circuit breaker that
+fails fast while the upstream is down instead of letting each request wait out a timeout.
+Every attempt is timed into metrics.py under an operation name registered by the app.
+"""
+import os
+import random
+import re
+import threading
+import time
+import logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 20)) # Kept-alive connections per host
+UPSTREAM_MAX_RETRIES = int(os.getenv('UPSTREAM_MAX_RETRIES', 2)) # Extra attempts, GET only
+UPSTREAM_RETRY_BACKOFF = float(os.getenv('UPSTREAM_RETRY_BACKOFF', 0.2)) # Seconds, doubled per attempt
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv('UPSTREAM_BREAKER_THRESHOLD', 5)) # Consecutive failures to open
+UPSTREAM_BREAKER_RESET_SECONDS = float(os.getenv('UPSTREAM_BREAKER_RESET_SECONDS', 30))
+
+RETRYABLE_STATUS_CODES = frozenset({502, 503, 504})
+IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS'})
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    """Raised without touching the network while a host's circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker: closed -> open after `threshold` failures -> one half-open probe."""
+
+    def __init__(self, host, threshold=UPSTREAM_BREAKER_THRESHOLD, reset_seconds=UPSTREAM_BREAKER_RESET_SECONDS):
+        self.host = host
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        return 'half-open' if self._probing else 'open'
+
+    def before_call(self):
+        """Raises UpstreamUnavailable if calls to this host should fail fast right now."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if self._probing or time.monotonic() - self._opened_at < self.reset_seconds:
+                raise UpstreamUnavailable(f"Circuit open for upstream {self.host}")
+            self._probing = True # Let a single request through to test the upstream
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info("Circuit closed for upstream %s", self.host)
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.threshold:
+                if self._opened_at is None:
+                    logger.warning("Circuit opened for upstream %s after %s consecutive failures", self.host, self._failures)
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def record_status(self, status_code):
+        if status_code >= 500:
+            self.record_failure()
+        else:
+            self.record_success()
+
+
+_operations = [] # (name, method, url pattern, SOAPAction substring or None)
+
+def register_operation(name, method, url_pattern, soap_action=None):
+    """Names calls matching `method` and the `url_pattern` regex (and SOAPAction) for metrics."""
+    _operations.append((name, method.upper(), re.compile(url_pattern), soap_action))
+
+def operation_for(method, url, headers=None):
+    method = method.upper()
+    for name, operation_method, pattern, soap_action in _operations:
+        if operation_method != method or not pattern.search(url):
+            continue
+        if soap_action is None or soap_action in str((headers or {}).get('SOAPAction', '')):
+            return name
+    return f"{urlsplit(url).netloc} {method}"
+
+
+def attempts_for(method):
+    return 1 + (UPSTREAM_MAX_RETRIES if method.upper() in IDEMPOTENT_METHODS else 0)
+
+
+def retry_delay(attempt):
+    """Full-jitter exponential backoff for the given zero-based attempt."""
+    return random.uniform(0, UPSTREAM_RETRY_BACKOFF * (2 ** attempt))
+
+
+class UpstreamClient:
+    """Pooled session plus breaker and retry policy for a single upstream host."""
+
+    def __init__(self, host):
+        self.host = host
+        self.breaker = CircuitBreaker(host)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=UPSTREAM_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, **kwargs):
+        attempts = attempts_for(method)
+        operation = operation_for(method, url, kwargs.get('headers'))
+        for attempt in range(attempts):
+            try:
+                self.breaker.before_call()
+            except UpstreamUnavailable:
+                metrics.registry.inc('upstream_circuit_rejections_total', operation)
+                raise
+            last_attempt = attempt + 1 >= attempts
+            try:
+                with metrics.UpstreamTimer(operation) as timer:
+                    response = self.session.request(method, url, **kwargs)
+                    timer.outcome = metrics.outcome_for(response.status_code)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.breaker.record_failure()
+                if last_attempt:
+                    raise
+                logger.warning("%s %s failed (%s), retrying (%s/%s)", method, self.host, e.__class__.__name__, attempt + 1, attempts - 1)
+            except Exception:
+                # Not retried (ChunkedEncodingError, TooManyRedirects, SSL errors...), but a half-open probe must still resolve
+                self.breaker.record_failure()
+                raise
+            else:
+                self.breaker.record_status(response.status_code)
+                if last_attempt or response.status_code not in RETRYABLE_STATUS_CODES:
+                    return response
+                logger.warning("%s %s returned %s, retrying (%s/%s)", method, self.host, response.status_code, attempt + 1, attempts - 1)
+                response.close()
+            time.sleep(retry_delay(attempt))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def client_for(url):
+    """Returns the shared client for the URL's host, creating it on first use."""
+    host = urlsplit(url).netloc
+    client = _clients.get(host)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(host)
+            if client is None:
+                client = _clients[host] = UpstreamClient(host)
+    return client
+
+def _reset_after_fork():
+    # A forked worker must not share the parent's keep-alive sockets; it builds its own clients
+    global _clients_lock
+    _clients.clear()
+    _clients_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def request(method, url, **kwargs):
+    """Drop-in replacement for requests.request() that goes through the host's pooled client."""
+    return client_for(url).request(method, url, **kwargs)
@@ -0,0 +1,105 @@
+"""Process-wide Zarinpal SOAP gateway client.
+
+The WSDL is downloaded and parsed once (and kept in suds' on-disk object cache, so restarts
+skip the fetch too). suds clients keep per-call state, so each payment call borrows one from
+a small pool of idle clients and returns it afterwards; the pool grows to the number of
+concurrent calls, each new client built from the cached WSDL. All HTTP, including the SOAP
+calls themselves, goes through the pooled keep-alive client in upstream.py. suds itself is
+only imported when the first client is built (or by warm_up() in a pre-fork master).
+"""
+import io
+import os
+import queue
+import threading
+import logging
+import functools
+from contextlib import contextmanager
+
+import upstream
+
+logger = logging.getLogger(__name__)
+
+ZARINPAL_WSDL_CACHE_DIR = os.getenv('ZARINPAL_WSDL_CACHE_DIR', './.wsdl_cache')
+ZARINPAL_WSDL_CACHE_DAYS = int(os.getenv('ZARINPAL_WSDL_CACHE_DAYS', 7))
+ZARINPAL_TIMEOUT = int(os.getenv('ZARINPAL_TIMEOUT', 30))
+ZARINPAL_IDLE_CLIENTS = int(os.getenv('ZARINPAL_IDLE_CLIENTS', 16)) # Parsed clients kept between calls
+
+
+@functools.lru_cache(maxsize=None)
+def pooled_transport_class():
+    """suds transport that sends requests through upstream.py instead of a fresh urllib connection."""
+    from suds.transport import Reply, Transport, TransportError
+
+    class PooledTransport(Transport):
+        def open(self, request):
+            response = upstream.request('GET', request.url, headers=request.headers, timeout=self.options.timeout)
+            if response.status_code >= 400:
+                raise TransportError(response.reason, response.status_code, io.BytesIO(response.content))
+            return io.BytesIO(response.content)
+
+        def send(self, request):
+            response = upstream.request('POST', request.url, data=request.message, headers=request.headers, timeout=self.options.timeout)
+            if response.status_code in (202, 204):
+                return None
+            if response.status_code >= 400:
+                raise TransportError(response.reason, response.status_code, io.BytesIO(response.content))
+            return Reply(response.status_code, response.headers, response.content)
+
+    return PooledTransport
+
+
+class ZarinpalGateway:
+    def __init__(self, wsdl_url):
+        self.wsdl_url = wsdl_url
+        self._idle = queue.LifoQueue(maxsize=ZARINPAL_IDLE_CLIENTS)
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def _load(self):
+        # Client.clone() can't be used: deep-copying its options recurses forever on Python 3.11.
+        # Builds are serialized so concurrent first calls wait for one WSDL fetch and then hit the cache.
+        from suds.cache import ObjectCache
+        from suds.client import Client
+
+        with self._lock:
+            os.makedirs(ZARINPAL_WSDL_CACHE_DIR, exist_ok=True)
+            cache = ObjectCache(location=ZARINPAL_WSDL_CACHE_DIR, days=ZARINPAL_WSDL_CACHE_DAYS)
+            client = Client(self.wsdl_url, cache=cache, transport=pooled_transport_class()(), timeout=ZARINPAL_TIMEOUT)
+            if not self._loaded:
+                self._loaded = True
+                logger.info("Zarinpal WSDL loaded from %s", self.wsdl_url)
+            return client
+
+    @contextmanager
+    def client(self):
+        """Lends a parsed client for one call."""
+        try:
+            client = self._idle.get_nowait()
+        except queue.Empty:
+            client = self._load()
+        try:
+            yield client
+        finally:
+            try:
+                self._idle.put_nowait(client)
+            except queue.Full:
+                pass
+
+    def warm_up(self):
+        """Loads the WSDL ahead of the first payment. Failures are logged and retried lazily."""
+        try:
+            with self.client():
+                pass
+        except Exception as e:
+            logger.warning("Zarinpal WSDL warm-up failed, will retry on first payment: %s", e)
+
+    def warm_up_in_background(self):
+        threading.Thread(target=self.warm_up, name='zarinpal-warmup', daemon=True).start()
+
+    def payment_request(self, merchant_id, amount, description, email, mobile, callback_url):
+        with self.client() as client:
+            return client.service.PaymentRequest(merchant_id, amount, description, email, mobile, callback_url)
+
+    def payment_verification(self, merchant_id, authority, amount):
+        with self.client() as client:
+            return client.service.PaymentVerification(merchant_id, authority, amount)